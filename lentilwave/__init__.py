@@ -1,4 +1,4 @@
-from lentilwave.generation.generate import generate
+from lentilwave.generation.generate import generate, generate_series
 from lentilwave.generation.caches import GeneratorCache
 from lentilwave.helpers import TestSettings, TestResults
 from lentilwave.retrieval import estimate_wavefront_errors
\ No newline at end of file
@@ -1,9 +1,13 @@
+import copy
+import time
+
 import prysm
 from lentil.constants_utils import *
 from lentil.wavefront_utils import plot_nominal_psf
 from lentilwave.encode_decode import encode_parameter_tuple, decode_parameter_tuple, convert_wavefront_dicts_to_p_dicts
 from lentilwave import helpers, config
 from lentilwave.generation import masks
+from lentilwave.generation.generate import generate
 
 
 def plot_wfe_data(focusset):
@@ -35,6 +39,101 @@ def plot_wfe_data(focusset):
        -3.86548324]
 
 
+def compare_engines(s, engines=("fft2", "lsf"), quiet=False):
+    """
+    Check generated OTFs from each engine agree with the first (reference) engine
+
+    :param s: TestSettings to evaluate (not modified)
+    :param engines: Propagation engines to compare, first is reference
+    :return: dict of engine: maximum absolute complex OTF difference (sag and tan)
+    """
+    otfs = {}
+    for engine in engines:
+        s_engine = copy.copy(s)
+        s_engine.engine = engine
+        otfs[engine] = np.array(generate(s_engine).otf)
+
+    reference = otfs[engines[0]]
+    errors = {}
+    for engine in engines:
+        errors[engine] = np.abs(otfs[engine] - reference).max()
+        if not quiet:
+            print("{:>6}: max OTF error {:.3e}".format(engine, errors[engine]))
+    return errors
+
+
+def validate_radial_fast_path(s, quiet=False):
+    """
+    Check OTFs from the radially symmetric (Hankel) fast path agree with the 2D path
+
+    :param s: TestSettings to evaluate (not modified)
+    :return: (engine used with fast path enabled, maximum absolute complex OTF difference)
+    """
+    otfs = {}
+    for fast in (False, True):
+        s_fast = copy.deepcopy(s)
+        s_fast.radial_fast_path = fast
+        tr = generate(s_fast)
+        otfs[fast] = np.array(tr.otf), tr.timings['engine']
+    error = np.abs(otfs[True][0] - otfs[False][0]).max()
+    if not quiet:
+        print("{:>6}: max OTF error {:.3e} against {}".format(otfs[True][1], error, otfs[False][1]))
+    return otfs[True][1], error
+
+
+def audit_precision(s, sizes=(96, 128, 192, 256, 384, 512), param="z5", step=1e-3, quiet=False):
+    """
+    Compare float32 and float64 generation over a range of pupil sizes (fftsize is twice phasesamples)
+
+    Reports OTF error, the retrieval mean squares cost of the float32 OTFs against float64 OTFs as
+    chart data, the relative error of a finite difference cost gradient (what the optimiser sees) and
+    the speedup.
+
+    :param s: TestSettings to evaluate (not modified)
+    :param sizes: Pupil samples to test
+    :param param: Parameter for finite difference gradient check
+    :param step: Finite difference step
+    :return: list of dicts, one per size
+    """
+    def run(phasesamples, precision, delta=0.0):
+        s_run = copy.deepcopy(s)
+        s_run.phasesamples = phasesamples
+        s_run.fftsize = phasesamples * 2
+        s_run.precision = precision
+        s_run.p[param] = s_run.p.get(param, 0.0) + delta
+        generate(s_run)  # Warm caches
+        t = time.time()
+        otf = np.array(generate(s_run).otf)
+        return otf, time.time() - t
+
+    def cost(model, chart):
+        # Same mean squares as retrieval cost with uniform weights
+        magdiffs = (abs(model) - abs(chart)) * 2
+        return ((abs(model - chart) ** 2 + magdiffs ** 2).mean()) * config.COST_WEIGHT_MEAN_SQUARES
+
+    results = []
+    for phasesamples in sizes:
+        otf64, t64 = run(phasesamples, 64)
+        otf32, t32 = run(phasesamples, 32)
+        # Gradient of cost against a fixed chart (the unperturbed float64 model, offset to be non-zero)
+        chart = otf64 * 0.98
+        grads = []
+        for precision in (64, 32):
+            plus, _ = run(phasesamples, precision, step)
+            minus, _ = run(phasesamples, precision, -step)
+            grads.append((cost(plus, chart) - cost(minus, chart)) / (2 * step))
+        result = dict(phasesamples=phasesamples,
+                      otf_error=np.abs(otf32 - otf64).max(),
+                      cost=cost(otf32, otf64),
+                      grad_error=abs(grads[1] - grads[0]) / max(abs(grads[0]), 1e-30),
+                      speedup=t64 / t32)
+        results.append(result)
+        if not quiet:
+            print("{phasesamples:>5}: max OTF error {otf_error:.2e}, cost {cost:.2e}, "
+                  "gradient error {grad_error:.2e}, speedup {speedup:.2f}x".format(**result))
+    return results
+
+
 def plot_chromatic_aberration(focusset):
     z4s = []
     z9s = []
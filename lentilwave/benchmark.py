@@ -0,0 +1,254 @@
+import copy
+import itertools
+import json
+import os
+import platform
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+from lentilwave import config, helpers
+from lentilwave.generation import caches
+from lentilwave.generation.generate import generate, generate_series
+
+# Realistic parameter sets (as a retrieval would see them) with image location (None for centre)
+PARAMETER_SETS = OrderedDict([
+    # On axis with only rotationally symmetric aberrations
+    ("onaxis", (dict(fstop=1.4, base_fstop=1.4, df_offset=0, df_step=1, z9=0.1, z16=0.03, loca=0.2, spca=0.1),
+                None)),
+    # Off axis with coma and astigmatism
+    ("offaxis", (dict(fstop=2.0, base_fstop=1.4, df_offset=0, df_step=1, z5=0.05, z6=-0.02, z7=0.03, z8=0.01,
+                      z9=0.05, z16=0.02, loca=0.1, spca=0.1, tca_slr=0.01, v_slr=0.2, a=1.0, b=1.0),
+                 (3500, 2500))),
+])
+
+# Settings attributes selecting engine modes, so each mode has its own baseline
+ENGINE_MODES = OrderedDict([
+    ("default", {}),
+    ("lsf", dict(engine="lsf")),
+    ("mft", dict(engine="mft")),
+    ("packed", dict(packed_pupil=True)),
+    ("radial", dict(radial_fast_path=True)),
+    ("nofastpaths", dict(radial_fast_path=False, mirror_fast_path=False)),
+])
+
+# Default sweep, (phasesamples, fftsize) pairs are swept together
+SIZES = ((128, 256), (192, 384), (256, 512))
+NUM_WAVELENGTHS = (3, 9)
+MONO = (False, True)
+RETURN_PSF = (False, True)
+PRECISIONS = (64, 32)
+
+# Fields identifying a benchmark case
+CASE_FIELDS = ('params', 'mode', 'phasesamples', 'fftsize', 'num_wavelengths', 'mono', 'return_psf', 'precision',
+               'slices')
+
+
+def get_cases(params=tuple(PARAMETER_SETS), modes=("default",), sizes=SIZES, num_wavelengths=NUM_WAVELENGTHS,
+              mono=MONO, return_psf=RETURN_PSF, precisions=PRECISIONS, slices=(1,)):
+    """
+    Get every combination of the swept settings as benchmark cases.
+
+    Wavelength count has no effect on monochromatic cases, so those are only included once (with one wavelength).
+
+    :param slices: Defocus slices per call, more than one uses generate_series()
+    :return: list of case dicts keyed as CASE_FIELDS
+    """
+    cases = []
+    for name, mode, (phasesamples, fftsize), wavelengths, mono_, psf, precision, num_slices in itertools.product(
+            params, modes, sizes, num_wavelengths, mono, return_psf, precisions, slices):
+        case = dict(params=name, mode=mode, phasesamples=phasesamples, fftsize=fftsize,
+                    num_wavelengths=1 if mono_ else wavelengths, mono=mono_, return_psf=psf, precision=precision,
+                    slices=num_slices)
+        if case not in cases:
+            cases.append(case)
+    return cases
+
+
+def get_case_key(case):
+    return "/".join("{}={}".format(field, case[field]) for field in CASE_FIELDS)
+
+
+def get_case_settings(case):
+    """
+    Get TestSettings for a benchmark case (CPU only, as generate() would be called from retrieval).
+
+    :return: TestSettings
+    """
+    p, location = PARAMETER_SETS[case['params']]
+    x_loc, y_loc = location or (None, None)
+    s = helpers.TestSettings(copy.deepcopy(p), x_loc=x_loc, y_loc=y_loc, defocus=0.5)
+    s.allow_cuda = False
+    s.phasesamples = case['phasesamples']
+    s.fftsize = case['fftsize']
+    s.mono = case['mono']
+    s.return_psf = case['return_psf']
+    s.precision = case['precision']
+    s.wavelengths = helpers.get_model_wavelengths(case['num_wavelengths'])
+    for attr, value in ENGINE_MODES[case['mode']].items():
+        setattr(s, attr, value)
+    return s
+
+
+def run_case(case, min_time=1.0, min_repeats=3, cache_=None):
+    """
+    Time generate() (or generate_series() for more than one slice) for one case.
+
+    Caches are warmed by one untimed call first, so results reflect the steady state of a retrieval. Peak memory
+    is what numpy allocates during one further call, which tracemalloc sees.
+
+    :param case: Case dict from get_cases()
+    :param min_time: Keep repeating until this many seconds have been timed
+    :param min_repeats: and at least this many calls
+    :param cache_: Generator caches (defaults to fresh caches for each case)
+    :return: dict of case fields and results
+    """
+    if cache_ is None:
+        cache_ = {'np': caches.GeneratorCache(), 'cp': caches.GeneratorCache()}
+    s = get_case_settings(case)
+    defocus_values = np.linspace(-1, 1, case['slices']) if case['slices'] > 1 else None
+
+    def call():
+        s_call = copy.copy(s)
+        if defocus_values is None:
+            return [generate(s_call, cache_=cache_)]
+        return generate_series(s_call, defocus_values, cache_=cache_)
+
+    engine = call()[0].timings.get('engine')
+
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    times = []
+    start = time.time()
+    while len(times) < min_repeats or time.time() - start < min_time:
+        t = time.time()
+        call()
+        times.append(time.time() - t)
+
+    median = float(np.median(times))
+    result = dict(case)
+    result.update(engine=engine,
+                  calls=len(times),
+                  median_ms=median * 1e3,
+                  min_ms=min(times) * 1e3,
+                  slices_per_s=case['slices'] / median,
+                  peak_mb=peak / 2 ** 20)
+    return result
+
+
+def run(cases=None, min_time=1.0, min_repeats=3, quiet=False):
+    """
+    Run benchmark cases.
+
+    :param cases: list of case dicts (defaults to get_cases())
+    :return: dict of case key: result
+    """
+    if cases is None:
+        cases = get_cases()
+    results = OrderedDict()
+    if not quiet:
+        print("Running {} benchmark cases".format(len(cases)))
+    for case in cases:
+        result = run_case(case, min_time=min_time, min_repeats=min_repeats)
+        results[get_case_key(case)] = result
+        if not quiet:
+            print_result(result)
+    return results
+
+
+def print_result(result, baseline=None):
+    line = ("{params:>8} {mode:>11} {phasesamples:>4}/{fftsize:<4} wvls {num_wavelengths:>2} "
+            "psf {return_psf:d} fp{precision} x{slices} {engine:>7}: {slices_per_s:>8.1f} slices/s "
+            "{peak_mb:>7.1f} MB".format(**result))
+    if baseline is not None:
+        line += " ({:+.0%} speed, {:+.0%} memory)".format(*get_changes(result, baseline))
+    print(line)
+
+
+def get_host_info():
+    return dict(host=platform.node(),
+                machine=platform.machine(),
+                processor=platform.processor(),
+                cpus=os.cpu_count(),
+                python=platform.python_version(),
+                numpy=np.__version__)
+
+
+def get_baseline_path(name="baseline"):
+    if config.BENCHMARK_DIR is None:
+        raise ValueError("No baseline path given and config.BENCHMARK_DIR is None")
+    return os.path.join(config.BENCHMARK_DIR, "{}_{}.json".format(name, platform.node() or "host"))
+
+
+def save_baseline(results, path=None):
+    """
+    Save results as a JSON baseline.
+
+    :param path: defaults to get_baseline_path()
+    :return: path written
+    """
+    if path is None:
+        path = get_baseline_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(dict(created=time.strftime("%Y-%m-%dT%H:%M:%S"), host=get_host_info(), results=results),
+                  file, indent=1)
+    return path
+
+
+def load_baseline(path=None):
+    """
+    :return: dict of case key: result
+    """
+    if path is None:
+        path = get_baseline_path()
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def get_changes(result, baseline):
+    """
+    :return: (relative change in throughput, relative change in peak memory), positive is more
+    """
+    speed = result['slices_per_s'] / baseline['slices_per_s'] - 1
+    memory = result['peak_mb'] / max(baseline['peak_mb'], 1e-9) - 1
+    return speed, memory
+
+
+def compare(results, baseline, tolerance=None, quiet=False):
+    """
+    Compare results against a baseline.
+
+    A case regresses if throughput drops, or peak memory grows, by more than the tolerance.
+
+    :param results: dict of case key: result (from run())
+    :param baseline: dict of case key: result (from load_baseline())
+    :param tolerance: Fractional change allowed (defaults to config.BENCHMARK_TOLERANCE)
+    :return: list of (case key, speed change, memory change) for regressed cases
+    """
+    if tolerance is None:
+        tolerance = config.BENCHMARK_TOLERANCE
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        speed, memory = get_changes(result, baseline[key])
+        if not quiet:
+            print_result(result, baseline[key])
+        if speed < -tolerance or memory > tolerance:
+            regressions.append((key, speed, memory))
+    if not quiet:
+        missing = len([key for key in results if key not in baseline])
+        print("{} of {} cases regressed by more than {:.0%}{}".format(
+            len(regressions), len(results) - missing, tolerance,
+            ", {} not in baseline".format(missing) if missing else ""))
+        for key, speed, memory in regressions:
+            print("  {}: {:+.0%} speed, {:+.0%} memory".format(key, speed, memory))
+    return regressions
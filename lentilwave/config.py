@@ -32,6 +32,30 @@ PRECISION = 64 if USE_CUDA else 64
 CUDA_PROCESSES = 2
 CUDA_CPU_PROCESSES = 2
 CPU_ONLY_PROCESSES = 1
+FFT_BACKEND = "fftpack"  # CPU FFTs from "fftpack", "scipy" (multithreaded scipy.fft), "numpy" or "fftw" (pyfftw)
+FFT_WORKERS = 1  # Threads per FFT with "scipy" or "fftw" backends, consider fewer processes if raising
+FFT_MULTITHREAD_MIN_SIZE = 1024  # Smaller FFTs always use one thread
+FFTW_PLANNER_EFFORT = "FFTW_MEASURE"
+# Files written to persist state between runs are all opt in (None to disable), for example under
+# os.path.join(os.path.expanduser("~"), ".lentilwave")
+FFTW_WISDOM_PATH = None  # FFTW plans
+FFT_AUTOTUNE = False  # Choose CPU FFT sizes by this host's timings rather than the smallest big enough, so model
+                      # sampling depends on the host (see fft_tuning.py)
+FFT_TUNING_DIR = None  # Per host timing tables, FFT_AUTOTUNE needs this set
+FFT_TUNING_MIN_TIME = 0.05  # Seconds timed per candidate size
+FFT_TUNING_TOLERANCE = 0.03  # Prefer a smaller size within this fraction of the fastest
+CACHE_BASE_WAVEFUNCTIONS = True  # Keep each wavelength's wavefunction without defocus, then only apply a defocus phasor
+PACKED_PUPIL = False  # Only work on in-pupil samples (as 1D vectors) until propagation
+USE_WORKSPACES = True  # Reuse preallocated arrays in the generate loop rather than allocating per wavelength
+SHARE_ZERNIKE_CUBES = True  # Build Zernike cubes once in shared memory for all worker processes
+SHARED_CUBE_BYTE_BUDGET = 256 * 2 ** 20  # Shared cube bytes the parent keeps published, and each worker attached
+PROFILE_STAGES = True  # Return per-stage profiles from generate for retrieval to aggregate (see profiling.py)
+PROFILE_MEMORY = False  # Also sample memory at the end of each stage
+PROFILE_SYNC_CUDA = False  # Synchronise GPU after each stage so stage times are accurate (slows GPU pipelines)
+PROFILE_MAX_SAMPLES = 100000  # Per group and stage, for percentiles
+PROFILE_EXPORT_DIR = None  # Profile JSON and CSV output, None to disable export
+BENCHMARK_DIR = None  # Default directory for baselines (see benchmark.py)
+BENCHMARK_TOLERANCE = 0.1  # Fractional throughput loss or memory growth counted as a regression
 CPU_GPU_ARRAYSIZE_BOUNDARY = 144
 CPU_GPU_FFTSIZE_BOUNDARY_FINETUNE = False
 FINETUNE_MIN = 128
@@ -40,15 +64,83 @@ MASK_CACHE_SIZE = 160
 
 ENABLE_PUPIL_DISTORTION = True
 
+BATCH_WAVELENGTHS = False  # Propagate all wavelengths as one stacked 3d array
+BATCH_MAX_BYTES = 128 * 2 ** 20  # Split stacks larger than this
+PROPAGATION_ENGINE = "fft2"  # "fft2" for full 2D PSFs, "lsf" to get only the two LSFs using 1D FFTs,
+                             # "mft" for LSFs from matrix DFTs of the unpadded pupil (approximate, about 3e-5 OTF),
+                             # "auto" for cheapest estimated of fft2/lsf/mft
+MFT_RELATIVE_SPEED = 12  # Flop rate of matrix products relative to FFTs, for "auto" engine choice (measured 12-15)
+RADIAL_FAST_PATH = False  # Use Hankel transforms rather than 2D propagation when the pupil is rotationally symmetric
+                          # (approximate, about 1e-4 OTF at autosized sizes and 1e-3 at small ones)
+HANKEL_OVERSAMPLING = 2  # Radial nodes relative to the minimum for the PSF extent of the 2D FFT
+HANKEL_MAX_MASK_ASYMMETRY = 1e-3  # Largest deviation of mask from its azimuthal mean to still count as symmetric
+MIRROR_FAST_PATH = True  # Only propagate half the pupil when it is a mirror image of itself about the x axis
+POLYCHROMATIC_MODE = "spatial"  # "spatial" to resample LSFs to a common grid, "frequency" to combine scaled OTFs
+                                # (MTFs agree to about 5e-5 from 192 phase samples, worse below: 6e-4 at 128, 1e-2 at 64)
+DIRECT_OTF_SAMPLING = False  # Evaluate OTFs at SPACIAL_FREQS with a cached DFT matrix rather than FFT + splines
+                             # (changes MTFs by about 1e-3, more at small fftsizes; adjoint gradients need it)
+GENERATE_SERIES = False  # Send each focusset to workers as one generate_series() job rather than one job per slice
+# Byte budgets for each GeneratorCache store (None is unbounded), least recently used entries are evicted first
+CACHE_BYTE_BUDGETS = dict(basephases=128 * 2 ** 20,
+                          cubes=1024 * 2 ** 20,
+                          settings=None,
+                          windows=16 * 2 ** 20,
+                          mft_matrices=128 * 2 ** 20,
+                          otf_samplers=16 * 2 ** 20,
+                          masks=None,
+                          workspaces=2048 * 2 ** 20,
+                          defocus_lookups=64 * 2 ** 20,
+                          base_wavefunctions=512 * 2 ** 20,
+                          packings=64 * 2 ** 20,
+                          hankel_transforms=64 * 2 ** 20)
+CACHE_MAX_ENTRIES = dict(masks=MASK_CACHE_SIZE)  # Per store
+CACHE_DEFAULT_MAX_ENTRIES = 5000
+
 
 PSF_SPLINE_ORDER = 3
 
 Q_AUTOSIZE_SCALAR = 1
 PHASE_AUTOSIZE_SCALAR = 0.65
 
+# Coarse to fine retrieval stages, each warm starting the next. All keys are optional:
+#   name: label for logs and saved data
+#   num_wavelengths: model wavelengths, spread as MODEL_WVLS (defaults to MODEL_WVLS)
+#   frequency_step: model every nth of SPACIAL_FREQS
+#   q_autosize_scalar, phase_autosize_scalar: sizing (defaults to Q_AUTOSIZE_SCALAR, PHASE_AUTOSIZE_SCALAR)
+#   max_iterations: (defaults to MAXITER)
+# Stages before the last hand off once cost improves by less than RETRIEVAL_PLATEAU_TOLERANCE (relative) over
+# RETRIEVAL_PLATEAU_ITERATIONS iterations. The default single empty stage always models at full fidelity, a schedule
+# such as
+#     (dict(name="coarse", num_wavelengths=3, frequency_step=2, q_autosize_scalar=0.6, phase_autosize_scalar=0.45,
+#           max_iterations=150),
+#      dict(name="full"))
+# fits at lower fidelity first (so can take a different path and end at a different minimum).
+RETRIEVAL_SCHEDULE = (
+    dict(name="full"),
+)
+RETRIEVAL_PLATEAU_ITERATIONS = 5
+RETRIEVAL_PLATEAU_TOLERANCE = 0.01
+
+# Groups of OPTIMISE_PARAMS added to the fit in turn (None for all parameters in no other group), inactive
+# parameters keep their current values. The default fits all parameters from the start, for example
+#     (('df_offset', 'df_step'), ('z5', 'z6', 'z7', 'z8', 'z9'), None)
+# fits focus first, then primary aberrations, then everything else, each group added once cost plateaus as above.
+# Groups are all added at the fidelity of the first RETRIEVAL_SCHEDULE stage (later stages fit every group), so with
+# a coarse first stage the early groups are only ever fitted coarsely on their own.
+PARAMETER_ACTIVATION = (None,)
+
 DF_STEP_TOLERANCE = 2.1
 
 MAXITER = 600
+SOLVER = "L-BFGS-B"  # or "least_squares" (trust region reflective on the weighted residual vector, MAXITER limits
+                    # its residual evaluations rather than iterations). Its sum of squares is a weighted sum of
+                    # sagittal and meridional costs, not L-BFGS-B's sqrt(cost_sag ** 2 + cost_mer ** 2). Weights
+                    # are set so the two agree (with gradients) at the start of each stage, so it reaches a nearby
+                    # but not identical minimum when the axes' costs change balance.
+ADJOINT_GRADIENTS = True  # Give the optimiser back propagated gradients (see generation/gradients.py) where possible
+                          # (only with DIRECT_OTF_SAMPLING, otherwise this falls back to finite differences)
+GRADIENT_FD_STEP = 1e-8  # Forward difference step for other parameters, as scipy uses by default
+BATCHED_FD_GRADIENTS = True  # Model all forward difference steps in one queue (rather than one by one)
 
 DISABLE_MULTIPROCESSING = False
 LIVE_PLOTTING = not DISABLE_MULTIPROCESSING
@@ -69,6 +161,7 @@ MULTIPLY_BY_BASE_APERTURE = lambda f, b=None: b
 NOP = lambda f, b=None: 1.0
 
 ZERNIKE_SCHEME = "FRINGE"
+ZERNIKE_BASIS_CACHE_DIR = None  # On disk cache of Zernike bases, None to disable
 
 COST_MULTIPLIER = 1
 
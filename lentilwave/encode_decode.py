@@ -179,6 +179,40 @@ def decode_parameter_tuple(tup, passed_options_ordering, dataset, use_existing_f
     return ps, popt, pfix
 
 
+def get_active_indices(passed_options_ordering, groups, num_groups):
+    """
+    Get indices of an encoded parameter tuple which are fitted with the first groups of a progressive activation.
+
+    :param passed_options_ordering: from encode_parameter_tuple()
+    :param groups: Groups of parameter names, None for all parameters in no other group (see
+                   config.PARAMETER_ACTIVATION)
+    :param num_groups: Number of groups active
+    :return: list of indices
+    """
+    grouped = set(name for group in groups if group is not None for name in group)
+    active = []
+    for ix, (name, _, _) in enumerate(passed_options_ordering):
+        for group in groups[:num_groups]:
+            if (name not in grouped) if group is None else (name in group):
+                active.append(ix)
+                break
+    return active
+
+
+def expand_parameter_tuple(active_tup, tup, active_indices):
+    """
+    Get full encoded parameter tuple with active parameters replaced.
+
+    :param active_tup: Values of active parameters
+    :param tup: Full tuple (values of inactive parameters are kept)
+    :param active_indices: from get_active_indices()
+    :return: array
+    """
+    expanded = np.array(tup, dtype="float64")
+    expanded[active_indices] = active_tup
+    return expanded
+
+
 def convert_wavefront_dicts_to_p_dicts(wfdd):
     ps = []
     print(wfdd)
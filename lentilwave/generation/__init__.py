@@ -1 +1 @@
-from lentilwave.generation.generate import generate
\ No newline at end of file
+from lentilwave.generation.generate import generate, generate_series
\ No newline at end of file
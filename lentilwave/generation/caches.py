@@ -1,7 +1,104 @@
+import sys
+from collections import OrderedDict
+
+from lentilwave import config
+
+COUNTER_KEYS = ('c_hits', 'c_misses', 'c_evictions', 'c_mask_hits', 'c_mask_misses')
+
+
+def get_nbytes(value):
+    """
+    Estimate memory used by a cached value (numpy/cupy arrays, or tuples and lists of them).
+
+    :param value: cached object
+    :return: size in bytes
+    """
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Dictionary-like store evicting least recently used entries once over a byte budget or entry count.
+
+    Lookups through [] and get() count hits and misses, 'in' does not.
+    """
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._store = OrderedDict()
+
+    def __getitem__(self, key):
+        try:
+            value, _ = self._store[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._store.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._store:
+            self.nbytes -= self._store.pop(key)[1]
+        nbytes = get_nbytes(value)
+        self._store[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def __len__(self):
+        return len(self._store)
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone is over budget
+        while len(self._store) > 1 and ((self.max_bytes is not None and self.nbytes > self.max_bytes) or
+                                        (self.max_entries is not None and len(self._store) > self.max_entries)):
+            _, (_, nbytes) = self._store.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._store.clear()
+        self.nbytes = 0
+
 
 class GeneratorCache:
-    def __init__(self):
-        self.basephases = {}
-        self.cubes = {}
-        self.settings = {}
-        self.windows = {}
+    def __init__(self, budgets=None):
+        if budgets is None:
+            budgets = config.CACHE_BYTE_BUDGETS
+        for name, max_bytes in budgets.items():
+            max_entries = config.CACHE_MAX_ENTRIES.get(name, config.CACHE_DEFAULT_MAX_ENTRIES)
+            setattr(self, name, LRUCache(max_bytes=max_bytes, max_entries=max_entries))
+        self.names = tuple(budgets)
+
+    def counters(self):
+        """
+        Get hit, miss and eviction counts summed over all stores, plus mask store hits and misses.
+
+        :return: dict of counts keyed as COUNTER_KEYS
+        """
+        stores = [getattr(self, name) for name in self.names]
+        return dict(c_hits=sum(store.hits for store in stores),
+                    c_misses=sum(store.misses for store in stores),
+                    c_evictions=sum(store.evictions for store in stores),
+                    c_mask_hits=self.masks.hits,
+                    c_mask_misses=self.masks.misses)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.names)
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import scipy.fft
+from scipy import fftpack
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+
+from lentilwave import config
+
+BACKEND_FFTPACK = "fftpack"
+BACKEND_SCIPY = "scipy"
+BACKEND_NUMPY = "numpy"
+BACKEND_FFTW = "fftw"
+
+BACKENDS = (BACKEND_FFTPACK, BACKEND_SCIPY, BACKEND_NUMPY, BACKEND_FFTW)
+
+# Backends already set up in this process, keyed by (name, workers)
+_backends = {}
+
+
+class FFTBackend:
+    """
+    CPU FFTs with a common interface: fft() over one axis and fft2() over the last two axes, both
+    optionally allowed to overwrite their input.
+    """
+    name = None
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+    def fft(self, x, axis=-1, overwrite_x=False):
+        raise NotImplementedError
+
+    def fft2(self, x, overwrite_x=False):
+        raise NotImplementedError
+
+    def dct(self, x, axis=-1, overwrite_x=False):
+        # Unnormalised type II, complex input has real and imaginary parts transformed separately
+        return scipy.fft.dct(x, axis=axis, overwrite_x=overwrite_x, workers=self.workers)
+
+
+class FftpackBackend(FFTBackend):
+    name = BACKEND_FFTPACK
+
+    def __init__(self, workers=1):
+        # Single threaded only
+        super().__init__(1)
+
+    def fft(self, x, axis=-1, overwrite_x=False):
+        return fftpack.fft(x, axis=axis, overwrite_x=overwrite_x)
+
+    def fft2(self, x, overwrite_x=False):
+        return fftpack.fft2(x, overwrite_x=overwrite_x)
+
+
+class ScipyBackend(FFTBackend):
+    name = BACKEND_SCIPY
+
+    def fft(self, x, axis=-1, overwrite_x=False):
+        return scipy.fft.fft(x, axis=axis, overwrite_x=overwrite_x, workers=self.workers)
+
+    def fft2(self, x, overwrite_x=False):
+        return scipy.fft.fft2(x, overwrite_x=overwrite_x, workers=self.workers)
+
+
+class NumpyBackend(FFTBackend):
+    name = BACKEND_NUMPY
+
+    def __init__(self, workers=1):
+        # Single threaded only
+        super().__init__(1)
+
+    def fft(self, x, axis=-1, overwrite_x=False):
+        return np.fft.fft(x, axis=axis)
+
+    def fft2(self, x, overwrite_x=False):
+        return np.fft.fft2(x)
+
+
+class FFTWBackend(FFTBackend):
+    """
+    pyfftw with its plan cache enabled, so each (shape, dtype) is planned once per process. Wisdom is loaded
+    from and saved to config.FFTW_WISDOM_PATH so plans also persist across runs.
+    """
+    name = BACKEND_FFTW
+
+    def __init__(self, workers=1):
+        if pyfftw is None:
+            raise ValueError("FFT backend '{}' needs pyfftw installed".format(BACKEND_FFTW))
+        super().__init__(workers)
+        pyfftw.interfaces.cache.enable()
+        pyfftw.interfaces.cache.set_keepalive_time(300)
+        self.planned = set()
+        load_wisdom()
+
+    def _note_plan(self, x, axes):
+        key = (x.shape, x.dtype.name, axes)
+        if key not in self.planned:
+            # First transform of this shape has just been planned, keep the wisdom
+            self.planned.add(key)
+            save_wisdom()
+
+    def fft(self, x, axis=-1, overwrite_x=False):
+        out = pyfftw.interfaces.scipy_fft.fft(x, axis=axis, overwrite_x=overwrite_x, workers=self.workers,
+                                              planner_effort=config.FFTW_PLANNER_EFFORT)
+        self._note_plan(x, (axis,))
+        return out
+
+    def fft2(self, x, overwrite_x=False):
+        out = pyfftw.interfaces.scipy_fft.fft2(x, overwrite_x=overwrite_x, workers=self.workers,
+                                               planner_effort=config.FFTW_PLANNER_EFFORT)
+        self._note_plan(x, (-2, -1))
+        return out
+
+    def dct(self, x, axis=-1, overwrite_x=False):
+        out = pyfftw.interfaces.scipy_fft.dct(x, axis=axis, overwrite_x=overwrite_x, workers=self.workers,
+                                              planner_effort=config.FFTW_PLANNER_EFFORT)
+        self._note_plan(x, ("dct", axis))
+        return out
+
+
+_backend_classes = {BACKEND_FFTPACK: FftpackBackend,
+                    BACKEND_SCIPY: ScipyBackend,
+                    BACKEND_NUMPY: NumpyBackend,
+                    BACKEND_FFTW: FFTWBackend}
+
+
+def load_wisdom(path=None):
+    if path is None:
+        path = config.FFTW_WISDOM_PATH
+    if pyfftw is None or path is None or not os.path.exists(path):
+        return
+    try:
+        with open(path, "rb") as file:
+            pyfftw.import_wisdom(tuple(file.read().split(b"\0\0")))
+    except (OSError, ValueError):
+        pass
+
+
+def save_wisdom(path=None):
+    if path is None:
+        path = config.FFTW_WISDOM_PATH
+    if pyfftw is None or path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmppath, "wb") as file:
+            file.write(b"\0\0".join(pyfftw.export_wisdom()))
+        os.replace(tmppath, path)
+    except OSError:
+        pass
+
+
+def get_fft_workers(s):
+    """
+    Get FFT thread count for these settings, only multithreading large transforms.
+
+    :param s: TestSettings with processing details
+    :return: number of workers
+    """
+    if s.fftsize is not None and s.fftsize >= config.FFT_MULTITHREAD_MIN_SIZE:
+        return s.fft_workers
+    return 1
+
+
+def get_backend(name, workers=1):
+    """
+    Get (shared) FFT backend by name.
+
+    :param name: One of BACKENDS
+    :param workers: Number of threads per transform (where supported)
+    :return: FFTBackend instance
+    """
+    if name not in _backend_classes:
+        raise ValueError("Unknown FFT backend '{}', options are {}".format(name, BACKENDS))
+    key = name, workers
+    try:
+        return _backends[key]
+    except KeyError:
+        backend = _backend_classes[name](workers)
+        _backends[key] = backend
+        return backend
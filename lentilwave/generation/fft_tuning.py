@@ -0,0 +1,167 @@
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+from lentil import constants_utils as lentilconf
+
+from lentilwave import config
+from lentilwave.generation import fft_backends
+
+# Timing tables already loaded in this process, keyed by path
+_tables = {}
+
+
+def get_table_path():
+    if config.FFT_TUNING_DIR is None:
+        return None
+    return os.path.join(config.FFT_TUNING_DIR, "fft_sizes_{}.json".format(platform.node() or "host"))
+
+
+def get_table_key(backend, workers, precision):
+    return "{}:{}:{}".format(backend, workers, precision)
+
+
+def time_fftsize(fftsize, backend, precision=64, min_time=None, min_repeats=3):
+    """
+    Time the CPU propagation pipeline for one FFT size, as generate() runs it: an in place 2D FFT, |.|^2 and
+    projection to two LSFs.
+
+    :param fftsize: FFT size
+    :param backend: FFTBackend
+    :param precision: 32 or 64
+    :param min_time: Keep repeating until this many seconds have been timed (defaults to config.FFT_TUNING_MIN_TIME)
+    :param min_repeats: and at least this many transforms
+    :return: fastest time in seconds
+    """
+    if min_time is None:
+        min_time = config.FFT_TUNING_MIN_TIME
+    realdtype, complexdtype = ("float32", "complex64") if precision == 32 else ("float64", "complex128")
+    rng = np.random.default_rng(0)
+    pupil = (rng.random((fftsize, fftsize)) + 1j * rng.random((fftsize, fftsize))).astype(complexdtype)
+    buffer = np.empty_like(pupil)
+    power = np.empty((fftsize, fftsize), dtype=realdtype)
+
+    times = []
+    start = time.time()
+    while len(times) < min_repeats or time.time() - start < min_time:
+        buffer[:] = pupil
+        t = time.time()
+        fftarr = backend.fft2(buffer, overwrite_x=True)
+        np.absolute(fftarr, out=power)
+        power **= 2
+        power.sum(axis=-1)
+        power.sum(axis=-2)
+        times.append(time.time() - t)
+    return min(times)
+
+
+def tune(sizes=None, backend=None, workers=None, precision=None, quiet=False):
+    """
+    Time each candidate FFT size with a CPU FFT backend.
+
+    Thread count follows fft_backends.get_fft_workers(), so only sizes from config.FFT_MULTITHREAD_MIN_SIZE are
+    timed multithreaded.
+
+    :param sizes: Candidate sizes (defaults to CPU_GOOD_FFT_SIZES)
+    :param backend: Backend name (defaults to config.FFT_BACKEND)
+    :param workers: FFT threads (defaults to config.FFT_WORKERS)
+    :param precision: 32 or 64 (defaults to config.PRECISION)
+    :return: dict of fftsize: seconds
+    """
+    if sizes is None:
+        sizes = lentilconf.CPU_GOOD_FFT_SIZES
+    if backend is None:
+        backend = config.FFT_BACKEND
+    if workers is None:
+        workers = config.FFT_WORKERS
+    if precision is None:
+        precision = config.PRECISION
+    timings = {}
+    for fftsize in sizes:
+        fftsize = int(fftsize)
+        size_workers = workers if fftsize >= config.FFT_MULTITHREAD_MIN_SIZE else 1
+        timings[fftsize] = time_fftsize(fftsize, fft_backends.get_backend(backend, size_workers), precision)
+        if not quiet:
+            print("FFT size {:>5}: {:.3f} ms".format(fftsize, timings[fftsize] * 1e3))
+    return timings
+
+
+def load_table(path=None):
+    """
+    Load this host's timing tables.
+
+    :return: dict of table key: {fftsize: seconds}
+    """
+    if path is None:
+        path = get_table_path()
+    if path is None:
+        return {}
+    try:
+        return _tables[path]
+    except KeyError:
+        pass
+    try:
+        with open(path) as file:
+            table = {key: {int(size): seconds for size, seconds in timings.items()}
+                     for key, timings in json.load(file).items()}
+    except (OSError, ValueError):
+        table = {}
+    _tables[path] = table
+    return table
+
+
+def save_table(table, path=None):
+    if path is None:
+        path = get_table_path()
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmppath = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmppath, "w") as file:
+        json.dump(table, file, indent=1)
+    os.replace(tmppath, path)
+    _tables[path] = table
+
+
+def get_timings(backend, workers, precision, tune_missing=False, path=None):
+    """
+    Get this host's FFT size timings for a backend, workers and precision.
+
+    :param tune_missing: Run tune() and save the results if there are no timings yet (do this in one process
+                         before starting workers, they'll then all load the same table)
+    :return: dict of fftsize: seconds, or None if not tuned
+    """
+    if path is None and get_table_path() is None:
+        # Workers load the table from disk, so timings can't just be kept in memory
+        raise ValueError("FFT autotuning needs a table path, and config.FFT_TUNING_DIR is None")
+    key = get_table_key(backend, workers, precision)
+    table = load_table(path)
+    if key not in table and tune_missing:
+        print("Tuning FFT sizes for {}".format(key))
+        table = dict(table)
+        table[key] = tune(backend=backend, workers=workers, precision=precision, quiet=True)
+        save_table(table, path)
+    return table.get(key)
+
+
+def choose_fftsize(min_fftsize, sizes, timings=None):
+    """
+    Choose an FFT size of at least min_fftsize.
+
+    :param sizes: Candidate sizes, ascending
+    :param timings: dict of fftsize: seconds from get_timings(), if given the smallest timed candidate within
+                    config.FFT_TUNING_TOLERANCE of the fastest is chosen
+    :return: fftsize (the largest size if none are big enough)
+    """
+    candidates = [int(size) for size in sizes if size >= min_fftsize]
+    if not candidates:
+        return int(sizes[-1])
+    if timings:
+        timed = [size for size in candidates if size in timings]
+        if timed:
+            fastest = min(timings[size] for size in timed)
+            return min(size for size in timed if timings[size] <= fastest * (1 + config.FFT_TUNING_TOLERANCE))
+    return candidates[0]
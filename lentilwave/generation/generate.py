@@ -1,4 +1,7 @@
+import copy
+import sys
 import time
+from collections import OrderedDict
 
 import numpy as np
 import prysm
@@ -6,15 +9,22 @@ try:
     import cupy as cp
     import cupyx.scipy.ndimage
     import cupyx.scipy.fftpack
+    import cupyx.scipy.fft
 except ImportError:
     cp = None
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 from scipy import interpolate, ndimage, fftpack
 import matplotlib.pyplot as plt
 
 from lentil import constants_utils as lentilconf
-from lentilwave import config, helpers
-from lentilwave.generation import masks, caches
+from lentilwave import config, helpers, profiling
+from lentilwave.generation import masks, caches, propagation, otfs, shared, zernikes, fft_backends, workspace, \
+    packing, hankel
 
 
 def sanitycheck(s):
@@ -25,66 +35,250 @@ def sanitycheck(s):
 defaultcaches = {'np': caches.GeneratorCache(),
                  'cp': caches.GeneratorCache()}
 
+TIMING_KEYS = ('t_init',
+               't_maskmaking',
+               't_pupils',
+               't_get_phases',
+               't_get_fcns',
+               't_pads',
+               't_ffts',
+               't_cudasyncs',
+               't_affines',
+               't_mtfs',
+               't_misc')
 
-def get_phase_cache_cube(s: helpers.TestSettings, me=np, realdtype="float64"):
-    zarr = s.zernike_flags.copy()
-    zarr[3] = 1
-    zarr[8] = 1
 
-    prysm.FringeZernike(zarr*0.1,
-                        dia=10, norm=False,
-                        opd_unit="um",
-                        mask_target='none',
-                        samples=s.phasesamples, )  # This is just here to fill the coeff cache
+MEMORY_KEYS = ('m_peak_rss_mb', 'm_cache_mb', 'm_gpu_pool_mb')
 
-    # Assign empty array ready to populate
-    arr = me.empty((s.phasesamples, s.phasesamples, s.zernike_flags.sum()), dtype=realdtype)
 
-    # Now pack the phases into a 3d array
-    for z in s.used_zernikes:
-        idx = s.zernike_index[z - 1]  # Zero based
-        singlez = prysm.zernike.zcache.regular[s.phasesamples][z - 1]
-        arr[:, :, idx] = me.array(singlez, dtype=realdtype)
-    return arr
+def get_memory_usage(used_caches=(), me=np):
+    """
+    Get memory use of this (worker) process, for reporting alongside timings.
 
+    These are levels not times, so aren't split between slices (retrieval keeps the maximum).
 
-def generate(s: helpers.TestSettings, cache_=defaultcaches):
-    t = time.time()
-    # return None
+    :param used_caches: GeneratorCaches to total
+    :param me: Array engine (numpy or cupy)
+    :return: dict keyed as MEMORY_KEYS (MB)
+    """
+    if resource is None:
+        peak = 0
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kB on Linux, bytes on macOS
+        peak = peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+    gpu_pool = cp.get_default_memory_pool().total_bytes() / 2 ** 20 if me is cp else 0
+    return dict(m_peak_rss_mb=peak,
+                m_cache_mb=sum(cache.nbytes() for cache in used_caches) / 2 ** 20,
+                m_gpu_pool_mb=gpu_pool)
+
+
+def get_phase_cache_cube(s: helpers.TestSettings, me=np, realdtype="float64"):
+    basis = zernikes.get_basis(s.phasesamples, config.ZERNIKE_SCHEME, realdtype)
+
+    # Pack the phases in use into a 3d array (Z4 and Z9 are always used, indices follow s.zernike_index)
+    used = np.array(s.used_zernikes) - 1  # Zero based
+    return me.array(np.ascontiguousarray(np.moveaxis(basis[used], 0, -1)), dtype=realdtype)
+
+
+def get_defocus_lookup(z4_phase, me=np):
+    """
+    Get the distinct values of the (radial) Z4 phase and where each pupil sample finds its value.
+
+    A defocus phasor then only needs evaluating once per distinct radius, not once per sample.
+
+    :param z4_phase: 2D Z4 phase
+    :param me: Array engine (numpy or cupy)
+    :return: (unique values, 2D index array into them)
+    """
+    unique, inverse = me.unique(z4_phase, return_inverse=True)
+    return unique, inverse.reshape(z4_phase.shape).astype("int32")
+
+
+def get_base_wavefunction(basephase, z9_phase, z9, wavelength, mask, me=np, complexdtype="complex128"):
+    """
+    Get masked wavefunction with everything except defocus (which is applied later as a phasor).
+
+    :param basephase: 2D phase without Z4 and Z9
+    :param z9_phase: 2D Z9 phase
+    :param z9: Z9 coefficient at this wavelength
+    :param wavelength: Wavelength
+    :param mask: 2D pupil mask
+    :param me: Array engine (numpy or cupy)
+    :param complexdtype: dtype of wavefunction
+    :return: 2D complex wavefunction
+    """
+    phase = basephase + z9_phase * z9
+    phase *= 2 * me.pi / wavelength
+    wavefunction = me.empty(phase.shape, dtype=complexdtype)
+    me.cos(phase, out=wavefunction.real)
+    me.sin(phase, out=wavefunction.imag)
+    wavefunction *= mask
+    return wavefunction
+
+
+def get_psf_sample_spacing(s: helpers.TestSettings, min_wvl):
+    """
+    Get PSF sample spacing (um) at the shortest wavelength, which all wavelengths are resampled to.
+    """
+    # Get a blank pupil to get unit data from
+    pupil = prysm.FringeZernike(dia=10, wavelength=min_wvl, norm=False,
+                                opd_unit="um",
+                                mask_target='none',
+                                samples=s.phasesamples, )
+
+    return prysm.propagation.pupil_sample_to_psf_sample(pupil_sample=pupil.sample_spacing,
+                                                        samples=s.fftsize,
+                                                        wavelength=min_wvl,
+                                                        efl=s.p['base_fstop'] * 10) * 1e-3
+
+
+def get_stack_batches(s: helpers.TestSettings, num_items, complexdtype="complex128", batched=None):
+    """
+    Split stack item indices (one item per slice and wavelength) into stacks which are propagated together.
+
+    Without batching every item gets its own stack of one, otherwise as many items as fit
+    in config.BATCH_MAX_BYTES (per stacked complex array) are grouped together.
+
+    :param s: TestSettings with processing details
+    :param num_items: Number of slice/wavelength pairs being evaluated
+    :param complexdtype: dtype of stacked wavefunction
+    :param batched: Override s.batch_wavelengths
+    :return: list of index arrays
+    """
+    if batched is None:
+        batched = s.batch_wavelengths
+    if batched:
+        stack_bytes = s.fftsize ** 2 * np.dtype(complexdtype).itemsize
+        per_batch = int(np.clip(config.BATCH_MAX_BYTES // stack_bytes, 1, num_items))
+    else:
+        per_batch = 1
+    indices = np.arange(num_items)
+    return [indices[start:start + per_batch] for start in range(0, num_items, per_batch)]
+
+
+def _dummy_result(s: helpers.TestSettings):
     tr = helpers.TestResults()
     tr.copy_important_settings(s)
+    tr.otf = np.zeros(len(s.spacial_freqs),dtype="complex128"), np.zeros(len(s.spacial_freqs),dtype="complex128")
+    tr.timings = dict.fromkeys(TIMING_KEYS + caches.COUNTER_KEYS, 0)
+    tr.timings['fft_backend'] = "{}:0".format(s.fft_backend)
+    tr.timings['engine'] = s.engine
+    tr.timings.update(dict.fromkeys(MEMORY_KEYS, 0))
+    return tr
+
+
+def _series_key(s: helpers.TestSettings):
+    # Slices with equal keys only differ by defocus so can share all other work
+    return (s.fftsize,
+            s.phasesamples,
+            s.mono,
+            s.allow_cuda,
+            s.x_loc,
+            s.y_loc,
+            tuple(sorted(s.p.items())),
+            s.pixel_vignetting,
+            s.lens_vignetting,
+            s.fix_pupil_rotation,
+            s.default_exit_pupil_position_mm,
+            s.return_otf,
+            s.return_otf_mtf,
+            s.return_psf,
+            s.return_prysm_mtf,
+            s.return_mask,
+            s.engine,
+            s.polychromatic_mode)
+
 
+def generate(s: helpers.TestSettings, cache_=defaultcaches):
     if s.dummy:
-        timings = dict(t_init=0,
-                       t_maskmaking=0,
-                       t_pupils=0,
-                       t_get_phases=0,
-                       t_get_fcns=0,
-                       t_fcntransforms=0,
-                       t_pads=0,
-                       t_ffts=0,
-                       t_cudasyncs=0,
-                       t_affines=0,
-                       t_mtfs=0,
-                       t_misc=0)
-
-        tr.otf = np.zeros(len(config.SPACIAL_FREQS),dtype="complex128"), np.zeros(len(config.SPACIAL_FREQS),dtype="complex128")
-        tr.timings = timings
-        return tr
+        return _dummy_result(s)
 
     sanitycheck(s)
 
     s.get_processing_details()
+
+    return _generate_slices([s], cache_=cache_, batched=s.batch_wavelengths)[0]
+
+
+def _copy_slice_settings(s, defocus):
+    # Shallow copy with its own parameters, so slices don't share (or change) the caller's
+    s = copy.copy(s)
+    s.p = dict(s.p)
+    s.defocus = defocus
+    return s
+
+
+def generate_series(settings, defocus_values=None, cache_=defaultcaches):
+    """
+    Generate a whole through-focus series in one call.
+
+    Work which doesn't depend on defocus (mask, base phase, Z9 terms, polychromatic weights,
+    tukey window) is done once, and slices sharing an fftsize are propagated as stacked arrays.
+
+    :param settings: TestSettings used as a template for every defocus value, or a sequence of
+                     TestSettings (one per slice)
+    :param defocus_values: Defocus for each slice (optional if a sequence of settings is passed, which are then
+                           copied rather than changed)
+    :param cache_: Generator caches
+    :return: list of TestResults, one per slice
+    """
+    if isinstance(settings, helpers.TestSettings):
+        if not settings.dummy:
+            sanitycheck(settings)
+            settings.get_processing_details()
+        slices = [_copy_slice_settings(settings, defocus) for defocus in defocus_values]
+    else:
+        slices = list(settings)
+        if defocus_values is not None:
+            slices = [_copy_slice_settings(s, defocus) for s, defocus in zip(slices, defocus_values)]
+
+    results = [None] * len(slices)
+    groups = OrderedDict()
+    for n, s in enumerate(slices):
+        if s.dummy:
+            results[n] = _dummy_result(s)
+            continue
+        sanitycheck(s)
+        s.get_processing_details()
+        groups.setdefault(_series_key(s), []).append(n)
+
+    for indices in groups.values():
+        group_results = _generate_slices([slices[n] for n in indices], cache_=cache_, batched=True)
+        for n, tr in zip(indices, group_results):
+            results[n] = tr
+    return results
+
+
+def _generate_slices(slices, cache_=defaultcaches, batched=False):
+    # All slices must share everything but defocus (see _series_key())
+    t = time.time()
+    s = slices[0]
+    num_slices = len(slices)
+    trs = []
+    for slice_s in slices:
+        tr = helpers.TestResults()
+        tr.copy_important_settings(slice_s)
+        trs.append(tr)
+
     use_cuda = s.allow_cuda and cp is not None
 
     if use_cuda:
+        fft = cupyx.scipy.fftpack.fft
         fft2 = cupyx.scipy.fftpack.fft2
+        dct = cupyx.scipy.fft.dct
+        fft_backend_name, fft_workers = "cupy", 1
         affine_transform = cupyx.scipy.ndimage.affine_transform
     else:
-        fft2 = fftpack.fft2
+        backend = fft_backends.get_backend(s.fft_backend, fft_backends.get_fft_workers(s))
+        fft = backend.fft
+        fft2 = backend.fft2
+        dct = backend.dct
+        fft_backend_name, fft_workers = backend.name, backend.workers
         affine_transform = ndimage.affine_transform
 
-    tr.used_cuda = use_cuda
+    for tr in trs:
+        tr.used_cuda = use_cuda
 
     # Normalise PSF/LSF after scaling, rather than before
     SAM_RADIOMETRIC_MODEL = True
@@ -93,27 +287,37 @@ def generate(s: helpers.TestSettings, cache_=defaultcaches):
 
     def sync():
         # Option to sync cuda device after each stage for profiling
-        pass
+        if use_cuda and config.PROFILE_SYNC_CUDA:
+            cp.cuda.Device().synchronize()
 
-    realdtype = "float32" if config.PRECISION == 32 else "float64"
-    complexdtype = "complex64" if config.PRECISION == 32 else "complex128"
+    realdtype = s.realdtype
+    complexdtype = s.complexdtype
 
     me, engine_string = (cp, 'cp') if use_cuda else (np, 'np')
 
     # We only care about cached items on appropriate device
     engcache = cache_[engine_string]
+    used_caches = [engcache] if engine_string == 'np' else [engcache, cache_['np']]
+    counters_before = [cache.counters() for cache in used_caches]
 
-    eval_wavelengths = [config.BASE_WAVELENGTH] if s.mono else config.MODEL_WVLS
+    eval_wavelengths = np.array([config.BASE_WAVELENGTH] if s.mono else s.wavelengths)
+    num_wvls = len(eval_wavelengths)
 
     build_psf = s.return_psf or FORCE_PSF or s.return_prysm_mtf
 
+    if s.polychromatic_mode not in otfs.POLYCHROMATIC_MODES:
+        raise ValueError("Unknown polychromatic mode '{}', options are {}".format(s.polychromatic_mode,
+                                                                               otfs.POLYCHROMATIC_MODES))
+    # Combining wavelengths as OTFs needs no resampling, but we can't then build a 2D PSF
+    frequency_mode = s.polychromatic_mode == otfs.POLYCHROMATIC_FREQUENCY and not build_psf
+
     if build_psf:
-        # Get zero array for building full polychromatic 2d PSF
-        psf_stack_sum = me.zeros(s.fftshape, dtype="float64")
+        # Get zero array for building full polychromatic 2d PSF (one per slice)
+        psf_stack_sum = me.zeros((num_slices,) + s.fftshape, dtype=realdtype)
 
-    # Get 2 1D LSFs
-    lsf_sag = np.zeros((s.fftsize, ), dtype="float64")
-    lsf_tan = np.zeros((s.fftsize, ), dtype="float64")
+    # Get 2 1D LSFs per slice
+    lsf_sag = np.zeros((num_slices, s.fftsize), dtype=realdtype)
+    lsf_tan = np.zeros((num_slices, s.fftsize), dtype=realdtype)
 
     polychromatic_weights = np.array([float(lentilconf.photopic_fn(wv * 1e3) *
                                             lentilconf.d50_interpolator(wv)) for wv in eval_wavelengths])
@@ -124,214 +328,437 @@ def generate(s: helpers.TestSettings, cache_=defaultcaches):
     yellip = np.clip(1.0 - ellip, 0.5, 1.0)
 
     # Timing accumulators
-    t_misc = 0
-    t_pupils = 0
-    t_get_phases = 0
-    t_get_fcns = 0
-    t_fcntransforms = 0
-    t_pads = 0
-    t_ffts = 0
-    t_cudasyncs = 0
-    t_affines = 0
-    t_mtfs = 0
-    t_init = time.time() - t
+    timer = profiling.StageTimer(TIMING_KEYS, me=me, sync=sync)
+    timer.stage("t_init", t)
 
     t = time.time()
-    mask = masks.build_mask(s, engine=me, dtype=realdtype)
+    mask = masks.build_mask(s, engine=me, dtype=realdtype, cache=engcache.masks)
     if s.return_mask:
-        tr.mask = mask
-    t_maskmaking = time.time() - t
+        for tr in trs:
+            tr.mask = mask
+    maskkey = masks.get_mask_key(s, me, realdtype)
+    if s.packed_pupil:
+        # Pupil domain arrays only hold in-pupil samples, keys below need the mask they were packed with
+        try:
+            pupilpack = engcache.packings[maskkey]
+        except KeyError:
+            pupilpack = packing.PupilPacking(mask, me=me)
+            engcache.packings[maskkey] = pupilpack
+        pupil_mask = pupilpack.mask
+        packkey = maskkey
+    else:
+        pupilpack = None
+        pupil_mask = mask
+        packkey = None
+    timer.stage("t_maskmaking", t)
 
     # Analysis p dictionary to get Z usage
     s.get_used_zernikes()
     zusedhash = hash(s.used_zernikes)
-    zhash = hash(tuple(s.zernike_array))
 
-    for wvl_num, (model_wvl, polych_weight) in enumerate(zip(eval_wavelengths, polychromatic_weights)):
-        t = time.time()
-        rel_wv = model_wvl / config.BASE_WAVELENGTH
+    # Zero out any Z4 and Z9 otherwise wouldn't be a base
+    indexed_no_z4_no_z9 = s.zernike_array_indexed.copy()
+    indexed_no_z4_no_z9[s.zernike_index[4 - 1]] = 0
+    indexed_no_z4_no_z9[s.zernike_index[9 - 1]] = 0
+    zhash = hash(tuple(indexed_no_z4_no_z9))
 
-        z4 = helpers.get_z4(s.defocus, s.p, model_wvl)
-        z9 = helpers.get_z9(s.p, model_wvl)
-        t_misc += time.time() - t
+    t = time.time()
+    cubekey = (s.phasesamples, zusedhash, realdtype, engine_string)
+    try:
+        cube = engcache.cubes[cubekey]
+    except KeyError:
+        # New phase size or Zernike set so we need a cube, preferably one already built by our parent process
+        cube = shared.attach_cube(s, realdtype=realdtype)
+        if cube is None:
+            # Get a 3d array (one 2d phase for each coefficient in use)
+            cube = get_phase_cache_cube(s, me=me, realdtype=realdtype)
+        elif me is cp:
+            cube = me.array(cube)
+        engcache.cubes[cubekey] = cube
+
+    if pupilpack is not None:
+        cubekey = cubekey + (packkey,)
+        try:
+            cube = engcache.cubes[cubekey]
+        except KeyError:
+            cube = pupilpack.pack(cube)
+            engcache.cubes[cubekey] = cube
+
+    # Do we already have a base phase without Z4 and Z9
+    basekey = (s.phasesamples, zusedhash, zhash, realdtype, engine_string, packkey)
+    try:
+        basephase = engcache.basephases[basekey]
+    except KeyError:
+        # We need to build one (keeping to cube precision)
+        indexed_no_z4_no_z9 = me.array(indexed_no_z4_no_z9, dtype=realdtype)
 
-        if s.phasesamples not in engcache.cubes or engcache.cubes[s.phasesamples][0] != zusedhash:
-            # New phase size so we need to call prysm and build some phases
-            t = time.time()
+        # Run dot product
+        basephase = cube @ indexed_no_z4_no_z9
+        engcache.basephases[basekey] = basephase
 
-            # Get a 3d array (one 2d phase for each coefficient in use)
-            cube = get_phase_cache_cube(s, me=me)
+    # (These are packed pupils if pupilpack is in use, which broadcast below as 2D pupils do)
+    z4_phase = cube[:, :, s.zernike_index[4 - 1]]
+    z9_phase = cube[:, :, s.zernike_index[9 - 1]]
+    timer.stage("t_get_phases", t)
 
-            # Cache it
-            engcache.cubes[s.phasesamples] = (zusedhash, cube)
+    t = time.time()
+    min_wvl = min(eval_wavelengths)
+    psf_sample_spacing = get_psf_sample_spacing(s, min_wvl)
+    psf_units = np.arange(-s.fftsize / 2, s.fftsize / 2) * psf_sample_spacing
+    timer.stage("t_pupils", t)
 
-            sync()
-            t_get_phases += time.time() - t
-        else:
-            assert engcache.cubes[s.phasesamples][0] == zusedhash
-            # We have a valid cached cube
-            _, cube = engcache.cubes[s.phasesamples]
+    t = time.time()
+    # Defocus independent per-wavelength terms
+    z9s_by_wvl = np.array([helpers.get_z9(s.p, model_wvl) for model_wvl in eval_wavelengths])
 
-        # Get a blank pupil to get unit data from
-        t = time.time()
-        pupil = prysm.FringeZernike(dia=10, wavelength=model_wvl, norm=False,
-                                    opd_unit="um",
-                                    mask_target='none',
-                                    samples=s.phasesamples, )
-        t_pupils += time.time() - t
+    mtf_mapper_fft_halfwindowsize_um = 16 * lentilconf.DEFAULT_PIXEL_SIZE * 1e6
+    get_x_freqs = np.asarray(s.spacial_freqs) / lentilconf.DEFAULT_PIXEL_SIZE * 1e-3
+
+    # Clipping to ensure a nice continuous function (avoid NOP at zoom == 1.0)
+    zoom_factors_by_wvl = np.clip(eval_wavelengths / min_wvl, 1.001, np.inf)
+    shifts_x_by_wvl, shifts_y_by_wvl = np.array([helpers.get_lca_shifts(s, model_wvl, psf_sample_spacing)
+                                                 for model_wvl in eval_wavelengths]).T
+
+    support = propagation.get_support(s, mask, me=me)
+    mft_halfwidth = propagation.get_mft_halfwidth(s, psf_sample_spacing, mtf_mapper_fft_halfwindowsize_um,
+                                                  max(np.abs(shifts_x_by_wvl).max(), np.abs(shifts_y_by_wvl).max()))
+    engine = propagation.get_engine(s, build_psf, mft_halfwidth, support)
+
+    if engine == propagation.ENGINE_MFT:
+        mftkey = (s.fftsize, s.phasesamples, mft_halfwidth,
+                  tuple((sl.start, sl.stop) for sl in support), complexdtype, engine_string)
+        try:
+            mft_matrices = engcache.mft_matrices[mftkey]
+        except KeyError:
+            mft_matrices = tuple(propagation.get_mft_matrix(s, mft_halfwidth, sl.start, sl.stop, me=me,
+                                                            complexdtype=complexdtype) for sl in support)
+            engcache.mft_matrices[mftkey] = mft_matrices
+
+    if s.radial_fast_path and not build_psf and s.fftsize >= s.phasesamples and hankel.is_symmetric(s):
+        # Rotationally symmetric pupils only need 1D (Hankel) transforms
+        radius = min(masks.get_mask_radius(s), 2 ** 0.5)
+        hankelkey = (s.phasesamples, s.fftsize, radius, realdtype, engine_string)
+        try:
+            hankel_transform = engcache.hankel_transforms[hankelkey]
+        except KeyError:
+            hankel_transform = hankel.HankelTransform(s.phasesamples, s.fftsize, radius, me=me, realdtype=realdtype)
+            engcache.hankel_transforms[hankelkey] = hankel_transform
+        radial_mask, radial_cube = hankel.get_radial_pupil(s, hankel_transform, me=me, realdtype=realdtype)
+        radial_base = radial_cube @ me.array(indexed_no_z4_no_z9, dtype=realdtype)
+        radial_z4 = radial_cube[:, s.zernike_index[4 - 1]]
+        radial_z9 = radial_cube[:, s.zernike_index[9 - 1]]
+        engine = propagation.ENGINE_HANKEL
+
+    pupil_rows = s.phasesamples
+    if (s.mirror_fast_path and engine in (propagation.ENGINE_FFT2, propagation.ENGINE_LSF) and not build_psf and
+            pupilpack is None and propagation.is_mirror_symmetric(s)):
+        # The upper half of the pupil is the lower half mirrored, so only the lower half is needed
+        engine = propagation.ENGINE_MIRROR
+        pupil_rows = s.phasesamples // 2
+        pupil_mask, basephase, z4_phase, z9_phase = (arr[-pupil_rows:] for arr in (mask, basephase, z4_phase,
+                                                                                  z9_phase))
+        cubekey += (engine,)
+        basekey += (engine,)
+
+    if config.CACHE_BASE_WAVEFUNCTIONS and engine != propagation.ENGINE_HANKEL:
+        # Only defocus changes between slices, so keep everything else as a wavefunction for each wavelength
+        try:
+            z4_unique, z4_lookup = engcache.defocus_lookups[cubekey]
+        except KeyError:
+            z4_unique, z4_lookup = get_defocus_lookup(z4_phase, me=me)
+            engcache.defocus_lookups[cubekey] = z4_unique, z4_lookup
+        base_wavefunctions = []
+        for model_wvl, z9 in zip(eval_wavelengths, z9s_by_wvl):
+            basewfkey = (basekey, maskkey, float(model_wvl), float(z9), complexdtype)
+            try:
+                base_wavefunction = engcache.base_wavefunctions[basewfkey]
+            except KeyError:
+                base_wavefunction = get_base_wavefunction(basephase, z9_phase, z9, model_wvl, pupil_mask, me=me,
+                                                          complexdtype=complexdtype)
+                engcache.base_wavefunctions[basewfkey] = base_wavefunction
+            base_wavefunctions.append(base_wavefunction)
+    else:
+        base_wavefunctions = None
+
+    if frequency_mode:
+        otf_bins = otfs.get_otf_bins(s.fftsize, psf_sample_spacing, get_x_freqs)
+        centred_coords = np.arange(s.fftsize) - s.fftsize // 2
+        factors_by_wvl, samplers_by_wvl, windows_by_wvl = [], [], []
+        for ellip_factor, shifts in ((xellip, shifts_x_by_wvl), (yellip, shifts_y_by_wvl)):
+            factors = zoom_factors_by_wvl / ellip_factor
+            factors_by_wvl.append(factors)
+            samplers_by_wvl.append(otfs.get_scaled_otf_samplers(s.fftsize, otf_bins, factors))
+            # Tukey window mapped back from the zoomed grid onto each wavelength's own grid
+            zoomed_units = (centred_coords[None, :] * factors[:, None] + shifts[:, None]) * psf_sample_spacing
+            windows_by_wvl.append(lentilconf.tukey(zoomed_units / mtf_mapper_fft_halfwindowsize_um, 0.6))
+
+        # Accumulate spectra, sums and first moments (for centroid) for sag and tan
+        poly_spectra = np.zeros((2, num_slices, len(otf_bins)), dtype="complex128")
+        poly_sums = np.zeros((2, num_slices))
+        poly_moments = np.zeros((2, num_slices))
+
+    # One stack item for each slice and wavelength pair
+    item_slices = np.repeat(np.arange(num_slices), num_wvls)
+    item_wvls = np.tile(np.arange(num_wvls), num_slices)
+    timer.stage("t_misc", t)
+
+    batches = get_stack_batches(s, len(item_slices), complexdtype, batched=batched)
+    if config.USE_WORKSPACES and engine != propagation.ENGINE_HANKEL:
+        ws = workspace.get_workspace(engcache.workspaces, s.fftsize, s.phasesamples, max(len(b) for b in batches),
+                                     realdtype, complexdtype, me=me, engine_string=engine_string)
+    else:
+        ws = None
 
+    for batch in batches:
         t = time.time()
-        basephase = None
-
-        # Do we already have a base phase without Z4 and Z9
-        if s.phasesamples in engcache.basephases:
-            cached_base = engcache.basephases[s.phasesamples]
-            if cached_base[0] == zhash:
-                # Already done
-                basephase = cached_base[1]
-
-        if basephase is None:
-            # We need to build one
-            _, cube = engcache.cubes[s.phasesamples]  # This should already be populated from earlier
-
-            # Zero out any Z4 and Z9 otherwise wouldn't be a base
-            indexed_no_z4_no_z9 = s.zernike_array_indexed.copy()
-            indexed_no_z4_no_z9[s.zernike_index[4 - 1]] = 0
-            indexed_no_z4_no_z9[s.zernike_index[9 - 1]] = 0
-            if me is cp:
-                indexed_no_z4_no_z9 = me.array(indexed_no_z4_no_z9)
-
-            # Run dot product
-            basephase = cube @ indexed_no_z4_no_z9
-
-            # Cache it
-            cached_base = zhash, basephase
-            engcache.basephases[s.phasesamples] = cached_base
-
-        # Now we have basephase add Z4 and Z9 to taste
-        phase = basephase.copy()
-        z4_phase = cube[:, :, s.zernike_index[4 - 1]]
-        phase += z4_phase * z4
-        z9_phase = cube[:, :, s.zernike_index[9 - 1]]
-        phase += z9_phase * z9
-
-        phase /= model_wvl
-        sync()
-        t_get_phases += time.time() - t
-
+        num_items = len(batch)
+        batch_slices = item_slices[batch]
+        batch_wvl_nums = item_wvls[batch]
+        batch_wvls = eval_wavelengths[batch_wvl_nums]
+        batch_weights = polychromatic_weights[batch_wvl_nums]
+
+        z4s = np.array([helpers.get_z4(slices[slice_num].defocus, s.p, model_wvl)
+                        for slice_num, model_wvl in zip(batch_slices, batch_wvls)])
+        z9s = z9s_by_wvl[batch_wvl_nums]
+
+        zoom_factors = zoom_factors_by_wvl[batch_wvl_nums]
+        shifts_x = shifts_x_by_wvl[batch_wvl_nums]
+        shifts_y = shifts_y_by_wvl[batch_wvl_nums]
+        timer.stage("t_misc", t)
+
+        # Now we have basephase add Z4 and Z9 to taste (one phase per item in stack)
         t = time.time()
-        # Get complex wavefunction
-        wavefunction = me.exp(1j * 2 * me.pi * phase)
-        # Apply mask
-        wavefunction *= mask
-        sync()
-        t_get_fcns += time.time() - t
-
-        if model_wvl == min(eval_wavelengths):
-            # This is our shortest wavelength, samples spacing will be normalised to this
-            psf_sample_spacing = prysm.propagation.pupil_sample_to_psf_sample(pupil_sample=pupil.sample_spacing,
-                                                          samples=s.fftsize,
-                                                          wavelength=model_wvl,
-                                                          efl=s.p['base_fstop'] * 10) * 1e-3
-            psf_units = np.arange(-s.fftsize / 2, s.fftsize / 2) * psf_sample_spacing
-
-        # Process wavefunction
-        resized_wavefunction = pad_and_distort(s, wavefunction, affine_transform=affine_transform, me=me, complexdtype=complexdtype)
+        z4s, z9s, stack_wvls = (me.array(arr, dtype=realdtype) for arr in (z4s, z9s, batch_wvls))
+        if engine == propagation.ENGINE_HANKEL:
+            # Radial phase only (in radians)
+            phase = radial_base[None, :] + radial_z4[None, :] * z4s[:, None]
+            phase += radial_z9[None, :] * z9s[:, None]
+            phase *= (2 * me.pi / stack_wvls)[:, None]
+        elif base_wavefunctions is not None:
+            # Phase isn't needed, just the defocus phasor at each distinct radius
+            phasors = me.exp(1j * (2 * me.pi * z4s / stack_wvls)[:, None] * z4_unique[None, :])
+        elif ws is not None:
+            # Same again but in place (phase is in radians here)
+            if pupilpack is not None:
+                phase = ws.packed(ws.phase, num_items, pupilpack.npix)
+                scratch = ws.packed(ws.scratch, num_items, pupilpack.npix)
+            else:
+                phase = ws.phase[:num_items, :pupil_rows]
+                scratch = ws.scratch[:num_items, :pupil_rows]
+            me.multiply(z4_phase[None, :, :], z4s[:, None, None], out=phase)
+            phase += basephase[None, :, :]
+            me.multiply(z9_phase[None, :, :], z9s[:, None, None], out=scratch)
+            phase += scratch
+            phase *= (2 * me.pi / stack_wvls)[:, None, None]
+        else:
+            phase = basephase[None, :, :] + z4_phase[None, :, :] * z4s[:, None, None]
+            phase += z9_phase[None, :, :] * z9s[:, None, None]
+
+            phase /= stack_wvls[:, None, None]
+        timer.stage("t_get_phases", t)
 
         t = time.time()
-        # FFTs
-        fftarr = me.fft.fftshift(resized_wavefunction)
-        fftarr = fft2(fftarr, overwrite_x=True)
-        shifted = me.fft.ifftshift(fftarr)
-
-        # Get PSF for incoherent imaging
-        mono_psf = me.absolute(shifted)
-        mono_psf **= 2
-
-        if not SAM_RADIOMETRIC_MODEL:
-            mono_psf /= mono_psf.sum()
-
-        # Sum down to two 1D LSFs
-        impx = mono_psf.sum(axis=1)
-        impy = mono_psf.sum(axis=0)
-        sync()
-        t_ffts += time.time() - t
-
-        # Clipping to ensure a nice continuous function (avoid NOP at zoom == 1.0)
-        zoom_factor = float(np.clip(model_wvl / min(eval_wavelengths), 1.001, np.inf))
-        shift_x, shift_y = helpers.get_lca_shifts(s, model_wvl, psf_sample_spacing)
+        # Get complex wavefunctions
+        if ws is not None and pupilpack is not None:
+            wsfunction = ws.packed(ws.wavefunction, num_items, pupilpack.npix)
+        elif ws is not None:
+            wsfunction = ws.wavefunction[:num_items, :pupil_rows]
+        if engine == propagation.ENGINE_HANKEL:
+            wavefunction = me.exp(1j * phase)
+            wavefunction *= radial_mask
+        elif base_wavefunctions is not None:
+            if ws is not None:
+                wavefunction = wsfunction
+            else:
+                wavefunction = me.empty((num_items,) + basephase.shape, dtype=complexdtype)
+            for stack_num, wvl_num in enumerate(batch_wvl_nums):
+                me.take(phasors[stack_num], z4_lookup, out=wavefunction[stack_num])
+                wavefunction[stack_num] *= base_wavefunctions[wvl_num]
+        elif ws is not None:
+            wavefunction = wsfunction
+            me.cos(phase, out=wavefunction.real)
+            me.sin(phase, out=wavefunction.imag)
+        else:
+            wavefunction = me.exp(1j * 2 * me.pi * phase)
+        if base_wavefunctions is None and engine != propagation.ENGINE_HANKEL:
+            # Apply mask
+            wavefunction *= pupil_mask
+        if pupilpack is not None and engine != propagation.ENGINE_HANKEL and (engine != propagation.ENGINE_FFT2 or
+                                                                              ws is None):
+            # Back to a square pupil for engines which need one
+            wavefunction = pupilpack.unpack(wavefunction, dtype=complexdtype)
+        timer.stage("t_get_fcns", t)
+
+        if engine == propagation.ENGINE_HANKEL:
+            t = time.time()
+            # Sagittal and tangential LSFs are the same
+            impx = hankel_transform.lsfs(wavefunction)
+            impy = impx
+            timer.stage("t_ffts", t)
+        elif engine == propagation.ENGINE_MFT:
+            t = time.time()
+            # Only the LSF samples which reach the tukey window, straight from the unpadded wavefunction
+            impx, impy, energies = propagation.lsfs_from_mft(s, wavefunction, mft_matrices, support, me=me)
+            if not SAM_RADIOMETRIC_MODEL:
+                impx /= energies[:, None]
+                impy /= energies[:, None]
+            timer.stage("t_ffts", t)
+        elif engine == propagation.ENGINE_MIRROR:
+            t = time.time()
+            # Half the pupil rows and half length transforms along y
+            impx, impy = propagation.lsfs_from_mirrored_ffts(s, wavefunction, fft=fft, dct=dct, me=me,
+                                                             complexdtype=complexdtype)
+            timer.stage("t_ffts", t)
+        elif engine == propagation.ENGINE_LSF:
+            t = time.time()
+            # Only two 1D LSFs per item, straight from the unpadded wavefunction
+            impx, impy = propagation.lsfs_from_1d_ffts(s, wavefunction, fft=fft, me=me, complexdtype=complexdtype,
+                                                       support=support)
+            if not SAM_RADIOMETRIC_MODEL:
+                impx /= impx.sum(axis=-1, keepdims=True)
+                impy /= impy.sum(axis=-1, keepdims=True)
+            timer.stage("t_ffts", t)
+        elif ws is not None:
+            t = time.time()
+            # Pad and fftshift in one go straight into the FFT buffer
+            fftarr = ws.padded[:num_items]
+            if pupilpack is not None:
+                pupilpack.write_padded_shifted(fftarr, wavefunction, s.fftsize)
+            else:
+                workspace.write_padded_shifted(fftarr, wavefunction, s.fftsize, me=me)
+            timer.stage("t_pads", t)
+
+            t = time.time()
+            fftarr = fft2(fftarr, overwrite_x=True)
+
+            # Get (unshifted) PSF for incoherent imaging
+            power = ws.power[:num_items]
+            me.absolute(fftarr, out=power)
+            power **= 2
+
+            if not SAM_RADIOMETRIC_MODEL:
+                power /= power.sum(axis=(-2, -1), keepdims=True)
+
+            # Sum down to two 1D LSFs per item, then shift those rather than the PSF
+            impx = me.fft.ifftshift(power.sum(axis=-1), axes=-1)
+            impy = me.fft.ifftshift(power.sum(axis=-2), axes=-1)
+            if build_psf:
+                mono_psf = me.fft.ifftshift(power, axes=(-2, -1))
+            timer.stage("t_ffts", t)
+        else:
+            # Process wavefunction
+            t = time.time()
+            resized_wavefunction = pad_and_distort(s, wavefunction, affine_transform=affine_transform, me=me, complexdtype=complexdtype)
+            timer.stage("t_pads", t)
+
+            t = time.time()
+            # FFTs (over the last two axes only so the whole stack is transformed in one call)
+            fftarr = me.fft.fftshift(resized_wavefunction, axes=(-2, -1))
+            fftarr = fft2(fftarr, overwrite_x=True)
+            shifted = me.fft.ifftshift(fftarr, axes=(-2, -1))
+
+            # Get PSF for incoherent imaging
+            mono_psf = me.absolute(shifted)
+            mono_psf **= 2
+
+            if not SAM_RADIOMETRIC_MODEL:
+                mono_psf /= mono_psf.sum(axis=(-2, -1), keepdims=True)
+
+            # Sum down to two 1D LSFs per item
+            impx = mono_psf.sum(axis=-1)
+            impy = mono_psf.sum(axis=-2)
+            timer.stage("t_ffts", t)
+
         if build_psf:
             t = time.time()
 
-            # Resample PSF to fit minimum wavelength sample spacing
-            scaled_mono_psf = helpers.zoom2d(mono_psf,
-                                             zoom_factor / xellip, zoom_factor / yellip,
-                                             shift_x, shift_y,
-                                             affine_transform=affine_transform,
-                                             me=me)
+            for stack_num, (slice_num, polych_weight) in enumerate(zip(batch_slices, batch_weights)):
+                # Resample PSF to fit minimum wavelength sample spacing
+                scaled_mono_psf = helpers.zoom2d(mono_psf[stack_num],
+                                                 zoom_factors[stack_num] / xellip, zoom_factors[stack_num] / yellip,
+                                                 shifts_x[stack_num], shifts_y[stack_num],
+                                                 affine_transform=affine_transform,
+                                                 me=me)
 
-            if SAM_RADIOMETRIC_MODEL:
-                # Renormalise to ensure radiometry
-                scaled_mono_psf *= polych_weight / scaled_mono_psf.sum()
-            else:
-                scaled_mono_psf *= polych_weight
+                if SAM_RADIOMETRIC_MODEL:
+                    # Renormalise to ensure radiometry
+                    scaled_mono_psf *= polych_weight / scaled_mono_psf.sum()
+                else:
+                    scaled_mono_psf *= polych_weight
 
-            # Add to stack
-            psf_stack_sum += scaled_mono_psf
-            sync()
-            t_affines += time.time() - t
+                # Add to stack
+                psf_stack_sum[slice_num] += scaled_mono_psf
+            timer.stage("t_affines", t)
 
         t = time.time()
         if me is cp:
             # Bring back from GPU
             impx = cp.asnumpy(impx)
             impy = cp.asnumpy(impy)
-        sync()
-        t_cudasyncs += time.time() - t
+            if engine == propagation.ENGINE_MFT:
+                energies = cp.asnumpy(energies)
+        timer.stage("t_cudasyncs", t)
 
         t = time.time()
 
+        if frequency_mode:
+            for axis, (imp, shifts) in enumerate(((impx, shifts_x), (impy, shifts_y))):
+                factors = factors_by_wvl[axis][batch_wvl_nums]
+                if SAM_RADIOMETRIC_MODEL:
+                    # Cropped MFT LSFs still have all their energy accounted for
+                    lsf_sums = energies if engine == propagation.ENGINE_MFT else imp.sum(axis=1)
+                    coefficients = batch_weights / lsf_sums
+                else:
+                    coefficients = batch_weights * zoom_factors * factors
+                spectra, sums, moments = otfs.scaled_lsf_terms(imp,
+                                                               windows_by_wvl[axis][batch_wvl_nums],
+                                                               samplers_by_wvl[axis][batch_wvl_nums],
+                                                               otf_bins, factors, shifts, coefficients)
+                np.add.at(poly_spectra[axis], batch_slices, spectra)
+                np.add.at(poly_sums[axis], batch_slices, sums)
+                np.add.at(poly_moments[axis], batch_slices, moments)
+            timer.stage("t_affines", t)
+            continue
+
         # Resample LSFs to match minimum wavelength sample spacing
-        scaled_sag_lsf = helpers.zoom1d(impx, zoom_factor / xellip, shift_x)
-        scaled_tan_lsf = helpers.zoom1d(impy, zoom_factor / yellip, shift_y)
+        scaled_sag_lsf = helpers.zoom1d_stack(impx, zoom_factors / xellip, shifts_x)
+        scaled_tan_lsf = helpers.zoom1d_stack(impy, zoom_factors / yellip, shifts_y)
+
+        mul = 1.0 * zoom_factors[:, None]
 
-        mul = 1.0 * zoom_factor
+        if engine == propagation.ENGINE_MFT:
+            # LSFs are cropped so get their resampled sums from total energy (resampling sums scale with zoom)
+            sag_sums = (energies * zoom_factors / xellip)[:, None]
+            tan_sums = (energies * zoom_factors / yellip)[:, None]
+        else:
+            sag_sums = scaled_sag_lsf.sum(axis=1, keepdims=True)
+            tan_sums = scaled_tan_lsf.sum(axis=1, keepdims=True)
 
         if SAM_RADIOMETRIC_MODEL:
             # Normalise PSF intensity to ensure radiometry
-            lsf_sag += scaled_sag_lsf / scaled_sag_lsf.sum() * polych_weight
-            lsf_tan += scaled_tan_lsf / scaled_tan_lsf.sum() * polych_weight
+            np.add.at(lsf_sag, batch_slices, scaled_sag_lsf / sag_sums * batch_weights[:, None])
+            np.add.at(lsf_tan, batch_slices, scaled_tan_lsf / tan_sums * batch_weights[:, None])
         else:
-            lsf_sag += scaled_sag_lsf * polych_weight * mul
-            lsf_tan += scaled_tan_lsf * polych_weight * mul
-        sync()
-        t_affines += time.time() - t
+            np.add.at(lsf_sag, batch_slices, scaled_sag_lsf * batch_weights[:, None] * mul)
+            np.add.at(lsf_tan, batch_slices, scaled_tan_lsf * batch_weights[:, None] * mul)
+        timer.stage("t_affines", t)
+
+    # Keep longest wavelength shift for TCA blurring
+    shift_x = shifts_x_by_wvl[-1]
 
     t = time.time()
 
     if build_psf:
         # Replace LSFs with LSFs from PSF since we have it
-        lsf_sag = psf_stack_sum.sum(axis=1)
-        lsf_tan = psf_stack_sum.sum(axis=0)
+        lsf_sag = psf_stack_sum.sum(axis=2)
+        lsf_tan = psf_stack_sum.sum(axis=1)
         if me is cp:
             lsf_sag = cp.asnumpy(lsf_sag)
             lsf_tan = cp.asnumpy(lsf_tan)
 
     # Extra TCA blur
     if shift_x != 0 and 0:
-        lsf_tan = ndimage.gaussian_filter1d(lsf_tan, shift_x / 10, 0, mode="constant", cval=0.0)
-
-    if build_psf:
-        # Since we have full psf put data into prysm PSF object
-        npunits = cp.asnumpy(psf_units)
-        numpystack = cp.asnumpy(psf_stack_sum)
-        if shift_x != 0:
-            tca_blurred = ndimage.gaussian_filter1d(numpystack, shift_x / 10, 1, mode="constant", cval=0.0)
-        else:
-            tca_blurred = numpystack
-        prysm_psf = prysm.PSF(x=npunits, y=npunits, data=tca_blurred)
-        if s.return_psf:
-            tr.psf = prysm_psf
+        lsf_tan = ndimage.gaussian_filter1d(lsf_tan, shift_x / 10, 1, mode="constant", cval=0.0)
 
     centre = s.fftsize // 2
     # Get OTF x units from prysm
@@ -339,63 +766,107 @@ def generate(s: helpers.TestSettings, cache_=defaultcaches):
     sag_x = mtf_x_units[centre:]  # We don't need negative frequency data as LSF was real
     tan_x = mtf_x_units[centre:]
 
-    mtf_mapper_fft_halfwindowsize_um = 16 * lentilconf.DEFAULT_PIXEL_SIZE * 1e6
-
     # Get hashable to help caching
     tukeykey = (s.fftsize, psf_sample_spacing)
     try:
         tukey_window = cache_['np'].windows[tukeykey]
     except KeyError:
-        if len(cache_['np'].windows) > 300:
-            cache_['np'].windows = {}
         tukey_window = lentilconf.tukey(psf_units / mtf_mapper_fft_halfwindowsize_um, 0.6)
         cache_['np'].windows[tukeykey] = tukey_window
 
-    # Run FFT on LSFs to get MTF (with phase normalisation)
-    sag_mod = lentilconf.normalised_centreing_fft(lsf_sag * tukey_window, fftpack=fftpack, engine=np)[:centre]
-    tan_mod = lentilconf.normalised_centreing_fft(lsf_tan * tukey_window, fftpack=fftpack, engine=np)[:centre]
-
-    if s.return_prysm_mtf:
-        prysm_mtf = prysm.MTF.from_psf(prysm_psf)
-        tr.prysm_mtf = prysm_mtf
-
-    get_x_freqs = config.SPACIAL_FREQS / lentilconf.DEFAULT_PIXEL_SIZE * 1e-3
     interpolator = interpolate.InterpolatedUnivariateSpline
     order = 2
-    if s.return_otf and s.return_otf_mtf:
-        sagmtf = interpolator(sag_x, np.abs(sag_mod), k=order)(get_x_freqs)
-        tanmtf = interpolator(tan_x, np.abs(tan_mod), k=order)(get_x_freqs)
-        tr.otf = sagmtf, tanmtf
-
-    if s.return_otf and not s.return_otf_mtf:
-        sagmtf = interpolator(sag_x, np.real(sag_mod), k=order)(get_x_freqs)
-        tanmtf = interpolator(tan_x, np.real(tan_mod), k=order)(get_x_freqs)
-        sagmtf_i = interpolator(sag_x, np.imag(sag_mod), k=order)(get_x_freqs)
-        tanmtf_i = interpolator(tan_x, np.imag(tan_mod), k=order)(get_x_freqs)
-        tr.otf = sagmtf + 1j * sagmtf_i,\
-                 tanmtf + 1j * tanmtf_i
-    t_mtfs += time.time() - t
-
-    timings = dict(t_init=t_init,
-                   t_maskmaking=t_maskmaking,
-                   t_pupils=t_pupils,
-                   t_get_phases=t_get_phases,
-                   t_get_fcns=t_get_fcns,
-                   t_fcntransforms=t_fcntransforms,
-                   t_pads=t_pads,
-                   t_ffts=t_ffts,
-                   t_cudasyncs=t_cudasyncs,
-                   t_affines=t_affines,
-                   t_mtfs=t_mtfs,
-                   t_misc=t_misc)
-
-    tr.timings = timings
 
-    return tr
+    direct_otfs = frequency_mode or config.DIRECT_OTF_SAMPLING
+    if frequency_mode:
+        sag_otfs = otfs.combine_otfs(poly_spectra[0], poly_sums[0], poly_moments[0], otf_bins, s.fftsize)
+        tan_otfs = otfs.combine_otfs(poly_spectra[1], poly_sums[1], poly_moments[1], otf_bins, s.fftsize)
+    elif config.DIRECT_OTF_SAMPLING:
+        samplerkey = tukeykey + (tuple(get_x_freqs),)
+        try:
+            otf_sampler = cache_['np'].otf_samplers[samplerkey]
+        except KeyError:
+            otf_sampler = otfs.get_otf_sampler(s.fftsize, psf_sample_spacing, get_x_freqs)
+            cache_['np'].otf_samplers[samplerkey] = otf_sampler
+
+        # All slices and both axes in one matrix product
+        sampled = otfs.sample_otfs(np.concatenate((lsf_sag, lsf_tan)) * tukey_window, otf_sampler)
+        sag_otfs, tan_otfs = sampled[:num_slices], sampled[num_slices:]
+
+    for slice_num, (slice_s, tr) in enumerate(zip(slices, trs)):
+        if build_psf:
+            # Since we have full psf put data into prysm PSF object
+            npunits = psf_units
+            numpystack = cp.asnumpy(psf_stack_sum[slice_num]) if me is cp else psf_stack_sum[slice_num]
+            if shift_x != 0:
+                tca_blurred = ndimage.gaussian_filter1d(numpystack, shift_x / 10, 1, mode="constant", cval=0.0)
+            else:
+                tca_blurred = numpystack
+            prysm_psf = prysm.PSF(x=npunits, y=npunits, data=tca_blurred)
+            if slice_s.return_psf:
+                tr.psf = prysm_psf
+
+        if slice_s.return_prysm_mtf:
+            prysm_mtf = prysm.MTF.from_psf(prysm_psf)
+            tr.prysm_mtf = prysm_mtf
+
+        if not slice_s.return_otf:
+            continue
+
+        if direct_otfs:
+            if slice_s.return_otf_mtf:
+                tr.otf = np.abs(sag_otfs[slice_num]), np.abs(tan_otfs[slice_num])
+            else:
+                tr.otf = sag_otfs[slice_num], tan_otfs[slice_num]
+            continue
+
+        # Run FFT on LSFs to get MTF (with phase normalisation)
+        lsf_fft = fft_backends.get_backend(s.fft_backend)
+        sag_mod = lentilconf.normalised_centreing_fft(lsf_sag[slice_num] * tukey_window, fftpack=lsf_fft, engine=np)[:centre]
+        tan_mod = lentilconf.normalised_centreing_fft(lsf_tan[slice_num] * tukey_window, fftpack=lsf_fft, engine=np)[:centre]
+
+        if slice_s.return_otf_mtf:
+            sagmtf = interpolator(sag_x, np.abs(sag_mod), k=order)(get_x_freqs)
+            tanmtf = interpolator(tan_x, np.abs(tan_mod), k=order)(get_x_freqs)
+            tr.otf = sagmtf, tanmtf
+        else:
+            sagmtf = interpolator(sag_x, np.real(sag_mod), k=order)(get_x_freqs)
+            tanmtf = interpolator(tan_x, np.real(tan_mod), k=order)(get_x_freqs)
+            sagmtf_i = interpolator(sag_x, np.imag(sag_mod), k=order)(get_x_freqs)
+            tanmtf_i = interpolator(tan_x, np.imag(tan_mod), k=order)(get_x_freqs)
+            tr.otf = sagmtf + 1j * sagmtf_i,\
+                     tanmtf + 1j * tanmtf_i
+    timer.stage("t_mtfs", t)
+
+    timings = dict(timer.times)
+
+    counts = dict.fromkeys(caches.COUNTER_KEYS, 0)
+    for cache, before in zip(used_caches, counters_before):
+        for key, value in cache.counters().items():
+            counts[key] += value - before[key]
+
+    # Shared work is split evenly so timings still add up when summed over results, whole counts go with the
+    # first result (as the profile does)
+    for n, tr in enumerate(trs):
+        tr.timings = {key: value / num_slices for key, value in timings.items()}
+        tr.timings.update(counts if n == 0 else dict.fromkeys(counts, 0))
+        tr.timings.update(get_memory_usage(used_caches, me))
+        # Backend label as "name:threads"
+        tr.timings['fft_backend'] = "{}:{}".format(fft_backend_name, fft_workers)
+        tr.timings['engine'] = engine
+
+    if config.PROFILE_STAGES:
+        # Whole call goes with the first result, so each call is counted once however its results are split up
+        group = dict(device=engine_string, engine=engine, fftsize=int(s.fftsize), phasesamples=int(s.phasesamples),
+                     precision=int(s.precision), fft_backend=trs[0].timings['fft_backend'])
+        trs[0].profile = timer.get_profile(group, num_slices)
+
+    return trs
 
 
 def pad_and_distort(s, wavefunction, affine_transform=ndimage.affine_transform, me=np, complexdtype="complex128"):
     # How many array elements need adding or removing from each side of phase before FFT
+    # Wavefunction may be a single 2d array or a stack of them (in which case only the last two axes are resized)
     padpx = int((s.fftsize - s.phasesamples) / 2)
 
     ellip = None    # Plan pupil distortion
@@ -409,10 +880,11 @@ def pad_and_distort(s, wavefunction, affine_transform=ndimage.affine_transform,
         if config.ENABLE_PUPIL_DISTORTION and ellip is not None:
             wavefunction = helpers.zoom2d(wavefunction, xellip, yellip, affine_transform=affine_transform, me=me)
         t = time.time()
-        resized_wavefunction = me.pad(me.array(wavefunction, dtype=complexdtype), (pt, pt), mode="constant")
+        stackpad = ((0, 0),) * (wavefunction.ndim - 2)
+        resized_wavefunction = me.pad(me.array(wavefunction, dtype=complexdtype), stackpad + (pt, pt), mode="constant")
     elif padpx < 0:
         # Our phase is over padded
-        resized_wavefunction = me.array(wavefunction[-padpx:-padpx + s.fftsize, -padpx:-padpx + s.fftsize],
+        resized_wavefunction = me.array(wavefunction[..., -padpx:-padpx + s.fftsize, -padpx:-padpx + s.fftsize],
                                         dtype=complexdtype)
         if config.ENABLE_PUPIL_DISTORTION and ellip is not None:
             resized_wavefunction = helpers.zoom2d(resized_wavefunction, xellip, yellip, affine_transform=affine_transform,
@@ -0,0 +1,278 @@
+import numpy as np
+from scipy import linalg
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+from lentil import constants_utils as lentilconf
+
+from lentilwave import config, helpers
+from lentilwave.generation import fft_backends, hankel, masks, otfs, propagation
+from lentilwave.generation.generate import defaultcaches, get_phase_cache_cube, get_psf_sample_spacing, \
+    pad_and_distort, sanitycheck
+
+# Parameters with adjoint gradients, any others need finite differences
+ZERNIKE_PARAMS = tuple("z{}".format(znum) for znum in range(1, 49) if znum != 4)
+DEFOCUS_PARAMS = ('df_offset', 'df_step')
+CHROMATIC_PARAMS = ('loca', 'loca1', 'spca', 'spca2')
+GRADIENT_PARAMS = ZERNIKE_PARAMS + DEFOCUS_PARAMS + CHROMATIC_PARAMS
+
+# Engines giving the padded 2D FFT's LSFs (to rounding), the others approximate them
+EXACT_ENGINES = (propagation.ENGINE_FFT2, propagation.ENGINE_LSF, propagation.ENGINE_MIRROR)
+
+
+def has_gradient(name):
+    return name in GRADIENT_PARAMS
+
+
+def is_supported(s: helpers.TestSettings, engine=None):
+    """
+    Check generate() builds these settings' OTFs the way generate_gradient() differentiates them.
+
+    generate_gradient() differentiates the padded 2D FFT model, so the cropped MFT and Hankel paths (which only
+    approximate it) aren't supported.
+
+    :param engine: Engine generate() used for s (TestResults.timings['engine']), if known
+    :return: True if generate_gradient() can be used
+    """
+    if not (s.polychromatic_mode == otfs.POLYCHROMATIC_SPATIAL and config.DIRECT_OTF_SAMPLING and
+            config.PSF_SPLINE_ORDER in (1, 3) and not (s.return_psf or s.return_prysm_mtf)):
+        return False
+    if engine is not None:
+        return engine in EXACT_ENGINES
+    if s.engine not in EXACT_ENGINES:
+        # "auto" may choose the MFT
+        return False
+    if s.radial_fast_path:
+        s.get_processing_details()
+        s.get_used_zernikes()
+        if s.fftsize >= s.phasesamples and hankel.is_symmetric(s):
+            return False
+    return True
+
+
+def zoom_vjp(cotangent, factor, offset):
+    """
+    Back-propagate a cotangent through the LSF resampling done by helpers.zoom1d_stack() for one factor and offset.
+
+    zoom1d_stack() samples a spline (mirror boundaries, zero outside the input) at col_coords, so its transpose
+    scatters each cotangent sample back to the spline coefficients it read, then through the transposed
+    prefilter. Costs O(length), with no dense matrices.
+
+    :param cotangent: d(cost)/d(resampled LSF)
+    :return: d(cost)/d(LSF)
+    """
+    length = len(cotangent)
+    order = config.PSF_SPLINE_ORDER
+    # As zoom1d_stack()
+    coords = np.arange(length) / factor + (length / 2 * (1.0 - 1.0 / factor) - offset / factor)
+    inside = (coords >= 0) & (coords <= length - 1)
+    coords = coords[inside]
+    cotangent = np.asarray(cotangent, dtype="float64")[inside]
+
+    start = np.floor(coords)
+    t = (coords - start)[:, None]
+    if order == 1:
+        indices = start[:, None] + np.arange(2)
+        weights = np.hstack((1 - t, t))
+    else:
+        indices = start[:, None] + np.arange(-1, 3)
+        weights = np.hstack(((1 - t) ** 3, 3 * t ** 3 - 6 * t ** 2 + 4, -3 * t ** 3 + 3 * t ** 2 + 3 * t + 1,
+                             t ** 3)) / 6
+    # Mirror boundaries
+    indices = np.abs(indices).astype("int")
+    indices = np.where(indices > length - 1, 2 * (length - 1) - indices, indices)
+    coefficient_cotangent = np.bincount(indices.ravel(), (weights * cotangent[:, None]).ravel(), minlength=length)
+    if order == 1:
+        return coefficient_cotangent
+
+    # The prefilter solves B @ coefficients = lsf for tridiagonal B (1, 4, 1) / 6, mirrored at the ends
+    banded = np.zeros((3, length))
+    banded[0, 1:] = 1 / 6
+    banded[1] = 4 / 6
+    banded[2, :-1] = 1 / 6
+    # Transposed, B's [0, 1] and [-1, -2] are doubled by the mirror
+    banded[2, 0] = 2 / 6
+    banded[0, -1] = 2 / 6
+    return linalg.solve_banded((1, 1), banded, coefficient_cotangent)
+
+
+def otf_vjp(lsfs, cotangents, sampler):
+    """
+    Back-propagate OTF cotangents through otfs.sample_otfs().
+
+    :param lsfs: 2D array of (windowed) LSFs along last axis
+    :param cotangents: d(cost)/d(real) + 1j * d(cost)/d(imag) of each OTF sample
+    :param sampler: (matrix, bins) from otfs.get_otf_sampler()
+    :return: d(cost)/d(lsfs)
+    """
+    matrix, bins = sampler
+    fftsize = lsfs.shape[-1]
+    coords = np.arange(fftsize) - fftsize // 2
+    sums = lsfs.sum(axis=-1)
+    mid = (lsfs * coords).sum(axis=-1) / sums
+    phasors = np.exp(2j * np.pi * mid[:, None] * bins[None, :] / fftsize)
+    otf = (lsfs @ matrix.T) * phasors / np.abs(sums)[:, None]
+
+    # Through the spectrum, the centroid phase correction and the normalisation by the sum
+    spectrum_term = np.real((np.conj(cotangents) * phasors) @ matrix) / np.abs(sums)[:, None]
+    mid_term = np.real((np.conj(cotangents) * otf * 2j * np.pi * bins[None, :] / fftsize).sum(axis=-1))
+    sum_term = np.real((np.conj(cotangents) * otf).sum(axis=-1)) * np.sign(sums) / np.abs(sums)
+    return spectrum_term + (mid_term / sums)[:, None] * (coords[None, :] - mid[:, None]) - sum_term[:, None]
+
+
+def generate_gradient(s: helpers.TestSettings, sag_cotangent, tan_cotangent, cache_=defaultcaches):
+    """
+    Get gradients of a cost with respect to Zernike, defocus and chromatic parameters by back propagation through
+    the model for one slice.
+
+    The OTFs generate() would return for s are rebuilt with full 2D FFTs, then the cost's sensitivity to them is
+    carried back through OTF sampling, windowing, LSF resampling and normalisation, |.|^2, the FFT and the pupil
+    phase to each Zernike coefficient, and from Z4 and Z9 to the parameters they're derived from. This costs about
+    two generate() calls however many parameters there are, three if the FFTs are over config.BATCH_MAX_BYTES and
+    have to be recomputed.
+
+    :param s: TestSettings as passed to generate() (see is_supported())
+    :param sag_cotangent: d(cost)/d(real) + 1j * d(cost)/d(imag) of each sagittal OTF value generate() returned
+                          (real if s.return_otf_mtf)
+    :param tan_cotangent: Same for tangential
+    :param cache_: Generator caches
+    :return: dict of parameter name: d(cost)/d(parameter) for parameters in GRADIENT_PARAMS used by s
+    """
+    sanitycheck(s)
+    s.get_processing_details()
+    s.get_used_zernikes()
+
+    use_cuda = s.allow_cuda and cp is not None
+    me, engine_string = (cp, 'cp') if use_cuda else (np, 'np')
+    fft2 = me.fft.fft2 if use_cuda else fft_backends.get_backend(s.fft_backend, fft_backends.get_fft_workers(s)).fft2
+    engcache = cache_[engine_string]
+    realdtype, complexdtype = s.realdtype, s.complexdtype
+
+    eval_wavelengths = np.array([config.BASE_WAVELENGTH] if s.mono else s.wavelengths)
+    polychromatic_weights = np.array([float(lentilconf.photopic_fn(wv * 1e3) * lentilconf.d50_interpolator(wv))
+                                      for wv in eval_wavelengths])
+    ellip = s.p.get('ellip', 0)
+    xellip = np.clip(1.0 + ellip, 0.5, 1.0)
+    yellip = np.clip(1.0 - ellip, 0.5, 1.0)
+
+    mask = masks.build_mask(s, engine=me, dtype=realdtype, cache=engcache.masks)
+    cubekey = (s.phasesamples, hash(s.used_zernikes), realdtype, engine_string)
+    try:
+        cube = engcache.cubes[cubekey]
+    except KeyError:
+        cube = get_phase_cache_cube(s, me=me, realdtype=realdtype)
+        engcache.cubes[cubekey] = cube
+    z4_index = s.zernike_index[4 - 1]
+    z9_index = s.zernike_index[9 - 1]
+    coefficients = s.zernike_array_indexed.copy()
+    coefficients[z4_index] = 0
+    coefficients[z9_index] = 0
+    basephase = cube @ me.array(coefficients, dtype=realdtype)
+    z4_phase = cube[:, :, z4_index]
+    z9_phase = cube[:, :, z9_index]
+
+    min_wvl = min(eval_wavelengths)
+    psf_sample_spacing = get_psf_sample_spacing(s, min_wvl)
+    mtf_mapper_fft_halfwindowsize_um = 16 * lentilconf.DEFAULT_PIXEL_SIZE * 1e6
+    zoom_factors = np.clip(eval_wavelengths / min_wvl, 1.001, np.inf)
+    shifts_x, shifts_y = np.array([helpers.get_lca_shifts(s, model_wvl, psf_sample_spacing)
+                                   for model_wvl in eval_wavelengths]).T
+    z4s = np.array([helpers.get_z4(s.defocus, s.p, model_wvl) for model_wvl in eval_wavelengths])
+    z9s = np.array([helpers.get_z9(s.p, model_wvl) for model_wvl in eval_wavelengths])
+
+    tukeykey = (s.fftsize, psf_sample_spacing)
+    try:
+        tukey_window = cache_['np'].windows[tukeykey]
+    except KeyError:
+        psf_units = np.arange(-s.fftsize / 2, s.fftsize / 2) * psf_sample_spacing
+        tukey_window = lentilconf.tukey(psf_units / mtf_mapper_fft_halfwindowsize_um, 0.6)
+        cache_['np'].windows[tukeykey] = tukey_window
+    get_x_freqs = np.asarray(s.spacial_freqs) / lentilconf.DEFAULT_PIXEL_SIZE * 1e-3
+    samplerkey = tukeykey + (tuple(get_x_freqs),)
+    try:
+        otf_sampler = cache_['np'].otf_samplers[samplerkey]
+    except KeyError:
+        otf_sampler = otfs.get_otf_sampler(s.fftsize, psf_sample_spacing, get_x_freqs)
+        cache_['np'].otf_samplers[samplerkey] = otf_sampler
+
+    def propagate(wvl_num):
+        # As generate(), one wavelength at a time
+        phase = basephase + z4_phase * z4s[wvl_num] + z9_phase * z9s[wvl_num]
+        wavefunction = me.exp(1j * (2 * np.pi / eval_wavelengths[wvl_num]) * phase) * mask
+        fftarr = fft2(me.fft.fftshift(pad_and_distort(s, wavefunction, me=me, complexdtype=complexdtype)))
+        return wavefunction, fftarr
+
+    def to_numpy(arr):
+        return cp.asnumpy(arr) if me is cp else arr
+
+    # Forward pass down to OTFs, keeping FFTs for the backward pass if they fit
+    num_wvls = len(eval_wavelengths)
+    keep = num_wvls * s.fftsize ** 2 * np.dtype(complexdtype).itemsize <= config.BATCH_MAX_BYTES
+    kept = []
+    lsfs = np.zeros((2, s.fftsize))
+    scaled = np.zeros((2, num_wvls, s.fftsize))
+    for wvl_num in range(num_wvls):
+        wavefunction, fftarr = propagate(wvl_num)
+        power = me.absolute(fftarr) ** 2
+        imps = to_numpy(me.stack((me.fft.ifftshift(power.sum(axis=-1)), me.fft.ifftshift(power.sum(axis=-2)))))
+        if keep:
+            kept.append((wavefunction, fftarr))
+        for axis, (ellip_factor, shifts) in enumerate(((xellip, shifts_x), (yellip, shifts_y))):
+            scaled[axis, wvl_num] = helpers.zoom1d_stack(imps[axis][None, :], (zoom_factors[wvl_num] / ellip_factor,),
+                                                         (shifts[wvl_num],))[0]
+            lsfs[axis] += scaled[axis, wvl_num] / scaled[axis, wvl_num].sum() * polychromatic_weights[wvl_num]
+
+    windowed = lsfs * tukey_window
+    cotangents = np.array((sag_cotangent, tan_cotangent), dtype="complex128")
+    if s.return_otf_mtf:
+        # Cotangents are for magnitudes
+        otf = otfs.sample_otfs(windowed, otf_sampler)
+        cotangents = cotangents.real * otf / np.where(otf == 0, 1, np.abs(otf))
+    lsf_cotangents = otf_vjp(windowed, cotangents, otf_sampler) * tukey_window
+
+    grads = dict.fromkeys(s.used_zernikes, 0.0)
+    z4_grads = np.zeros(num_wvls)
+    z9_grads = np.zeros(num_wvls)
+    for wvl_num in range(num_wvls):
+        # Back through normalised sums and resampling to each axis's unscaled LSF
+        imp_cotangents = []
+        for axis, (ellip_factor, shifts) in enumerate(((xellip, shifts_x), (yellip, shifts_y))):
+            row = scaled[axis, wvl_num]
+            total = row.sum()
+            row_cotangent = (lsf_cotangents[axis] - (lsf_cotangents[axis] @ row) / total)
+            row_cotangent *= polychromatic_weights[wvl_num] / total
+            imp_cotangents.append(zoom_vjp(row_cotangent, zoom_factors[wvl_num] / ellip_factor, shifts[wvl_num]))
+
+        wavefunction, fftarr = kept[wvl_num] if keep else propagate(wvl_num)
+        # Projections of the unshifted PSF, so each PSF sample gets its row and column LSF cotangents
+        x_cotangent, y_cotangent = (me.fft.fftshift(me.array(imp_cotangent, dtype=realdtype))
+                                    for imp_cotangent in imp_cotangents)
+        fft_cotangent = 2 * (x_cotangent[:, None] + y_cotangent[None, :]) * fftarr
+        # Adjoint of the FFT, then of fftshift and padding
+        padded_cotangent = me.fft.ifftshift(me.conj(fft2(me.conj(fft_cotangent))))
+        padpx = int((s.fftsize - s.phasesamples) / 2)
+        if padpx > 0:
+            pupil_cotangent = padded_cotangent[padpx:padpx + s.phasesamples, padpx:padpx + s.phasesamples]
+        elif padpx < 0:
+            pupil_cotangent = me.zeros((s.phasesamples, s.phasesamples), dtype=complexdtype)
+            pupil_cotangent[-padpx:-padpx + s.fftsize, -padpx:-padpx + s.fftsize] = padded_cotangent
+        else:
+            pupil_cotangent = padded_cotangent
+        # Through exp(i phase), phase is 2 pi W / wavelength
+        phase_cotangent = me.imag(pupil_cotangent * me.conj(wavefunction)) * (2 * np.pi / eval_wavelengths[wvl_num])
+        term_grads = to_numpy(phase_cotangent.reshape(-1) @ cube.reshape(-1, cube.shape[-1]))
+        for znum, term_grad in zip(s.used_zernikes, term_grads):
+            if znum not in (4, 9):
+                grads[znum] += float(term_grad)
+        z4_grads[wvl_num] = term_grads[z4_index]
+        z9_grads[wvl_num] = term_grads[z9_index]
+
+    out = {"z{}".format(znum): grad for znum, grad in grads.items() if znum not in (4, 9)}
+    for wvl_num, model_wvl in enumerate(eval_wavelengths):
+        for derivatives, term_grad in ((helpers.get_z4_derivatives(s.defocus, s.p, model_wvl), z4_grads[wvl_num]),
+                                       (helpers.get_z9_derivatives(s.p, model_wvl), z9_grads[wvl_num])):
+            for name, derivative in derivatives.items():
+                out[name] = out.get(name, 0.0) + float(derivative * term_grad)
+    return out
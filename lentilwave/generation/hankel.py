@@ -0,0 +1,123 @@
+import numpy as np
+from scipy import special
+
+from lentilwave import config
+from lentilwave.generation import masks, zernikes
+
+
+class HankelTransform:
+    """
+    LSFs of radially symmetric pupils through two quasi-discrete Hankel transforms (pupil to amplitude PSF, then
+    PSF to OTF) and a 1D inverse FFT, in place of the 2D FFT.
+
+    Radial samples sit at zeros of J0 so each transform is a Fourier-Bessel (Dini) quadrature, which is exact for
+    band limited integrands. The OTF is evaluated on the same frequency grid as the 2D FFT would sample, so the
+    LSFs come out on the usual fftsize grid (centred at fftsize // 2) with the same total as the 2D FFT path.
+    """
+    def __init__(self, phasesamples, fftsize, radius, me=np, realdtype="float64",
+                 oversampling=config.HANKEL_OVERSAMPLING):
+        self.phasesamples = phasesamples
+        self.fftsize = fftsize
+        self.radius = radius
+        self.me = me
+
+        # Normalised pupil coordinates span -1 to 1 across phasesamples
+        pupil_spacing = 2.0 / (phasesamples - 1)
+        # Furthest PSF sample from the centre of the 2D FFT grid (in its corners)
+        psf_radius = 2 ** 0.5 / (2 * pupil_spacing)
+
+        # Pupil nodes need the amplitude PSF band limited within their Nyquist radius, then PSF nodes need
+        # the OTF (which is zero beyond twice the pupil radius) within theirs
+        pupil_nodes = int(np.ceil(2 * radius * psf_radius * oversampling))
+        psf_nodes = int(np.ceil(4 * radius * psf_radius * oversampling))
+        self.rho, rho_weights = get_nodes(pupil_nodes, radius)
+        psf_r, psf_weights = get_nodes(psf_nodes, psf_radius)
+
+        amplitude_matrix = special.j0(2 * np.pi * psf_r[:, None] * self.rho[None, :]) * rho_weights[None, :]
+
+        freqs = np.arange(fftsize // 2 + 1) * pupil_spacing
+        otf_matrix = special.j0(2 * np.pi * freqs[:, None] * psf_r[None, :]) * psf_weights[None, :]
+        # Autocorrelation of the pupil has nothing beyond twice its radius
+        otf_matrix[freqs > 2 * radius] = 0
+
+        # The 2D FFT path LSFs total fftsize^2 times the sum of squared pupil samples
+        scale = fftsize ** 2 / pupil_spacing ** 2
+
+        self.amplitude_matrix_t = me.array(amplitude_matrix.T, dtype=realdtype)
+        self.otf_matrix_t = me.array(otf_matrix.T * scale, dtype=realdtype)
+
+    def lsfs(self, pupils):
+        """
+        Get the (identical sagittal and tangential) LSFs of a stack of radial pupils.
+
+        :param pupils: complex pupils sampled at self.rho, shape (items, len(self.rho))
+        :return: LSFs of shape (items, fftsize), centred on fftsize // 2
+        """
+        me = self.me
+        amplitude = pupils @ self.amplitude_matrix_t
+        psf = amplitude.real ** 2
+        psf += amplitude.imag ** 2
+        otf = psf @ self.otf_matrix_t
+        return me.fft.fftshift(me.fft.irfft(otf, n=self.fftsize, axis=-1), axes=-1)
+
+    @property
+    def nbytes(self):
+        return int(self.amplitude_matrix_t.nbytes + self.otf_matrix_t.nbytes)
+
+
+def get_nodes(num, radius):
+    """
+    Get Fourier-Bessel quadrature nodes and weights for 2 pi integral(f(r) J0(2 pi nu r) r dr) over 0 to radius.
+
+    :param num: Number of nodes
+    :param radius: Radius beyond which the integrand is zero
+    :return: (nodes, weights)
+    """
+    zeros = special.jn_zeros(0, num + 1)
+    last = zeros[-1]
+    nodes = zeros[:-1] * radius / last
+    weights = 4 * np.pi * radius ** 2 / (last ** 2 * special.j1(zeros[:-1]) ** 2)
+    return nodes, weights
+
+
+def get_asymmetric_zernikes(s):
+    """
+    Get Zernike numbers in use with non-zero coefficients which aren't rotationally symmetric.
+
+    :param s: TestSettings (used Zernikes already found)
+    :return: list of Zernike numbers
+    """
+    nms = zernikes.get_fringe_nm()
+    return [znum for znum, coefficient in zip(s.used_zernikes, s.zernike_array_indexed)
+            if coefficient != 0 and nms[znum - 1][1] != 0]
+
+
+def is_symmetric(s):
+    """
+    Check whether the pupil (mask and wavefront) is rotationally symmetric.
+
+    :param s: TestSettings (used Zernikes already found)
+    :return: True if symmetric
+    """
+    if get_asymmetric_zernikes(s):
+        return False
+    rho = np.linspace(0, min(masks.get_mask_radius(s), 2 ** 0.5), s.phasesamples // 2 + 1)[1:]
+    _, asymmetry = masks.build_radial_mask(s, rho, engine=np)
+    return asymmetry <= config.HANKEL_MAX_MASK_ASYMMETRY
+
+
+def get_radial_pupil(s, transform, me=np, realdtype="float64"):
+    """
+    Get the (azimuthally averaged) mask and used Zernike terms at the transform's radial nodes.
+
+    :param s: TestSettings (used Zernikes already found)
+    :param transform: HankelTransform
+    :param me: Array engine (numpy or cupy)
+    :param realdtype: dtype of outputs
+    :return: (mask, cube of shape (nodes, used Zernikes))
+    """
+    radial_mask, _ = masks.build_radial_mask(s, transform.rho, engine=np)
+    basis = zernikes.evaluate_fringe_basis(np.zeros_like(transform.rho), transform.rho)
+    used = np.array(s.used_zernikes) - 1  # Zero based
+    cube = np.ascontiguousarray(basis[used].T)
+    return me.array(radial_mask, dtype=realdtype), me.array(cube, dtype=realdtype)
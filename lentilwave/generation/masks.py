@@ -10,31 +10,92 @@ from lentil import constants_utils as lentilconf
 from lentilwave import helpers
 
 
+def get_mask_key(s: helpers.TestSettings, engine=np, dtype="float64"):
+    # Everything the mask depends on must be in here
+    return (s.p['base_fstop'],
+            s.p['fstop'],
+            s.x_loc,
+            s.y_loc,
+            s.phasesamples,
+            s.p.get('a', 1.0),
+            s.p.get('b', 1.0),
+            s.p.get('v_slr', 1.0),
+            s.p.get('v_rad', 1.0),
+            s.p.get('squariness', 0.5),
+            s.default_exit_pupil_position_mm,
+            s.fix_pupil_rotation,
+            s.pixel_vignetting,
+            s.lens_vignetting,
+            "np" if engine is np else "cp",
+            dtype)
+
+
 def build_mask(s: helpers.TestSettings, engine=np, dtype="float64", plot=False, cache=None):
 
-    # Lets get a hash to we can cache our mask (if cache object provided)
-    hashtuple = (s.p['base_fstop'],
-                 s.p['fstop'],
-                 s.x_loc,
-                 s.y_loc,
-                 s.phasesamples,
-                 s.p.get('a', 0.0),
-                 s.p.get('b', 0.0),
-                 s.p.get('v_scr', 1.0),
-                 s.p.get('v_rad', 1.0),
-                 s.p.get('squariness', 0.5),
-                 "np" if engine is np else "cp",
-                 dtype)
-    hash = hashtuple.__hash__()
-
-    # Check cache
+    # Lets get a key so we can cache our mask (if cache object provided)
+    hashtuple = get_mask_key(s, engine, dtype)
+
+    # Check cache (anything dict-like, such as GeneratorCache.masks)
+    if cache is not None and not plot:
+        try:
+            return cache[hashtuple]
+        except KeyError:
+            pass
+
+    me = engine
+
+    normarr = me.linspace(-1, 1, s.phasesamples, dtype=dtype)
+    gridx, gridy = me.meshgrid(normarr, normarr)
+    mask = evaluate_mask(s, gridx, gridy, engine=me, dtype=dtype)
+
+    if plot or s.id_or_hash == -1:
+        if engine is cp:
+            plt.imshow(cp.asnumpy(mask))
+            plt.colorbar()
+            plt.show()
+        else:
+            plt.imshow(mask)
+            plt.colorbar()
+            plt.show()
+
+    mask = mask.astype(dtype, copy=False)
     if cache is not None:
-        for cachehash, mask in cache:
-            if cachehash == hash:
-                return mask
+        cache[hashtuple] = mask
+    return mask
+
+
+def is_mirror_symmetric(s: helpers.TestSettings):
+    """
+    Check whether the mask is a mirror image of itself about the x axis (pupil rows i and phasesamples - 1 - i
+    match), which it is whenever the field point is placed on the x axis.
+    """
+    return s.fix_pupil_rotation or s.y_loc == lentilconf.IMAGE_HEIGHT / 2
+
+
+def get_mask_radius(s: helpers.TestSettings):
+    """
+    Normalised pupil radius beyond which the (anti-aliased) aperture stop is fully closed.
+    """
+    return s.p['base_fstop'] / s.p['fstop'] + 0.5 / _get_smoothfactor(s)
+
 
+def _get_smoothfactor(s: helpers.TestSettings):
     # Anti-aliasing adjustment
-    smoothfactor = s.phasesamples / 1.5
+    return s.phasesamples / 1.5
+
+
+def evaluate_mask(s: helpers.TestSettings, normx, normy, engine=np, dtype="float64"):
+    """
+    Evaluate pupil mask (stop and vignetting) at arbitrary normalised pupil coordinates.
+
+    :param s: TestSettings
+    :param normx: x coordinates (any shape), -1 to 1 spans the full aperture
+    :param normy: y coordinates (same shape as normx)
+    :param engine: Array engine (numpy or cupy)
+    :param dtype: dtype of calculation
+    :return: mask, same shape as normx
+    """
+    smoothfactor = _get_smoothfactor(s)
 
     me = engine
 
@@ -55,15 +116,9 @@ def build_mask(s: helpers.TestSettings, engine=np, dtype="float64", plot=False,
         x_displacement_mm = -magnitude
         y_displacement_mm = 0
 
-    x_displacement_mm_min = -x_displacement_mm - pupil_radius_mm
-    x_displacement_mm_max = -x_displacement_mm + pupil_radius_mm
-    y_displacement_mm_min = -y_displacement_mm - pupil_radius_mm
-    y_displacement_mm_max = -y_displacement_mm + pupil_radius_mm
-
-    # Build a grid of lateral displacement from directly perpendicular to image plane
-    x = me.linspace(x_displacement_mm_min, x_displacement_mm_max, s.phasesamples, dtype=dtype)
-    y = me.linspace(y_displacement_mm_min, y_displacement_mm_max, s.phasesamples, dtype=dtype)
-    gridx, gridy = me.meshgrid(x, y)
+    # Lateral displacement from directly perpendicular to image plane
+    gridx = normx * pupil_radius_mm - x_displacement_mm
+    gridy = normy * pupil_radius_mm - y_displacement_mm
     displacement_grid = (gridx**2 + gridy**2) ** 0.5
 
     # Our pixels are square so there it's likely not a perfectly uniform response from all angles.
@@ -71,13 +126,11 @@ def build_mask(s: helpers.TestSettings, engine=np, dtype="float64", plot=False,
     pixel_angle_grid = me.arctan(displacement_grid / s.default_exit_pupil_position_mm *
                                  (1.0 + squariness * s.p.get('squariness', 0.5)), dtype=dtype)
 
-    # Build normalised radius grid for circles
-    normarr = me.linspace(-1, 1, s.phasesamples, dtype=dtype)
-    gridx, gridy = me.meshgrid(normarr, normarr)
-    pupil_norm_radius_grid = (gridx ** 2 + gridy ** 2) ** 0.5
+    # Normalised radius for circles
+    pupil_norm_radius_grid = (normx ** 2 + normy ** 2) ** 0.5
 
     # Get aperture stop mask (with antialiasing)
-    stopmask = np.clip((aperture_stop_norm_radius - pupil_norm_radius_grid) * smoothfactor + 0.5, 0, 1)
+    stopmask = me.clip((aperture_stop_norm_radius - pupil_norm_radius_grid) * smoothfactor + 0.5, 0, 1)
 
     # Get pixel vignetting coefficient scalars
     a = s.p.get('a', 1.0)
@@ -93,35 +146,38 @@ def build_mask(s: helpers.TestSettings, engine=np, dtype="float64", plot=False,
         mask = stopmask * square_grid
 
     if s.lens_vignetting:
-        # Get vignetting mask circle 1 (front of lens)
-        normarr = me.linspace(-1, 1, s.phasesamples, dtype=dtype)
         image_circle_modifier = s.p.get('v_slr', 1.0) * 0.6
-        gridx, gridy = me.meshgrid(normarr - x_displacement_mm / lentilconf.SENSOR_WIDTH * 1e-3 * image_circle_modifier,
-                                   normarr - y_displacement_mm / lentilconf.SENSOR_WIDTH * 1e-3 * image_circle_modifier)
-        vignette_radius_grid = (gridx ** 2 + gridy ** 2) ** 0.5
+        vignette_x = x_displacement_mm / lentilconf.SENSOR_WIDTH * 1e-3 * image_circle_modifier
+        vignette_y = y_displacement_mm / lentilconf.SENSOR_WIDTH * 1e-3 * image_circle_modifier
+
+        # Get vignetting mask circle 1 (front of lens)
+        vignette_radius_grid = ((normx - vignette_x) ** 2 + (normy - vignette_y) ** 2) ** 0.5
         vignette_crop_circle_radius = s.p.get('v_rad', 1.0)
-        vignette_mask = np.clip((vignette_crop_circle_radius - vignette_radius_grid) * smoothfactor + 0.5, 0, 1)
+        vignette_mask = me.clip((vignette_crop_circle_radius - vignette_radius_grid) * smoothfactor + 0.5, 0, 1)
         mask *= vignette_mask
 
         # Get vignetting mask circle 2 (back of lens)
-        normarr = me.linspace(-1, 1, s.phasesamples, dtype=dtype)
-        image_circle_modifier = s.p.get('v_slr', 1.0) * 0.6
-        gridx, gridy = me.meshgrid(normarr + x_displacement_mm / lentilconf.SENSOR_WIDTH * 1e-3 * image_circle_modifier,
-                                   normarr + y_displacement_mm / lentilconf.SENSOR_WIDTH * 1e-3 * image_circle_modifier)
-        vignette_radius_grid = (gridx ** 2 + gridy ** 2) ** 0.5
+        vignette_radius_grid = ((normx + vignette_x) ** 2 + (normy + vignette_y) ** 2) ** 0.5
         vignette_crop_circle_radius = s.p.get('v_rad', 1.0) * 1.0
-        vignette_mask = np.clip((vignette_crop_circle_radius - vignette_radius_grid) * smoothfactor + 0.5, 0, 1)
+        vignette_mask = me.clip((vignette_crop_circle_radius - vignette_radius_grid) * smoothfactor + 0.5, 0, 1)
         mask *= vignette_mask
-
-    if plot or s.id_or_hash == -1:
-        if engine is cp:
-            print(square_grid)
-            plt.imshow(cp.asnumpy(mask))
-            plt.colorbar()
-            plt.show()
-        else:
-            print(square_grid)
-            plt.imshow(mask)
-            plt.colorbar()
-            plt.show()
     return mask
+
+
+def build_radial_mask(s: helpers.TestSettings, rho, engine=np, dtype="float64", azimuths=16):
+    """
+    Get the azimuthal mean of the mask at each normalised radius, and how far the mask strays from it.
+
+    :param s: TestSettings
+    :param rho: 1D array of normalised radii
+    :param engine: Array engine (numpy or cupy)
+    :param dtype: dtype of calculation
+    :param azimuths: Number of azimuths to average over
+    :return: (radial mask, maximum absolute deviation of mask from radial mask)
+    """
+    me = engine
+    phi = me.arange(azimuths, dtype=dtype) * (2 * np.pi / azimuths)
+    samples = evaluate_mask(s, rho[:, None] * me.sin(phi)[None, :], rho[:, None] * me.cos(phi)[None, :],
+                            engine=me, dtype=dtype)
+    radial = samples.mean(axis=1)
+    return radial, float(abs(samples - radial[:, None]).max())
@@ -0,0 +1,122 @@
+import numpy as np
+
+POLYCHROMATIC_SPATIAL = "spatial"
+POLYCHROMATIC_FREQUENCY = "frequency"
+
+POLYCHROMATIC_MODES = (POLYCHROMATIC_SPATIAL, POLYCHROMATIC_FREQUENCY)
+
+
+def get_otf_bins(fftsize, psf_sample_spacing, freqs):
+    """
+    Convert frequencies to (fractional) FFT bins of an LSF.
+
+    :param fftsize: LSF length
+    :param psf_sample_spacing: LSF sample spacing (um)
+    :param freqs: Frequencies (cycles/mm)
+    :return: array of bins
+    """
+    return np.asarray(freqs) * fftsize * psf_sample_spacing * 1e-3
+
+
+def get_otf_sampler(fftsize, psf_sample_spacing, freqs):
+    """
+    Get DFT matrix evaluating the FFT of an LSF directly at the requested frequencies.
+
+    Rows match lentilconf.normalised_centreing_fft() (before phase normalisation) at fractional FFT bins,
+    which is what the splines through its output were approximating.
+
+    :param fftsize: LSF length
+    :param psf_sample_spacing: LSF sample spacing (um)
+    :param freqs: Frequencies to evaluate (cycles/mm)
+    :return: (matrix of shape (len(freqs), fftsize), frequencies in FFT bins)
+    """
+    bins = get_otf_bins(fftsize, psf_sample_spacing, freqs)
+    # Relative to centre so the centroid phase correction stays small
+    coords = np.arange(fftsize) - fftsize // 2
+    matrix = np.exp(-2j * np.pi * np.outer(bins, coords) / fftsize)
+    return matrix, bins
+
+
+def get_scaled_otf_samplers(fftsize, bins, factors):
+    """
+    Get one DFT matrix per scale factor, each evaluating at bins * factor.
+
+    An LSF zoomed by a factor about its centre has its spectrum compressed by the same factor, so these sample
+    the spectrum of the zoomed LSF without resampling it.
+
+    :param fftsize: LSF length
+    :param bins: Frequencies in FFT bins (see get_otf_bins())
+    :param factors: Zoom factors
+    :return: array of shape (len(factors), len(bins), fftsize)
+    """
+    coords = np.arange(fftsize) - fftsize // 2
+    scaled_bins = np.asarray(factors)[:, None] * bins[None, :]
+    return np.exp(-2j * np.pi * scaled_bins[:, :, None] * coords[None, None, :] / fftsize)
+
+
+def scaled_lsf_terms(lsfs, windows, samplers, bins, factors, shifts, coefficients):
+    """
+    Get the frequency domain terms of LSFs as if each had been zoomed by a factor about the centre, shifted,
+    windowed and multiplied by a coefficient.
+
+    Windows must already be mapped back onto the unzoomed LSF coordinates. Terms from many LSFs can be summed
+    and then passed to combine_otfs().
+
+    :param lsfs: 2D array of unzoomed LSFs along last axis
+    :param windows: 2D array of windows for each LSF in unzoomed coordinates
+    :param samplers: 3D array of DFT matrices for each LSF (see get_scaled_otf_samplers())
+    :param bins: Frequencies in FFT bins
+    :param factors: Zoom factor for each LSF
+    :param shifts: Shift in samples for each LSF
+    :param coefficients: Multiplier for each LSF
+    :return: (spectra, sums, first moments about centre)
+    """
+    fftsize = lsfs.shape[-1]
+    coords = np.arange(fftsize) - fftsize // 2
+    windowed = lsfs * windows
+
+    spectra = np.einsum("in,ifn->if", windowed, samplers)
+    spectra *= np.exp(-2j * np.pi * shifts[:, None] * bins[None, :] / fftsize)
+    spectra *= coefficients[:, None]
+
+    sums = windowed.sum(axis=-1) * coefficients
+    moments = (windowed * (shifts[:, None] + factors[:, None] * coords[None, :])).sum(axis=-1) * coefficients
+    return spectra, sums, moments
+
+
+def combine_otfs(spectra, sums, moments, bins, fftsize):
+    """
+    Get phase-normalised OTFs from spectra, sums and first moments of LSFs.
+
+    Same normalisation as lentilconf.normalised_centreing_fft(): unity at zero frequency with phase
+    relative to the LSF centroid.
+
+    :param spectra: 2D array of spectra at bins relative to LSF centre
+    :param sums: LSF sums
+    :param moments: LSF first moments about centre
+    :param bins: Frequencies in FFT bins
+    :param fftsize: LSF length
+    :return: 2D complex array of OTFs
+    """
+    empty = sums == 0
+    safe_sums = np.where(empty, 1.0, sums)
+    mid = moments / safe_sums
+
+    otfs = spectra * np.exp(2j * np.pi * mid[:, None] * bins[None, :] / fftsize)
+    otfs /= np.abs(safe_sums)[:, None]
+    otfs[empty] = 0
+    return otfs
+
+
+def sample_otfs(lsfs, sampler):
+    """
+    Get phase-normalised OTFs of a stack of (windowed) LSFs at the sampler's frequencies.
+
+    :param lsfs: 2D array of LSFs along last axis
+    :param sampler: (matrix, bins) from get_otf_sampler()
+    :return: 2D complex array of OTFs, one row per LSF
+    """
+    matrix, bins = sampler
+    fftsize = lsfs.shape[-1]
+    coords = np.arange(fftsize) - fftsize // 2
+    return combine_otfs(lsfs @ matrix.T, lsfs.sum(axis=-1), (lsfs * coords).sum(axis=-1), bins, fftsize)
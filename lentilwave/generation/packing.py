@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class PupilPacking:
+    """
+    The in-pupil samples of a mask, so pupil domain work (phase assembly, exp, masking) can skip everything
+    outside the aperture and only scatter into a square grid for propagation.
+
+    Packed 2D pupils have shape (1, npix) and packed cubes (1, npix, terms), so stacks of them broadcast in the
+    generate loop exactly as (phasesamples, phasesamples) pupils do.
+    """
+    def __init__(self, mask, me=np):
+        self.phasesamples = mask.shape[-1]
+        self.me = me
+        self.indices = me.flatnonzero(mask)
+        self.npix = int(self.indices.size)
+        self.mask = mask.reshape(-1)[self.indices][None, :]
+        self._fft_indices = {}
+
+    def pack(self, array):
+        """
+        Pack a 2D pupil (phasesamples, phasesamples) or cube (phasesamples, phasesamples, terms).
+
+        :return: packed array of shape (1, npix) or (1, npix, terms)
+        """
+        flat = array.reshape((self.phasesamples ** 2,) + array.shape[2:])
+        return self.me.ascontiguousarray(flat[self.indices])[None]
+
+    def unpack(self, packed, dtype=None):
+        """
+        Scatter a stack of packed pupils (items, 1, npix) back onto zeroed square grids.
+
+        :return: array of shape (items, phasesamples, phasesamples)
+        """
+        items = packed.shape[0]
+        out = self.me.zeros((items, self.phasesamples, self.phasesamples), dtype=dtype or packed.dtype)
+        out.reshape(items, -1)[:, self.indices] = packed[:, 0]
+        return out
+
+    def get_fft_indices(self, fftsize):
+        """
+        Get where each in-pupil sample lands in a flattened fftsize x fftsize buffer after padding (or
+        cropping) and fftshift, as workspace.write_padded_shifted() would place it.
+
+        :return: (flat destination indices, boolean array of samples kept or None if all are)
+        """
+        try:
+            return self._fft_indices[fftsize]
+        except KeyError:
+            pass
+        me = self.me
+        padpx = int((fftsize - self.phasesamples) / 2)
+        rows, cols = me.divmod(self.indices, self.phasesamples)
+        rows = rows + padpx
+        cols = cols + padpx
+        keep = (rows >= 0) & (rows < fftsize) & (cols >= 0) & (cols < fftsize)
+        if bool(keep.all()):
+            keep = None
+        else:
+            # Over-sized pupil, samples beyond the FFT are cropped
+            rows = rows[keep]
+            cols = cols[keep]
+        # fftshift moves sample k to (k + fftsize // 2) % fftsize
+        rows = (rows + fftsize // 2) % fftsize
+        cols = (cols + fftsize // 2) % fftsize
+        indices = rows * fftsize + cols
+        self._fft_indices[fftsize] = indices, keep
+        return indices, keep
+
+    def write_padded_shifted(self, out, packed, fftsize):
+        """
+        Scatter a stack of packed wavefunctions straight into (C contiguous) FFT buffers.
+
+        :param out: Complex buffer stack (items, fftsize, fftsize)
+        :param packed: Packed wavefunctions (items, 1, npix)
+        :param fftsize: FFT size
+        """
+        indices, keep = self.get_fft_indices(fftsize)
+        items = packed.shape[0]
+        values = packed[:, 0] if keep is None else packed[:, 0, keep]
+        out.fill(0)
+        out.reshape(items, -1)[:, indices] = values
+
+    @property
+    def nbytes(self):
+        arrays = [self.indices, self.mask] + [arr for pair in self._fft_indices.values()
+                                              for arr in pair if arr is not None]
+        return sum(int(arr.nbytes) for arr in arrays)
@@ -0,0 +1,285 @@
+from collections import OrderedDict
+
+import numpy as np
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+import scipy.fft
+from scipy import fftpack
+
+from lentilwave import config
+from lentilwave.generation import masks, zernikes
+
+ENGINE_FFT2 = "fft2"
+ENGINE_LSF = "lsf"
+ENGINE_MFT = "mft"
+ENGINE_AUTO = "auto"
+ENGINE_HANKEL = "hankel"  # Not selectable, used automatically for rotationally symmetric pupils (see hankel.py)
+ENGINE_MIRROR = "mirror"  # Not selectable, used automatically for mirror symmetric pupils (see is_mirror_symmetric())
+
+ENGINES = (ENGINE_FFT2, ENGINE_LSF, ENGINE_MFT, ENGINE_AUTO)
+
+# Extra LSF samples computed by the MFT beyond those needed, so spline resampling isn't affected by the crop
+MFT_MARGIN = 32
+
+
+def get_engine(s, build_psf=False, mft_halfwidth=None, support=None):
+    """
+    Decide which propagation engine to use for these settings.
+
+    Anything needing the full 2D PSF has to use the 2D FFT. "auto" picks whichever of the 2D FFT, 1D FFT
+    and MFT engines has the lowest estimated cost.
+
+    :param s: TestSettings with processing details
+    :param build_psf: True if a full 2D PSF is required
+    :param mft_halfwidth: Half width of LSF samples needed (see get_mft_halfwidth())
+    :param support: Pupil support slices (see get_support())
+    :return: engine string
+    """
+    if s.engine not in ENGINES:
+        raise ValueError("Unknown propagation engine '{}', options are {}".format(s.engine, ENGINES))
+    if build_psf:
+        return ENGINE_FFT2
+    if s.engine == ENGINE_AUTO:
+        return choose_engine(s, mft_halfwidth, support)
+    return s.engine
+
+
+def choose_engine(s, mft_halfwidth, support):
+    """
+    Estimate costs of the 2D FFT, 1D FFT and MFT engines and return the cheapest (the 2D FFT on a tie).
+
+    The 2D FFT transforms every row and column of the padded array, the 1D FFT engine only the support's
+    rows and columns. Matrix products run much closer to peak flops than FFTs, which config.MFT_RELATIVE_SPEED
+    accounts for.
+
+    :param s: TestSettings with processing details
+    :param mft_halfwidth: Half width of LSF samples needed (see get_mft_halfwidth())
+    :param support: Pupil support slices (see get_support())
+    :return: engine string
+    """
+    rows, cols = (sl.stop - sl.start for sl in support)
+    out_samples = min(2 * mft_halfwidth + 1, s.fftsize)
+    # Over padded pupils are cropped to fftsize first
+    line_flops = 5 * s.fftsize * np.log2(s.fftsize)
+    costs = OrderedDict([(ENGINE_FFT2, line_flops * s.fftsize * 2),
+                         (ENGINE_LSF, line_flops * (rows + cols)),
+                         (ENGINE_MFT, 8 * out_samples * rows * cols * 2 / config.MFT_RELATIVE_SPEED)])
+    return min(costs, key=costs.get)
+
+
+def get_support(s, mask, me=np):
+    """
+    Get the bounding box of non-zero pupil pixels (limited to those which fit in the FFT array).
+
+    :param s: TestSettings with processing details
+    :param mask: 2D pupil mask
+    :param me: Array engine (numpy or cupy)
+    :return: (row slice, column slice)
+    """
+    padpx = int((s.fftsize - s.phasesamples) / 2)
+    low = max(0, -padpx)
+    high = min(s.phasesamples, s.fftsize - padpx)
+    slices = []
+    for axis in (1, 0):
+        nonzero = me.flatnonzero(mask.any(axis=axis))
+        nonzero = nonzero[(nonzero >= low) * (nonzero < high)]
+        if len(nonzero) == 0:
+            slices.append(slice(low, low + 1))
+        else:
+            slices.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(slices)
+
+
+def get_mft_halfwidth(s, psf_sample_spacing, window_halfwidth_um, max_shift):
+    """
+    Get number of LSF samples either side of centre which can reach a non-zero part of the tukey window.
+
+    Resampling to the shortest wavelength only ever zooms in (factor > 1), so anything further out than the
+    window plus LCA shift (and a margin for spline support) is multiplied by zero later.
+
+    :param s: TestSettings with processing details
+    :param psf_sample_spacing: PSF sample spacing (um)
+    :param window_halfwidth_um: Half width of LSF window (um)
+    :param max_shift: Largest LCA shift in samples
+    :return: half width in samples
+    """
+    return int(np.ceil(window_halfwidth_um / psf_sample_spacing + abs(max_shift))) + MFT_MARGIN
+
+
+def lsfs_from_1d_ffts(s, wavefunction, fft=fftpack.fft, me=np, complexdtype="complex128", support=None):
+    """
+    Get both LSFs of the PSF of an unpadded wavefunction (or stack of them) using only 1D FFTs.
+
+    By Parseval's theorem the sum of |FFT2|**2 along one axis is the sum of |FFT|**2 over the other
+    (untransformed) axis, scaled by the transform length. So each LSF only needs 1D FFTs of the non-zero
+    pupil rows or columns, and the full 2D PSF is never built.
+
+    Output matches |ifftshift(fft2(fftshift(padded)))|**2 summed along each axis.
+
+    :param s: TestSettings with processing details
+    :param wavefunction: Complex pupil wavefunction(s) with phasesamples on the last two axes
+    :param fft: 1D FFT function taking axis and overwrite_x arguments
+    :param me: Array engine (numpy or cupy)
+    :param complexdtype: dtype to run FFTs in
+    :param support: (row slice, column slice) of non-zero pupil from get_support(), only these rows and columns
+                    are transformed (defaults to all)
+    :return: (impx, impy) LSFs along the last axis, matching psf.sum(axis=-1) and psf.sum(axis=-2)
+    """
+    padpx = int((s.fftsize - s.phasesamples) / 2)
+    if support is None:
+        low = max(0, -padpx)
+        high = min(s.phasesamples, s.fftsize - padpx)
+        support = slice(low, high), slice(low, high)
+    row_support, col_support = support
+    if padpx < 0:
+        # Our phase is over padded
+        wavefunction = wavefunction[..., -padpx:-padpx + s.fftsize, -padpx:-padpx + s.fftsize]
+        row_support, col_support = (slice(sl.start + padpx, sl.stop + padpx) for sl in support)
+        padpx = 0
+
+    lsfs = []
+    for fft_axis, sum_axis in ((-2, -1), (-1, -2)):
+        # Crop to the support, then pad back out to the FFT length along the transformed axis only
+        arr = wavefunction[..., row_support, col_support]
+        fft_support = row_support if fft_axis == -2 else col_support
+        padwidth = [(0, 0)] * wavefunction.ndim
+        padwidth[fft_axis] = (padpx + fft_support.start, padpx + wavefunction.shape[fft_axis] - fft_support.stop)
+        arr = me.pad(me.array(arr, dtype=complexdtype), padwidth, mode="constant")
+        arr = me.fft.fftshift(arr, axes=fft_axis)
+        arr = fft(arr, axis=fft_axis, overwrite_x=True)
+
+        power = me.absolute(arr)
+        power **= 2
+        lsf = power.sum(axis=sum_axis)
+        lsf *= s.fftsize
+        lsfs.append(me.fft.ifftshift(lsf, axes=-1))
+    return tuple(lsfs)
+
+
+def is_mirror_symmetric(s):
+    """
+    Check whether wavefunctions are mirror images of themselves about the x axis (pupil rows i and
+    phasesamples - 1 - i match), padded so that lsfs_from_mirrored_ffts() can use the symmetry.
+
+    :param s: TestSettings with processing details (used Zernikes already found)
+    :return: True if symmetric
+    """
+    if s.phasesamples % 2 or (s.fftsize - s.phasesamples) % 2 or s.fftsize < s.phasesamples:
+        return False
+    if not masks.is_mirror_symmetric(s):
+        return False
+    return all(coefficient == 0 or zernikes.is_y_even(znum)
+               for znum, coefficient in zip(s.used_zernikes, s.zernike_array_indexed))
+
+
+def lsfs_from_mirrored_ffts(s, half_wavefunction, fft=fftpack.fft, dct=scipy.fft.dct, me=np,
+                            complexdtype="complex128"):
+    """
+    Get both LSFs of a mirror symmetric wavefunction (or stack of them) from its lower half only.
+
+    As lsfs_from_1d_ffts(), but rows i and phasesamples - 1 - i are equal. Along x each row pair contributes
+    twice the power of one row. Along y each padded, fftshifted column is half-sample symmetric, so
+    |FFT|**2 over fftsize samples is |DCT-II|**2 over fftsize / 2, mirrored.
+
+    :param s: TestSettings with processing details (see is_mirror_symmetric())
+    :param half_wavefunction: Rows phasesamples // 2 onwards of the complex pupil wavefunction(s)
+    :param fft: 1D FFT function taking axis and overwrite_x arguments
+    :param dct: DCT function taking axis and overwrite_x arguments (unnormalised type II)
+    :param me: Array engine (numpy or cupy)
+    :param complexdtype: dtype to run transforms in
+    :return: (impx, impy) LSFs along the last axis, matching psf.sum(axis=-1) and psf.sum(axis=-2)
+    """
+    padpx = (s.fftsize - s.phasesamples) // 2
+    half_rows = s.fftsize // 2
+
+    # Along y, zero pad columns to half the FFT length
+    padwidth = [(0, 0)] * half_wavefunction.ndim
+    padwidth[-2] = (0, half_rows - half_wavefunction.shape[-2])
+    arr = me.pad(me.array(half_wavefunction, dtype=complexdtype), padwidth, mode="constant")
+    arr = dct(arr, axis=-2, overwrite_x=True)
+    power = me.absolute(arr)
+    power **= 2
+    half_lsf = power.sum(axis=-1)
+    impx = me.zeros(half_lsf.shape[:-1] + (s.fftsize,), dtype=half_lsf.dtype)
+    impx[..., :half_rows] = half_lsf
+    impx[..., half_rows + 1:] = half_lsf[..., :0:-1]
+    impx *= s.fftsize
+
+    # Along x, only one row of each pair
+    padwidth[-2] = (0, 0)
+    padwidth[-1] = (padpx, padpx)
+    arr = me.pad(me.array(half_wavefunction, dtype=complexdtype), padwidth, mode="constant")
+    arr = me.fft.fftshift(arr, axes=-1)
+    arr = fft(arr, axis=-1, overwrite_x=True)
+    power = me.absolute(arr)
+    power **= 2
+    impy = power.sum(axis=-2)
+    impy *= 2 * s.fftsize
+    return me.fft.ifftshift(impx, axes=-1), me.fft.ifftshift(impy, axes=-1)
+
+
+def get_mft_matrix(s, halfwidth, start, stop, me=np, complexdtype="complex128"):
+    """
+    Get DFT matrix mapping pupil samples start:stop onto the centre 2 * halfwidth + 1 LSF samples.
+
+    Matches ifftshift(fft(fftshift(padded))) for the same samples, without any zero padding.
+
+    :param s: TestSettings with processing details
+    :param halfwidth: Half width of output samples
+    :param start: First pupil sample used
+    :param stop: Stop of pupil samples used
+    :param me: Array engine (numpy or cupy)
+    :param complexdtype: dtype of matrix
+    :return: (matrix, output slice)
+    """
+    padpx = int((s.fftsize - s.phasesamples) / 2)
+    centre = s.fftsize // 2
+    out_slice = slice(max(0, centre - halfwidth), min(s.fftsize, centre + halfwidth + 1))
+
+    # Integer products so phase can be wrapped exactly before exp()
+    out_coords = np.arange(out_slice.start, out_slice.stop) - centre
+    in_coords = np.arange(start, stop) + padpx - centre
+    wrapped = np.outer(out_coords, in_coords) % s.fftsize
+    matrix = np.exp(-2j * np.pi * wrapped / s.fftsize).astype(complexdtype)
+    return me.array(matrix), out_slice
+
+
+def lsfs_from_mft(s, wavefunction, matrices, support, me=np):
+    """
+    Get both LSFs of the PSF of an unpadded wavefunction (or stack of them) using matrix DFTs.
+
+    Only LSF samples in the output slices of the matrices are computed (others are left as zero), so the exact
+    total energy of each LSF is also returned from Parseval's theorem for normalisation.
+
+    :param s: TestSettings with processing details
+    :param wavefunction: Complex pupil wavefunction(s) with phasesamples on the last two axes
+    :param matrices: ((row matrix, output slice), (column matrix, output slice)) from get_mft_matrix()
+    :param support: (row slice, column slice) of non-zero pupil
+    :param me: Array engine (numpy or cupy)
+    :return: (impx, impy, energies)
+    """
+    row_support, col_support = support
+    cropped = wavefunction[..., row_support, col_support]
+
+    (row_matrix, row_out), (col_matrix, col_out) = matrices
+    stack_shape = wavefunction.shape[:-2]
+
+    power = me.absolute(cropped)
+    power **= 2
+    energies = power.sum(axis=(-2, -1)) * s.fftsize ** 2
+
+    transformed = me.matmul(row_matrix, cropped)
+    power = me.absolute(transformed)
+    power **= 2
+    impx = me.zeros(stack_shape + (s.fftsize,), dtype=power.dtype)
+    impx[..., row_out] = power.sum(axis=-1) * s.fftsize
+
+    transformed = me.matmul(cropped, col_matrix.T)
+    power = me.absolute(transformed)
+    power **= 2
+    impy = me.zeros(stack_shape + (s.fftsize,), dtype=power.dtype)
+    impy[..., col_out] = power.sum(axis=-2) * s.fftsize
+    return impx, impy, energies
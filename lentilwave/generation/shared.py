@@ -0,0 +1,138 @@
+import atexit
+import hashlib
+import os
+import weakref
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from lentilwave import config
+
+# Shared memory blocks created by this process (name: SharedMemory), least recently used first, unlinked on
+# eviction or release
+_published = OrderedDict()
+
+# Blocks attached to in this process (name: (SharedMemory, array)), least recently used first, kept open so
+# arrays stay valid
+_attached = OrderedDict()
+
+# Evicted attached blocks (SharedMemory, weak reference to array) whose arrays may still be in use elsewhere (such
+# as a GeneratorCache), closed once they're not
+_closing = []
+
+
+def get_cube_name(phasesamples, used_zernikes, realdtype="float64"):
+    """
+    Get shared memory block name for a Zernike cube, unique to this process tree.
+
+    :param phasesamples: Pupil samples
+    :param used_zernikes: Tuple of Zernike numbers in cube
+    :param realdtype: dtype of cube
+    :return: name string
+    """
+    return "lw{}_{}".format(os.getpid(), _get_cube_digest(phasesamples, used_zernikes, realdtype))
+
+
+def _get_cube_digest(phasesamples, used_zernikes, realdtype):
+    return hashlib.md5(repr((phasesamples, tuple(used_zernikes), str(realdtype))).encode()).hexdigest()[:12]
+
+
+def publish_cube(s, realdtype=None):
+    """
+    Build the Zernike cube for these settings into shared memory (once) and record its name on the settings
+    so worker processes can attach to it with attach_cube() rather than building their own.
+
+    :param s: TestSettings with processing details
+    :param realdtype: dtype of cube (defaults to settings' precision)
+    :return: shared memory block name
+    """
+    # Avoid circular import
+    from lentilwave.generation.generate import get_phase_cache_cube
+
+    if realdtype is None:
+        realdtype = s.realdtype
+    s.get_used_zernikes()
+    name = get_cube_name(s.phasesamples, s.used_zernikes, realdtype)
+    if name in _published:
+        _published.move_to_end(name)
+    else:
+        cube = get_phase_cache_cube(s, me=np, realdtype=realdtype)
+        block = shared_memory.SharedMemory(name=name, create=True, size=cube.nbytes)
+        np.ndarray(cube.shape, dtype=cube.dtype, buffer=block.buf)[:] = cube
+        _published[name] = block
+        # Workers already attached keep their mapping, later ones build their own cube
+        while len(_published) > 1 and get_nbytes()[0] > config.SHARED_CUBE_BYTE_BUDGET:
+            _, evicted = _published.popitem(last=False)
+            evicted.close()
+            evicted.unlink()
+    s.shared_cube_name = name
+    return name
+
+
+def attach_cube(s, realdtype=None):
+    """
+    Get a zero-copy, read-only view of a cube published by publish_cube().
+
+    :param s: TestSettings with used Zernikes (shared_cube_name set by publish_cube())
+    :param realdtype: dtype of cube (defaults to settings' precision)
+    :return: cube array, or None if no cube was published
+    """
+    if realdtype is None:
+        realdtype = s.realdtype
+    name = s.shared_cube_name
+    # Published cube might be for different samples or precision
+    if name is None or not name.endswith(_get_cube_digest(s.phasesamples, s.used_zernikes, realdtype)):
+        return None
+    try:
+        cube = _attached[name][1]
+    except KeyError:
+        pass
+    else:
+        _attached.move_to_end(name)
+        return cube
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return None
+    shape = (s.phasesamples, s.phasesamples, len(s.used_zernikes))
+    cube = np.ndarray(shape, dtype=realdtype, buffer=block.buf)
+    cube.flags.writeable = False
+    _attached[name] = block, cube
+    while len(_attached) > 1 and get_nbytes()[1] > config.SHARED_CUBE_BYTE_BUDGET:
+        _, (evicted, evicted_cube) = _attached.popitem(last=False)
+        _closing.append((evicted, weakref.ref(evicted_cube)))
+        del evicted_cube
+    _close_detached()
+    return cube
+
+
+def _close_detached():
+    # Arrays don't hold a buffer export, so SharedMemory.close() would leave any still viewing the block dangling.
+    # Views keep their base cube alive, so the block is free once its cube is.
+    for item in list(_closing):
+        block, cube_ref = item
+        if cube_ref() is None:
+            block.close()
+            _closing.remove(item)
+
+
+def get_nbytes():
+    """
+    :return: (bytes published, bytes attached) by this process
+    """
+    return (sum(published.size for published in _published.values()),
+            sum(attached.size for attached, _ in _attached.values()))
+
+
+def release_published():
+    """
+    Unlink all shared memory blocks published by this process (workers still attached keep their mappings).
+    """
+    for block in _published.values():
+        block.close()
+        block.unlink()
+    _published.clear()
+
+
+atexit.register(release_published)
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class Workspace:
+    """
+    Preallocated arrays for one (fftsize, phasesamples, dtype) so the generate loop can work in place.
+
+    Arrays hold up to 'items' stacked slice/wavelength pairs, use views of the first n for smaller batches.
+    Padded FFT buffers are only allocated if the 2D FFT engine asks for them.
+    """
+    def __init__(self, fftsize, phasesamples, items, realdtype="float64", complexdtype="complex128", me=np):
+        self.fftsize = fftsize
+        self.phasesamples = phasesamples
+        self.items = items
+        self.realdtype = realdtype
+        self.complexdtype = complexdtype
+        self.me = me
+        pupilshape = (items, phasesamples, phasesamples)
+        self.phase = me.empty(pupilshape, dtype=realdtype)
+        self.scratch = me.empty(pupilshape, dtype=realdtype)
+        self.wavefunction = me.empty(pupilshape, dtype=complexdtype)
+        self._padded = None
+        self._power = None
+
+    @property
+    def padded(self):
+        if self._padded is None:
+            self._padded = self.me.zeros((self.items, self.fftsize, self.fftsize), dtype=self.complexdtype)
+        return self._padded
+
+    @property
+    def power(self):
+        if self._power is None:
+            self._power = self.me.empty((self.items, self.fftsize, self.fftsize), dtype=self.realdtype)
+        return self._power
+
+    def packed(self, array, items, npix):
+        """
+        View one of the pupil buffers as a stack of packed pupils (see packing.PupilPacking).
+
+        :return: view of shape (items, 1, npix)
+        """
+        return array.reshape(self.items, 1, -1)[:items, :, :npix]
+
+    @property
+    def nbytes(self):
+        arrays = (self.phase, self.scratch, self.wavefunction, self._padded, self._power)
+        return sum(int(arr.nbytes) for arr in arrays if arr is not None)
+
+
+def get_workspace(cache, fftsize, phasesamples, items, realdtype="float64", complexdtype="complex128", me=np,
+                  engine_string="np"):
+    """
+    Get a workspace big enough for 'items' from a cache store, making (or growing) it if needed.
+
+    :param cache: dict-like store (such as GeneratorCache.workspaces)
+    :return: Workspace
+    """
+    key = (fftsize, phasesamples, realdtype, engine_string)
+    try:
+        workspace = cache[key]
+        if workspace.items >= items:
+            return workspace
+    except KeyError:
+        pass
+    workspace = Workspace(fftsize, phasesamples, items, realdtype, complexdtype, me)
+    cache[key] = workspace
+    return workspace
+
+
+def _wrapped_segments(start, length, size):
+    """
+    Split a run of 'length' samples starting at 'start' (modulo size) into contiguous segments.
+
+    :return: list of (destination slice, source slice)
+    """
+    start %= size
+    first = min(length, size - start)
+    segments = [(slice(start, start + first), slice(0, first))]
+    if first < length:
+        segments.append((slice(0, length - first), slice(first, length)))
+    return segments
+
+
+def write_padded_shifted(out, wavefunction, fftsize, me=np):
+    """
+    Write wavefunctions into zeroed FFT buffers as fftshift(pad(wavefunction)) would leave them, without any
+    intermediate arrays. Over-sized wavefunctions are cropped to fftsize as in pad_and_distort().
+
+    :param out: Complex buffer (stack) with fftsize on the last two axes
+    :param wavefunction: Stack of wavefunctions with phasesamples on the last two axes
+    :param fftsize: FFT size
+    :param me: Array engine (numpy or cupy)
+    """
+    phasesamples = wavefunction.shape[-1]
+    padpx = int((fftsize - phasesamples) / 2)
+    if padpx < 0:
+        wavefunction = wavefunction[..., -padpx:-padpx + fftsize, -padpx:-padpx + fftsize]
+        padpx = 0
+    length = wavefunction.shape[-1]
+
+    out.fill(0)
+    # fftshift moves sample k to (k + fftsize // 2) % fftsize
+    segments = _wrapped_segments(padpx + fftsize // 2, length, fftsize)
+    for out_rows, in_rows in segments:
+        for out_cols, in_cols in segments:
+            out[..., out_rows, out_cols] = wavefunction[..., in_rows, in_cols]
@@ -0,0 +1,165 @@
+import os
+
+import numpy as np
+
+from lentilwave import config
+
+SCHEME_FRINGE = "FRINGE"
+
+# Number of Fringe terms in each basis (Z1 to Z48)
+NUM_TERMS = 48
+
+# Bases already loaded in this process, keyed by (samples, scheme, dtype)
+_bases = {}
+
+
+def get_fringe_nm(num_terms=NUM_TERMS):
+    """
+    Get (n, m) for each Fringe Zernike term, with negative m for sine terms.
+
+    Terms come in groups of equal (n + m) / 2, within which m counts down to zero with cosine before sine.
+
+    :param num_terms: Number of terms
+    :return: list of (n, m) tuples, zero indexed (Z1 first)
+    """
+    nms = []
+    group = 0
+    while len(nms) < num_terms:
+        for m in range(group, -1, -1):
+            n = 2 * group - m
+            nms.append((n, m))
+            if m:
+                nms.append((n, -m))
+        group += 1
+    return nms[:num_terms]
+
+
+def is_y_even(znum):
+    """
+    Check whether a Fringe Zernike term is unchanged by mirroring about the x axis (y to -y).
+
+    Azimuth is measured from y, so mirroring takes phi to pi - phi. cos(m phi) terms are even for even m and
+    sin(m phi) terms for odd m.
+
+    :param znum: Zernike number (Z1 first)
+    :return: True if even
+    """
+    _, m = get_fringe_nm(znum)[znum - 1]
+    return (m >= 0) == (m % 2 == 0)
+
+
+def build_fringe_basis(samples, dtype="float64", num_terms=NUM_TERMS):
+    """
+    Evaluate all Fringe Zernike terms (unnormalised) over a square grid spanning the unit circle.
+
+    Matches prysm's FringeZernike (y aligned azimuth) sampling and terms, except Z31-Z33 which deliberately
+    follow the standard definitions: prysm 0.16's have typos (Z31 repeats Z30's cos(3 phi), Z32 and Z33 use the
+    wrong radial polynomial).
+
+    :param samples: Samples across each axis
+    :param dtype: Output dtype
+    :param num_terms: Number of terms
+    :return: array of shape (num_terms, samples, samples)
+    """
+    x = np.linspace(-1, 1, samples)
+    xx, yy = np.meshgrid(x, x)
+    return evaluate_fringe_basis(xx, yy, dtype, num_terms)
+
+
+def evaluate_fringe_basis(xx, yy, dtype="float64", num_terms=NUM_TERMS):
+    """
+    Evaluate all Fringe Zernike terms (unnormalised) at arbitrary normalised pupil coordinates.
+
+    Radial polynomials come from the recurrence R(n, m) = rho * (R(n - 1, |m - 1|) + R(n - 1, m + 1)) - R(n - 2, m)
+    and azimuthal terms from Chebyshev recurrences, so nothing is evaluated term by term from scratch.
+
+    :param xx: x coordinates (any shape)
+    :param yy: y coordinates (same shape as xx), azimuth is measured from y as in prysm
+    :param dtype: Output dtype
+    :param num_terms: Number of terms
+    :return: array of shape (num_terms,) + xx.shape
+    """
+    nms = get_fringe_nm(num_terms)
+    max_n = max(n for n, _ in nms)
+
+    rho = (xx ** 2 + yy ** 2) ** 0.5
+    centre = rho == 0
+    safe_rho = np.where(centre, 1.0, rho)
+    cos_phi = np.where(centre, 1.0, yy / safe_rho)
+    sin_phi = np.where(centre, 0.0, xx / safe_rho)
+
+    # Radial polynomials for every (n, m) with n - m even
+    radial = {}
+    zero = np.zeros_like(rho)
+    for n in range(max_n + 1):
+        for m in range(n, -1, -2):
+            if m == n:
+                radial[(n, m)] = rho ** n
+            else:
+                radial[(n, m)] = rho * (radial.get((n - 1, abs(m - 1)), zero) +
+                                        radial.get((n - 1, m + 1), zero)) - radial.get((n - 2, m), zero)
+
+    # cos(m phi) and sin(m phi)
+    cos_m = [np.ones_like(rho), cos_phi]
+    sin_m = [np.zeros_like(rho), sin_phi]
+    for m in range(2, max_n + 1):
+        cos_m.append(2 * cos_phi * cos_m[-1] - cos_m[-2])
+        sin_m.append(2 * cos_phi * sin_m[-1] - sin_m[-2])
+
+    basis = np.empty((num_terms,) + rho.shape, dtype=dtype)
+    for idx, (n, m) in enumerate(nms):
+        if m >= 0:
+            basis[idx] = radial[(n, m)] * cos_m[m]
+        else:
+            basis[idx] = radial[(n, -m)] * sin_m[-m]
+    return basis
+
+
+def get_basis_path(samples, scheme=SCHEME_FRINGE, dtype="float64"):
+    if config.ZERNIKE_BASIS_CACHE_DIR is None:
+        return None
+    return os.path.join(config.ZERNIKE_BASIS_CACHE_DIR, "{}_{}_{}.npy".format(scheme.lower(), samples, np.dtype(dtype).name))
+
+
+def get_basis(samples, scheme=SCHEME_FRINGE, dtype="float64"):
+    """
+    Get Zernike basis, from memory, from a memory-mapped file on disk, or built (and saved) if neither.
+
+    :param samples: Samples across each axis
+    :param scheme: Zernike numbering scheme (only "FRINGE" supported)
+    :param dtype: dtype of basis
+    :return: array of shape (NUM_TERMS, samples, samples), one plane per term (Z1 first)
+    """
+    if scheme.upper() != SCHEME_FRINGE:
+        raise ValueError("Only {} Zernike bases are supported, not '{}'".format(SCHEME_FRINGE, scheme))
+    key = (samples, SCHEME_FRINGE, np.dtype(dtype).name)
+    try:
+        return _bases[key]
+    except KeyError:
+        pass
+
+    path = get_basis_path(samples, SCHEME_FRINGE, dtype)
+    basis = None
+    if path is not None and os.path.exists(path):
+        try:
+            basis = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            basis = None
+        if basis is not None and basis.shape != (NUM_TERMS, samples, samples):
+            basis = None
+
+    if basis is None:
+        basis = build_fringe_basis(samples, dtype)
+        if path is not None:
+            try:
+                os.makedirs(config.ZERNIKE_BASIS_CACHE_DIR, exist_ok=True)
+                # Write then rename so other processes never load a partial file
+                tmppath = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmppath, "wb") as file:
+                    np.save(file, basis)
+                os.replace(tmppath, path)
+            except OSError:
+                pass
+
+    _bases[key] = basis
+    return basis
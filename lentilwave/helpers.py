@@ -35,7 +35,19 @@ class TestSettings:
         self.guide_mtf = None
         self.q_autosize_scalar = config.Q_AUTOSIZE_SCALAR
         self.phase_autosize_scalar = config.PHASE_AUTOSIZE_SCALAR
+        self.wavelengths = config.MODEL_WVLS
+        self.spacial_freqs = config.SPACIAL_FREQS
         self.cache_sizes = True
+        self.batch_wavelengths = config.BATCH_WAVELENGTHS
+        self.engine = config.PROPAGATION_ENGINE
+        self.polychromatic_mode = config.POLYCHROMATIC_MODE
+        self.shared_cube_name = None
+        self.precision = config.PRECISION
+        self.fft_backend = config.FFT_BACKEND
+        self.fft_workers = config.FFT_WORKERS
+        self.packed_pupil = config.PACKED_PUPIL
+        self.radial_fast_path = config.RADIAL_FAST_PATH
+        self.mirror_fast_path = config.MIRROR_FAST_PATH
         if x_loc is None:
             x_loc = lentilconf.IMAGE_WIDTH / 2
         if y_loc is None:
@@ -66,6 +78,14 @@ class TestSettings:
             return None
         return self.phasesamples, self.phasesamples
 
+    @property
+    def realdtype(self):
+        return "float32" if self.precision == 32 else "float64"
+
+    @property
+    def complexdtype(self):
+        return "complex64" if self.precision == 32 else "complex128"
+
     @property
     def is_valid(self):
         if self.fftsize is None:
@@ -130,6 +150,7 @@ class TestResults:
         self.samples = None
         self.id_or_hash = None
         self.used_cuda = None
+        self.profile = None
 
         self.prysm_mtf: prysm.MTF = None
         self.psf: prysm.PSF = None
@@ -183,6 +204,21 @@ def zoom1d(inarr, factor=1.0, offset=0.0, affine_transform=ndimage.affine_transf
                              order=config.PSF_SPLINE_ORDER)
 
 
+def zoom1d_stack(inarr, factors, offsets, map_coordinates=ndimage.map_coordinates):
+    # Same as zoom1d() but applied to each row of a 2d array with its own factor and offset, in one call
+    rows, length = inarr.shape
+    factors = np.asarray(factors, dtype="float64")[:, None]
+    offsets_ = length / 2 * (1.0 - 1.0 / factors) - np.asarray(offsets, dtype="float64")[:, None] / factors
+    row_coords = np.broadcast_to(np.arange(rows)[:, None], (rows, length))
+    col_coords = np.arange(length)[None, :] / factors + offsets_
+    return map_coordinates(inarr, np.array((row_coords, col_coords)), order=config.PSF_SPLINE_ORDER)
+
+
+def get_model_wavelengths(num):
+    # Spread as config.MODEL_WVLS is
+    return np.linspace(0.42, 0.65, num + 2)[1:-1]
+
+
 def get_z9(p, modelwavelength):
     rel_wv = modelwavelength / config.BASE_WAVELENGTH
     spca = p.get('spca', 0.0) * 30
@@ -206,6 +242,24 @@ def get_z4(defocus, p, modelwavelength):
     return -(base_z4 - locadefocus - loca1defocus)
 
 
+def get_z9_derivatives(p, modelwavelength):
+    # Partial derivatives of get_z9() with respect to each parameter it uses
+    rel_wv = modelwavelength / config.BASE_WAVELENGTH
+    return dict(z9=1.0,
+                spca=((rel_wv - 1.0) + 0.028) * 30,
+                spca2=((rel_wv - 1.0) ** 2 * 10 - 0.06) * 30)
+
+
+def get_z4_derivatives(defocus, p, modelwavelength):
+    # Partial derivatives of get_z4() with respect to each (smoothly varying) parameter it uses
+    fstop_base_ratio = p['fstop'] / p['base_fstop']
+    rel_wv = modelwavelength / config.BASE_WAVELENGTH
+    return dict(df_offset=p.get('df_step', 1) * fstop_base_ratio ** 2,
+                df_step=-(defocus - p.get('df_offset', 0)) * fstop_base_ratio ** 2,
+                loca=((rel_wv - 1.0) ** 2 * 10 - 0.06) * 30,
+                loca1=((rel_wv - 1.0) + 0.027) * 30)
+
+
 def get_lca_shifts(s: TestSettings, modelwavelength, samplespacing, old=False):
     rel_wv = modelwavelength / 0.54
 
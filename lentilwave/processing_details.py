@@ -4,12 +4,14 @@ from scipy import interpolate, fftpack, optimize
 from lentil import constants_utils as lentilconf
 
 from lentilwave import config
-from lentilwave.generation import caches
+from lentilwave.generation import caches, fft_tuning
 
 
 def get_processing_details(s, cache_: caches.GeneratorCache = None):
-    if cache_ is not None and s.id_or_hash is not None and s.id_or_hash in cache_.settings:
-        stup = cache_.settings[s.id_or_hash]
+    stup = None
+    if cache_ is not None and s.id_or_hash is not None:
+        stup = cache_.settings.get(s.id_or_hash)
+    if stup is not None:
         if s.fftsize is None:
             s.fftsize = stup[0]
         if s.phasesamples is None:
@@ -27,7 +29,7 @@ def get_processing_details(s, cache_: caches.GeneratorCache = None):
     else:
         for otf in s.guide_mtf:
             freqs = np.arange(0, 65) / 64
-            zero_plus_spacial_freqs = np.concatenate(([0], config.SPACIAL_FREQS, [1.0, 2.0]))
+            zero_plus_spacial_freqs = np.concatenate(([0], s.spacial_freqs, [1.0, 2.0]))
             interpotf_real = interpolate.InterpolatedUnivariateSpline(zero_plus_spacial_freqs, np.concatenate(([1.0], otf.real, [0,0])), k=2)(freqs)
             interpotf_imag = interpolate.InterpolatedUnivariateSpline(zero_plus_spacial_freqs, np.concatenate(([1.0], otf.imag, [0,0])), k=2)(freqs)
             interpotf = interpotf_real + 1j * interpotf_imag
@@ -79,9 +81,11 @@ def get_processing_details(s, cache_: caches.GeneratorCache = None):
 
     min_fftsize = minimum_q * samples / effective_q_without_padding
 
-    for fftsize in (lentilconf.CUDA_GOOD_FFT_SIZES if s.allow_cuda else lentilconf.CPU_GOOD_FFT_SIZES):
-        if fftsize >= min_fftsize:
-            break
+    if s.allow_cuda:
+        fftsize = fft_tuning.choose_fftsize(min_fftsize, lentilconf.CUDA_GOOD_FFT_SIZES)
+    else:
+        timings = fft_tuning.get_timings(s.fft_backend, s.fft_workers, s.precision) if config.FFT_AUTOTUNE else None
+        fftsize = fft_tuning.choose_fftsize(min_fftsize, lentilconf.CPU_GOOD_FFT_SIZES, timings)
 
     s.allow_cuda = s.allow_cuda and fftsize >= s.cpu_gpu_arraysize_boundary
 
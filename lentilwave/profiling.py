@@ -0,0 +1,196 @@
+import csv
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from lentilwave import config
+
+# Fields identifying a group of comparable generate() calls
+GROUP_FIELDS = ('device', 'engine', 'fftsize', 'phasesamples', 'precision', 'fft_backend')
+
+# Columns of summary rows (see Profiler.summary())
+SUMMARY_FIELDS = GROUP_FIELDS + ('stage', 'calls', 'slices', 'total_s', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms',
+                                 'max_ms', 'peak_mb')
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_current_memory_mb(me=np):
+    """
+    Get memory currently in use, device pool memory for cupy or resident set size for numpy.
+
+    Falls back to peak resident set size where the current size isn't available.
+
+    :param me: Array engine (numpy or cupy)
+    :return: MB
+    """
+    if me is not np:
+        return me.get_default_memory_pool().used_bytes() / 2 ** 20
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class StageTimer:
+    """
+    Stage timings (and optionally memory) for one generate() call.
+
+    Call stage() at the end of each stage with the time it started. Times accumulate over repeated stages
+    (such as once per wavelength batch), memory keeps the highest level seen at the end of any of them.
+    """
+    def __init__(self, keys, me=np, sync=None, memory=None):
+        if memory is None:
+            memory = config.PROFILE_MEMORY
+        self.times = dict.fromkeys(keys, 0.0)
+        self.memory = {} if memory else None
+        self.me = me
+        self._sync = sync
+
+    def stage(self, key, start):
+        """
+        End a stage.
+
+        :param key: Timing key (such as "t_ffts")
+        :param start: time.time() at start of stage
+        """
+        if self._sync is not None:
+            self._sync()
+        self.times[key] += time.time() - start
+        if self.memory is not None:
+            self.memory[key] = max(self.memory.get(key, 0), get_current_memory_mb(self.me))
+
+    def get_profile(self, group, num_slices):
+        """
+        Get a picklable record of this call for Profiler.add().
+
+        :param group: dict of GROUP_FIELDS values
+        :param num_slices: Number of slices generated by the call
+        :return: dict
+        """
+        return dict(group=group, slices=num_slices, times=dict(self.times), memory=self.memory)
+
+
+class Profiler:
+    """
+    Aggregate generate() profiles from any number of processes by group and stage.
+
+    Counts, totals, maxima and peak memory are exact. Percentiles come from up to config.PROFILE_MAX_SAMPLES
+    samples per group and stage, kept by reservoir sampling so long runs don't grow without bound.
+    """
+    def __init__(self, max_samples=None):
+        self.max_samples = config.PROFILE_MAX_SAMPLES if max_samples is None else max_samples
+        self._stats = {}
+        self._random = random.Random(0)
+
+    def add(self, profile):
+        """
+        Add a profile record from StageTimer.get_profile().
+        """
+        group = tuple(profile['group'].get(field) for field in GROUP_FIELDS)
+        memory = profile.get('memory') or {}
+        for stage, seconds in profile['times'].items():
+            stats = self._stats.get((group, stage))
+            if stats is None:
+                stats = dict(calls=0, slices=0, total=0.0, max=0.0, peak_mb=0.0, samples=[])
+                self._stats[(group, stage)] = stats
+            stats['calls'] += 1
+            stats['slices'] += profile['slices']
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['peak_mb'] = max(stats['peak_mb'], memory.get(stage, 0))
+            samples = stats['samples']
+            if len(samples) < self.max_samples:
+                samples.append(seconds)
+            else:
+                replace = self._random.randrange(stats['calls'])
+                if replace < self.max_samples:
+                    samples[replace] = seconds
+
+    def add_results(self, results):
+        """
+        Add profiles carried by a list of TestResults (from any process).
+
+        :return: number of profiles added
+        """
+        profiles = [tr.profile for tr in results if getattr(tr, 'profile', None) is not None]
+        for profile in profiles:
+            self.add(profile)
+        return len(profiles)
+
+    def clear(self):
+        self._stats.clear()
+
+    def summary(self):
+        """
+        Get one row per group and stage, most time consuming first.
+
+        :return: list of dicts keyed as SUMMARY_FIELDS (times per call)
+        """
+        rows = []
+        for (group, stage), stats in self._stats.items():
+            row = dict(zip(GROUP_FIELDS, group))
+            percentiles = np.percentile(stats['samples'], PERCENTILES) * 1e3 if stats['samples'] else [0] * 3
+            row.update(stage=stage,
+                       calls=stats['calls'],
+                       slices=stats['slices'],
+                       total_s=stats['total'],
+                       mean_ms=stats['total'] / stats['calls'] * 1e3,
+                       max_ms=stats['max'] * 1e3,
+                       peak_mb=stats['peak_mb'])
+            for percentile, value in zip(PERCENTILES, percentiles):
+                row['p{}_ms'.format(percentile)] = float(value)
+            rows.append(row)
+        rows.sort(key=lambda row: row['total_s'], reverse=True)
+        return rows
+
+    def to_json(self, path):
+        with open(path, "w") as file:
+            json.dump(dict(created=time.strftime("%Y-%m-%dT%H:%M:%S"), stages=self.summary()), file, indent=1)
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+    def export(self, directory=None, name="profile"):
+        """
+        Write summary as both JSON and CSV.
+
+        :param directory: Output directory (defaults to config.PROFILE_EXPORT_DIR)
+        :param name: File name stem, a timestamp is appended
+        :return: (json path, csv path), or None if there is nowhere to write
+        """
+        if directory is None:
+            directory = config.PROFILE_EXPORT_DIR
+        if directory is None:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, "{}_{}".format(name, time.strftime("%Y%m%d-%H%M%S")))
+        self.to_json(stem + ".json")
+        self.to_csv(stem + ".csv")
+        return stem + ".json", stem + ".csv"
+
+    def print_summary(self, limit=20):
+        rows = self.summary()[:limit]
+        header = "{:>6} {:>7} {:>6} {:>5} {:>14} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}"
+        print(header.format("device", "engine", "fft", "prec", "stage", "calls", "total_s", "mean_ms", "p50_ms",
+                            "p90_ms", "p99_ms", "peak_mb"))
+        for row in rows:
+            print("{device:>6} {engine:>7} {fftsize:>6} {precision:>5} {stage:>14} {calls:>8} {total_s:>9.2f} "
+                  "{mean_ms:>9.2f} {p50_ms:>9.2f} {p90_ms:>9.2f} {p99_ms:>9.2f} {peak_mb:>8.0f}".format(**row))
@@ -1,3 +1,4 @@
+import inspect
 import time
 import random
 import signal
@@ -12,17 +13,26 @@ from matplotlib import animation
 from lentil import wavefront_utils
 from lentil.constants_utils import *
 from lentil.wavefront_utils import TerminateOptException
-from lentilwave.encode_decode import encode_parameter_tuple, decode_parameter_tuple
-from lentilwave import config, helpers
+from lentilwave.encode_decode import encode_parameter_tuple, decode_parameter_tuple, get_active_indices, \
+    expand_parameter_tuple
+from lentilwave import config, helpers, profiling
+from lentilwave.generation import fft_tuning, shared
+from lentilwave.generation import gradients as adjoint
 from lentil.focus_set import save_wafefront_data, scan_path, read_wavefront_file
 
-from lentilwave import generate, TestSettings, GeneratorCache
+from lentilwave import generate, generate_series, TestSettings, GeneratorCache
 
 matplotlib.use("Qt5agg")
 
 keysignal = ""
 exit_signal = False
 
+# Slice ids of each forward difference step start at a multiple of this (cauchy peak slices are offset by 10000)
+FD_ID_STRIDE = 100000
+
+# Older SciPy's least_squares() has no callback (so no progress display, plateau hand off or key signals)
+LEAST_SQUARES_CALLBACK = 'callback' in inspect.signature(optimize.least_squares).parameters
+
 
 def testme(samples, loops=16*5, Q=2, *args, **kwargs):
     for _ in range(loops):
@@ -83,7 +93,8 @@ def _wait_for_keypress():
         keysignal = f
 
 
-def _save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime, autosave=False, quiet=False):
+def _save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime, autosave=False, quiet=False,
+               schedule=None):
     if not quiet:
         print("Writing wavefront data...")
     all_p = {}
@@ -125,6 +136,12 @@ def _save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime,
     for data in dataset:
         extra["fields@{}".format(data.exif.aperture)] = list(data.focus_values)
 
+    if schedule is not None:
+        extra['schedule.stages'] = len(schedule)
+        for num, record in enumerate(schedule):
+            for key, value in record.items():
+                extra["schedule.{}.{}".format(num, key)] = value
+
     for key, value in all_p_init.items():
         outdict["p.initial:"+key] = value
 
@@ -162,6 +179,40 @@ def _save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime,
         log.warning("Results not saved!")
 
 
+def get_stage_frequency_indices(stage):
+    """
+    :param stage: dict from config.RETRIEVAL_SCHEDULE
+    :return: indices of config.SPACIAL_FREQS modelled in stage
+    """
+    return np.arange(0, len(config.SPACIAL_FREQS), stage.get('frequency_step', 1))
+
+
+def get_stage_settings(stage):
+    """
+    Get TestSettings attributes for a stage of config.RETRIEVAL_SCHEDULE.
+
+    :param stage: dict from config.RETRIEVAL_SCHEDULE
+    :return: dict of attribute: value
+    """
+    if stage.get('num_wavelengths') is None:
+        wavelengths = config.MODEL_WVLS
+    else:
+        wavelengths = helpers.get_model_wavelengths(stage['num_wavelengths'])
+    return dict(wavelengths=wavelengths,
+                spacial_freqs=config.SPACIAL_FREQS[get_stage_frequency_indices(stage)],
+                q_autosize_scalar=stage.get('q_autosize_scalar', config.Q_AUTOSIZE_SCALAR),
+                phase_autosize_scalar=stage.get('phase_autosize_scalar', config.PHASE_AUTOSIZE_SCALAR))
+
+
+def get_stage_record(stage, settings):
+    # Stage description for saved wavefront data
+    return OrderedDict([('name', stage.get('name', "")),
+                        ('wavelengths', list(settings['wavelengths'])),
+                        ('frequencies', ["{:.6f}".format(_) for _ in settings['spacial_freqs']]),
+                        ('q.autosize.scalar', settings['q_autosize_scalar']),
+                        ('phase.autosize.scalar', settings['phase_autosize_scalar'])])
+
+
 def _split_array(array, split):
     subs = []
     lastsize = 0
@@ -247,6 +298,26 @@ def _calculate_cost(modelall, chartall, split, weightsall, count=1):
             peak_mnsq * config.COST_WEIGHT_PEAK_LOCATIONS,)
 
 
+def _calculate_cost_gradient(modelall, chartall, weightsall):
+    # Gradient of _calculate_cost() with respect to each model value, as d/d(real) + 1j * d/d(imag)
+    absmodel = abs(modelall)
+    magdiffs = (absmodel - abs(chartall)) * 2
+    directions = modelall / np.where(absmodel == 0, 1, absmodel)
+    grads = (2 * (modelall - chartall) + 4 * magdiffs * directions) * weightsall / modelall.size
+    return grads * config.COST_WEIGHT_MEAN_SQUARES
+
+
+def _calculate_residuals(modelall, chartall, weightsall):
+    # Weighted residuals whose sum of squares is _calculate_cost()
+    scale = (np.broadcast_to(weightsall, modelall.shape) * config.COST_WEIGHT_MEAN_SQUARES / modelall.size) ** 0.5
+    diffs = modelall - chartall
+    magdiffs = (abs(modelall) - abs(chartall)) * 2
+    residuals = [np.real(diffs) * scale, magdiffs * scale]
+    if np.iscomplexobj(diffs):
+        residuals.append(np.imag(diffs) * scale)
+    return np.concatenate([residual.ravel() for residual in residuals])
+
+
 def _jiggle_zeds(x, passed_options_ordering):
     # print("Jiggling Zeds!")
     # print("In params:", list(x))
@@ -289,7 +360,9 @@ def _randomise_zeds(x, passed_options_ordering):
 
 
 def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, processes=None, plot_gradients_initial=None,
-                              x_loc=None, y_loc=None, complex_otf=False, avoid_ends=1):
+                              x_loc=None, y_loc=None, complex_otf=False, avoid_ends=1, solver=None):
+    if solver is None:
+        solver = config.SOLVER
     if hasattr(set[0], 'merged_mtf_values'):
         dataset = set
         if not from_scratch:
@@ -328,6 +401,7 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
     first_it_evals = 0
     total_iterations = 0
     timings = {}
+    profiler = profiling.Profiler()
     t_prep = 0
     t_calc = 0
     t_run = 0
@@ -362,6 +436,16 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
         focus_values_sequenced.append(new_focus_values)
     focus_values_concat = np.concatenate(focus_values_sequenced)
 
+    # Stages of the retrieval schedule may model a subset of frequencies (see set_stage())
+    full_chart_sag_concat = chart_sag_concat
+    full_chart_mer_concat = chart_mer_concat
+    full_weights_concat = weights_concat
+    schedule = config.RETRIEVAL_SCHEDULE
+    stage_index = 0
+    stage_settings = {}
+    stage_records = []
+    step_costs = []
+
     ######################
     # Set up live plotting
 
@@ -396,6 +480,10 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
 
     total_slices = len(focus_values_concat) + len(dataset)
 
+    if config.FFT_AUTOTUNE:
+        # Tune once here so worker processes all load the same table
+        fft_tuning.get_timings(config.FFT_BACKEND, config.FFT_WORKERS, config.PRECISION, tune_missing=True)
+
     #####################
     # Set up process pools
 
@@ -436,71 +524,22 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
     initial_ps = []
 
     last_params = None
+    last_residuals = None
+    # Weights of least_squares()' sagittal and meridional residual blocks (see set_residual_weights())
+    residual_weights = np.ones(2)
 
-    def prysmfit(*params, plot=False, return_timing_only=False, overwrite_chart_data=False):
+    def get_slice_settings(ps, onlyset, plot=False, id_base=0, include_peak=True):
         """
-        Provide inner loop for scipy optimise
+        Build settings for every slice of every focusset.
 
-        :param params: Iterable of parameters
-        :param plot: Explicitly plot results
-        :return: cost (unless return_dicts) is True
+        :param ps: Decoded parameter dicts, one per focusset
+        :param onlyset: Focusset indices to model, others are marked as dummies
+        :param id_base: Added to every slice id (to keep ids unique over several parameter sets)
+        :param include_peak: Also model the cauchy peak slice (not used by the cost)
+        :return: (list of TestSettings, focusset index of each)
         """
-        # Use outer scope for passing progress parameters
-        t = time.time()
-
-        nonlocal count
-        nonlocal it_count
-        nonlocal initial_ps
-        nonlocal prev_iterations
-        nonlocal lastcost
-        nonlocal first_it_evals
-        nonlocal last_params
-        nonlocal t_prep
-        nonlocal t_run
-        nonlocal t_calc
-        nonlocal  chart_sag_concat
-        nonlocal  chart_mer_concat
-        # Check deltas
-        orders = []
-        names = []
-        if last_params is None:
-            last_params = params[0]
-
-        for oldval, val, (pname, _, _) in zip(last_params, params[0], passed_options_ordering):
-            try:
-                if val - oldval != 0:
-                    try:
-                        orders.append(int(np.log10((val - oldval) * 0.33)))
-                    except FloatingPointError:
-                        orders.append("")
-                else:
-                    orders.append("")
-            except (ZeroDivisionError, OverflowError, ValueError):
-                orders.append("")
-            names.append(pname)
-
-        last_params = params[0]
-
-        # print(repr(params[0]))
-        ps, popt, pfix = decode_parameter_tuple(params[0], passed_options_ordering, dataset)
-
-        try:
-            onlyset = [params[1]]
-        except IndexError:
-            onlyset = list(range(len(dataset)))
-
-        arglists = [list() for _ in range(len(dataset))]
         all_arg_lst = []
-        gpu_arg_lst = []
-        cpu_arg_lst = []
-        data_for_args = []
-        all_focus_offsets = []
-
-        evalstart = time.time()
-        refs = []
-        gpu_fftsizes = []
-        cpu_fftsizes = []
-        qs = []
+        nd_for_args = []
         loop_base_fstop = min((p['fstop'] for p in ps))
         index_counter = 0
         slice_counter = -1
@@ -520,14 +559,11 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                     if key.startswith("df_each."):
                         num = int(key.split(".")[1])
                         focus_offsets[num] = value * 10
-                all_focus_offsets.append(focus_offsets)
                 focus_values = np.add(data.focus_values, focus_offsets)
             else:
-                focus_offsets = np.zeros((len(data.focus_values),))
-                all_focus_offsets.append(focus_offsets)
                 focus_values = data.focus_values
             expanded_focus_values = list(focus_values)
-            if p['fstop'] == loop_base_fstop:
+            if p['fstop'] == loop_base_fstop and include_peak:
                 sub_focus_values = expanded_focus_values + [data.cauchy_peak_x]
             else:
                 sub_focus_values = expanded_focus_values
@@ -543,7 +579,7 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                 s.mono = mono
                 s.plot = plottry
                 s.dummy = dummy
-                s.id_or_hash = index_counter + index_add
+                s.id_or_hash = id_base + index_counter + index_add
                 s.strehl_estimate = strehl_est_concat[slice_counter]
                 s.return_otf = True
                 s.return_otf_mtf = not complex_otf
@@ -552,19 +588,46 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                 s.x_loc = x_loc
                 s.y_loc = y_loc
                 s.exif = data.exif
-                if s.get_processing_details(cache_=process_details_cache).allow_cuda:
-                    gpu_arg_lst.append((s,))
-                else:
-                    cpu_arg_lst.append((s,))
+                for attr, value in stage_settings.items():
+                    setattr(s, attr, value)
                 all_arg_lst.append(s)
-
-                data_for_args.append(data)
+                nd_for_args.append(nd)
                 index_counter += 1
-        t_prep += time.time() - t
-        t = time.time()
+        return all_arg_lst, nd_for_args
+
+    def run_slices(all_arg_lst, series_keys):
+        """
+        Model slices on the pools (or in process), all in one queue per device.
+
+        :param all_arg_lst: TestSettings from get_slice_settings()
+        :param series_keys: Key for each slice, slices sharing a key go in one generate_series() job
+        :return: (TestResults sorted by id, cpu jobs, gpu jobs, seconds waiting on cpu pool)
+        """
+        gpu_arg_lst = []
+        cpu_arg_lst = []
+        gpu_series = OrderedDict()
+        cpu_series = OrderedDict()
+        for s, key in zip(all_arg_lst, series_keys):
+            if s.get_processing_details(cache_=process_details_cache).allow_cuda:
+                gpu_arg_lst.append((s,))
+                gpu_series.setdefault(key, []).append(s)
+            else:
+                cpu_arg_lst.append((s,))
+                cpu_series.setdefault(key, []).append(s)
 
         f = generate
 
+        if multi and config.SHARE_ZERNIKE_CUBES:
+            # Workers attach to these rather than each building their own
+            for settings in all_arg_lst:
+                shared.publish_cube(settings)
+
+        if config.GENERATE_SERIES:
+            # One job per focusset (on each device) so slices can share defocus independent work
+            f = generate_series
+            cpu_arg_lst = [(lst,) for lst in cpu_series.values()]
+            gpu_arg_lst = [(lst,) for lst in gpu_series.values()]
+
         if multi:
             cpures = cpupool.starmap_async(f, cpu_arg_lst)
             outcuda = cudapool.starmap(f, gpu_arg_lst)
@@ -572,21 +635,20 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
             out = cpures.get()
             cpuwait = time.time() - cpustart
             out.extend(outcuda)
+        elif config.GENERATE_SERIES:
+            out = [f(args) for args, in cpu_arg_lst + gpu_arg_lst]
+            cpuwait = 0
         else:
             out = [f(args) for args in all_arg_lst]
             cpuwait = 0
 
-        t_run += time.time() - t
-        t = time.time()
+        if config.GENERATE_SERIES:
+            out = [tr for series_out in out for tr in series_out]
 
         out.sort(key=lambda tr: tr.id_or_hash)
+        return out, cpu_arg_lst, gpu_arg_lst, cpuwait
 
-        evalrealtime = time.time() - evalstart
-        if return_timing_only:
-            return evalrealtime, cpuwait
-
-        allevaltimes.append(evalrealtime)
-
+    def record_timings(out):
         for using_cuda in [False, True]:
             timingdicts = [tr.timings for tr in out if bool(tr.used_cuda) is using_cuda]
             if using_cuda not in timings:
@@ -598,8 +660,149 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                         timings[using_cuda][key] = 0
                 for dct in timingdicts:
                     for key in timingkeys:
-                        timings[using_cuda][key] += dct[key]
+                        if isinstance(dct[key], str):
+                            # Labels such as FFT backend
+                            timings[using_cuda][key] = dct[key]
+                        elif key.startswith("m_"):
+                            # Memory levels
+                            timings[using_cuda][key] = max(timings[using_cuda][key], dct[key])
+                        else:
+                            timings[using_cuda][key] += dct[key]
+
+        # Per-stage profiles from every worker
+        profiler.add_results(out)
+
+    def get_model_cost(out, zero):
+        """
+        Get cost of modelled slices against chart data.
+
+        :param out: TestResults for the slices in the cost, in model value column order
+        :param zero: Zero offset parameter
+        :return: (cost, sagittal cost, meridional cost, sagittal and meridional model values, and with zero offset)
+        """
+        out_sag, out_tan = zip(*[tr.otf for tr in out])
+
+        model_sag_values = np.array(out_sag).T
+        model_mer_values = np.array(out_tan).T
+
+        if zero != 0:
+            offset_model_sag_values = zero + model_sag_values * (1.0 - zero)
+            offset_model_mer_values = zero + model_mer_values * (1.0 - zero)
+        else:
+            offset_model_sag_values = model_sag_values
+            offset_model_mer_values = model_mer_values
+        cost_sag, _, _, _ = _calculate_cost(offset_model_sag_values, chart_sag_concat, split, weights_concat, count)
+        cost_mer, _, _, _ = _calculate_cost(offset_model_mer_values, chart_mer_concat, split, weights_concat, count)
+        cost = (cost_sag**2 + cost_mer**2) ** 0.5
+        return (cost, cost_sag, cost_mer, model_sag_values, model_mer_values, offset_model_sag_values,
+                offset_model_mer_values)
+
+    def set_stage(index):
+        """
+        Model at the fidelity of a stage of the retrieval schedule from now on.
+
+        :param index: Index of stage in config.RETRIEVAL_SCHEDULE
+        """
+        nonlocal stage_index
+        nonlocal stage_settings
+        nonlocal chart_sag_concat
+        nonlocal chart_mer_concat
+        nonlocal weights_concat
+        nonlocal process_details_cache
+        nonlocal last_residuals
+        stage = schedule[index]
+        freq_indices = get_stage_frequency_indices(stage)
+        chart_sag_concat = full_chart_sag_concat[freq_indices]
+        chart_mer_concat = full_chart_mer_concat[freq_indices]
+        weights_concat = full_weights_concat[freq_indices]
+        stage_index = index
+        stage_settings = get_stage_settings(stage)
+        last_residuals = None
+        # Sizes differ between stages
+        process_details_cache = GeneratorCache()
+        if len(schedule) > 1:
+            print("Retrieval stage {} of {} ({})".format(index + 1, len(schedule), stage.get('name', "")))
+
+    def is_step_plateaued():
+        # Whether cost has stopped improving enough to hand off to the next step
+        if step_index >= len(steps) - 1 or len(step_costs) <= config.RETRIEVAL_PLATEAU_ITERATIONS:
+            return False
+        before = step_costs[-1 - config.RETRIEVAL_PLATEAU_ITERATIONS]
+        return before - step_costs[-1] < config.RETRIEVAL_PLATEAU_TOLERANCE * before
+
+    def prysmfit(*params, plot=False, return_timing_only=False, overwrite_chart_data=False, return_gradient=False,
+                 return_residuals=False):
+        """
+        Provide inner loop for scipy optimise
+
+        :param params: Iterable of parameters
+        :param plot: Explicitly plot results
+        :param return_gradient: Also return back propagated gradients (see adjoint_gradient())
+        :param return_residuals: Return weighted residual vector (for least_squares()) rather than cost
+        :return: cost (unless return_dicts) is True
+        """
+        # Use outer scope for passing progress parameters
+        t = time.time()
 
+        nonlocal count
+        nonlocal it_count
+        nonlocal initial_ps
+        nonlocal prev_iterations
+        nonlocal lastcost
+        nonlocal first_it_evals
+        nonlocal last_params
+        nonlocal last_residuals
+        nonlocal t_prep
+        nonlocal t_run
+        nonlocal t_calc
+        nonlocal  chart_sag_concat
+        nonlocal  chart_mer_concat
+        # Check deltas
+        orders = []
+        names = []
+        if last_params is None:
+            last_params = params[0]
+
+        for oldval, val, (pname, _, _) in zip(last_params, params[0], passed_options_ordering):
+            try:
+                if val - oldval != 0:
+                    try:
+                        orders.append(int(np.log10((val - oldval) * 0.33)))
+                    except FloatingPointError:
+                        orders.append("")
+                else:
+                    orders.append("")
+            except (ZeroDivisionError, OverflowError, ValueError):
+                orders.append("")
+            names.append(pname)
+
+        last_params = params[0]
+
+        # print(repr(params[0]))
+        ps, popt, pfix = decode_parameter_tuple(params[0], passed_options_ordering, dataset)
+
+        try:
+            onlyset = [params[1]]
+        except IndexError:
+            onlyset = list(range(len(dataset)))
+
+        evalstart = time.time()
+        all_arg_lst, nd_for_args = get_slice_settings(ps, onlyset, plot=plot)
+        t_prep += time.time() - t
+        t = time.time()
+
+        out, cpu_arg_lst, gpu_arg_lst, cpuwait = run_slices(all_arg_lst, nd_for_args)
+
+        t_run += time.time() - t
+        t = time.time()
+
+        evalrealtime = time.time() - evalstart
+        if return_timing_only:
+            return evalrealtime, cpuwait
+
+        allevaltimes.append(evalrealtime)
+
+        record_timings(out)
 
         # _, out_sag, out_tan, times, peakinesss, strehls, fftsizes = zip(*out)
 
@@ -614,25 +817,12 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
 
         # Strip out cauchy_x_peak test
 
-        out_sag, out_tan = zip(*[tr.otf for tr in out][:-1])
-
-        model_sag_values = np.array(out_sag).T
-        model_mer_values = np.array(out_tan).T
+        (cost, cost_sag, cost_mer, model_sag_values, model_mer_values, offset_model_sag_values,
+         offset_model_mer_values) = get_model_cost(out[:-1], ps[-1]['zero'])
 
         gpu_fftsizes = [tr.fftsize for tr in out[:-1] if tr.used_cuda]
         cpu_fftsizes = [tr.fftsize for tr in out[:-1] if not tr.used_cuda]
 
-        # Run cost calculations
-        if p['zero'] != 0:
-            offset_model_sag_values = p['zero'] + model_sag_values * (1.0 - p['zero'])
-            offset_model_mer_values = p['zero'] + model_mer_values * (1.0 - p['zero'])
-        else:
-            offset_model_sag_values = model_sag_values
-            offset_model_mer_values = model_mer_values
-        cost_sag, _, _, _ = _calculate_cost(offset_model_sag_values, chart_sag_concat, split, weights_concat, count)
-        cost_mer, _, _, _ = _calculate_cost(offset_model_mer_values, chart_mer_concat, split, weights_concat, count)
-        cost = (cost_sag**2 + cost_mer**2) ** 0.5
-        # cost = cost_mer
         if overwrite_chart_data:
             chart_sag_concat = offset_model_sag_values
             chart_mer_concat = offset_model_mer_values
@@ -739,9 +929,9 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                     tlist.append(("t_run", t_run))
                     tlist.append(("t_calc", t_calc))
                     for k, v in tlist:
-                        stri = "{}: {:.0f}".format(k, v)
+                        stri = "{}: {}".format(k, v) if isinstance(v, str) else "{}: {:.0f}".format(k, v)
                         strlist.append(stri.ljust(15))
-                        if k not in ['t_run']:
+                        if k.startswith("t_") and k not in ['t_run']:
                             total += v
                     strlist.insert(0, "Total: {:.0f}".format(total).ljust(20))
                     if using_cuda is False:
@@ -753,7 +943,8 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                 print("  ".join(headerstrlst))
             print("  ".join(displaystrlst))
 
-        if plot or (config.LIVE_PLOTTING and (iterations > prev_iterations or count % 2 == 0)) and plot_gradients_initial is None:
+        full_frequencies = len(chart_sag_concat) == len(full_chart_sag_concat)
+        if (plot or (config.LIVE_PLOTTING and (iterations > prev_iterations or count % 2 == 0)) and plot_gradients_initial is None) and full_frequencies:
             for chartaxespair, plotdictpair in zip(chart_axes, subplots):
                 for chart_axis, plotdict in zip(chartaxespair, plotdictpair):
                     lines = plotdict['lines']
@@ -775,9 +966,250 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
         it_count += 1
         prev_iterations = iterations
         lastcost = cost
+        if return_residuals:
+            residuals = get_residuals(offset_model_sag_values, offset_model_mer_values)
+            last_residuals = np.array(params[0], dtype="float64"), residuals
+            return residuals
+        if return_gradient:
+            grads, fd_indices = adjoint_gradient(params[0], ps, out[:-1], all_arg_lst, nd_for_args, model_sag_values,
+                                                 model_mer_values, offset_model_sag_values, offset_model_mer_values,
+                                                 cost_sag, cost_mer, ps[-1]['zero'])
+            return cost * config.HIDDEN_COST_SCALE, grads, fd_indices
         return cost * config.HIDDEN_COST_SCALE
 
+    def adjoint_gradient(x, ps, out, all_arg_lst, nd_for_args, model_sag_values, model_mer_values,
+                         offset_model_sag_values, offset_model_mer_values, cost_sag, cost_mer, zero):
+        """
+        Get gradient of the (hidden scaled) cost by back propagating through the model of each slice.
+
+        :param out: TestResults for the slices in the cost, in model value column order
+        :return: (gradient with respect to x, indices of x with no back propagated gradient)
+        """
+        grads = np.zeros(len(x))
+        all_indices = list(range(len(x)))
+        settings_by_id = {s.id_or_hash: (s, nd) for s, nd in zip(all_arg_lst, nd_for_args)}
+        for tr in out:
+            s, _ = settings_by_id[tr.id_or_hash]
+            if not s.dummy and not adjoint.is_supported(s, tr.timings.get('engine')):
+                return grads, all_indices
+
+        # Through cost = sqrt(cost_sag^2 + cost_mer^2) and zero offset
+        total = (cost_sag ** 2 + cost_mer ** 2) ** 0.5
+        if total == 0:
+            return grads, all_indices
+        cost_grads = []
+        zero_grad = 0.0
+        for axis_cost, offset_values, values, chart in ((cost_sag, offset_model_sag_values, model_sag_values,
+                                                         chart_sag_concat),
+                                                        (cost_mer, offset_model_mer_values, model_mer_values,
+                                                         chart_mer_concat)):
+            axis_grads = _calculate_cost_gradient(offset_values, chart, weights_concat)
+            axis_grads *= config.HIDDEN_COST_SCALE * axis_cost / total
+            zero_grad += np.real(np.conj(axis_grads) * (1.0 - values)).sum()
+            cost_grads.append(axis_grads * (1.0 - zero))
+
+        cpu_jobs = []
+        gpu_jobs = []
+        job_nds = []
+        for column, tr in enumerate(out):
+            s, nd = settings_by_id[tr.id_or_hash]
+            if s.dummy:
+                continue
+            job = (s, cost_grads[0][:, column], cost_grads[1][:, column])
+            (gpu_jobs if s.allow_cuda else cpu_jobs).append(job)
+            job_nds.append((s.allow_cuda, nd))
+        if multi:
+            cpures = cpupool.starmap_async(adjoint.generate_gradient, cpu_jobs)
+            gpu_grads = cudapool.starmap(adjoint.generate_gradient, gpu_jobs)
+            cpu_grads = cpures.get()
+        else:
+            cpu_grads = [adjoint.generate_gradient(*job) for job in cpu_jobs]
+            gpu_grads = [adjoint.generate_gradient(*job) for job in gpu_jobs]
+        job_nds = [nd for cuda, nd in job_nds if not cuda] + [nd for cuda, nd in job_nds if cuda]
+
+        # Sum over slices for each focusset's parameters
+        p_grads = [{} for _ in ps]
+        for nd, slice_grads in zip(job_nds, cpu_grads + gpu_grads):
+            for name, grad in slice_grads.items():
+                p_grads[nd][name] = p_grads[nd].get(name, 0.0) + grad
+        p_grads[-1]['zero'] = p_grads[-1].get('zero', 0.0) + zero_grad
+
+        # Parameters are linear in x (for a fixed fstop), so a unit step gives each one's derivative exactly
+        fd_indices = []
+        for ix, (name, _, _) in enumerate(passed_options_ordering):
+            if not (adjoint.has_gradient(name) or name == 'zero'):
+                fd_indices.append(ix)
+                continue
+            stepped = np.array(x, dtype="float64")
+            stepped[ix] += 1.0
+            stepped_ps, _, _ = decode_parameter_tuple(stepped, passed_options_ordering, dataset)
+            for p, stepped_p, p_grad in zip(ps, stepped_ps, p_grads):
+                for key, grad in p_grad.items():
+                    if key in p:
+                        grads[ix] += grad * (stepped_p[key] - p[key])
+        return grads, fd_indices
+
+    def run_finite_difference_steps(x, indices):
+        """
+        Model a forward difference step of each of some parameters.
+
+        Every perturbed parameter set's slices are submitted to the pools in one queue, so workers aren't left
+        waiting at a barrier after each perturbation.
+
+        :param x: Parameters
+        :param indices: Indices of x to step
+        :return: list of (step, decoded parameters, TestResults for the slices in the cost) for each index
+        """
+        nonlocal count
+        nonlocal t_prep
+        nonlocal t_run
+        t = time.time()
+        all_arg_lst = []
+        series_keys = []
+        steps = []
+        ps_by_batch = []
+        batch_of_id = {}
+        for batch, ix in enumerate(indices):
+            step = config.GRADIENT_FD_STEP
+            if x[ix] + step > optimise_bounds[ix][1]:
+                step = -step
+            stepped = np.array(x, dtype="float64")
+            stepped[ix] += step
+            ps, _, _ = decode_parameter_tuple(stepped, passed_options_ordering, dataset)
+            id_base = (batch + 1) * FD_ID_STRIDE
+            settings, nd_for_args = get_slice_settings(ps, list(range(len(dataset))), id_base=id_base,
+                                                       include_peak=False)
+            for s, nd in zip(settings, nd_for_args):
+                batch_of_id[s.id_or_hash] = batch
+                series_keys.append((batch, nd))
+            all_arg_lst.extend(settings)
+            steps.append(step)
+            ps_by_batch.append(ps)
+        t_prep += time.time() - t
+        t = time.time()
+
+        out, _, _, _ = run_slices(all_arg_lst, series_keys)
+        record_timings(out)
+
+        t_run += time.time() - t
+
+        outs_by_batch = [[] for _ in indices]
+        for tr in out:
+            outs_by_batch[batch_of_id[tr.id_or_hash]].append(tr)
+        count += len(indices)
+        return list(zip(steps, ps_by_batch, outs_by_batch))
+
+    def finite_difference_gradient(x, cost, indices):
+        """
+        Get forward difference gradient of the (hidden scaled) cost for some parameters.
+
+        :param x: Parameters
+        :param cost: Cost at x
+        :param indices: Indices of x to difference
+        :return: dict of index: gradient
+        """
+        nonlocal t_calc
+        steps = run_finite_difference_steps(x, indices)
+        t = time.time()
+        grads = {}
+        for ix, (step, ps, batch_out) in zip(indices, steps):
+            stepped_cost = get_model_cost(batch_out, ps[-1]['zero'])[0] * config.HIDDEN_COST_SCALE
+            grads[ix] = (stepped_cost - cost) / step
+        t_calc += time.time() - t
+        return grads
+
+    def get_residuals(offset_model_sag_values, offset_model_mer_values):
+        # Sum of squares is the (hidden scaled) residual_weights weighted sum of sagittal and meridional costs
+        residuals_sag = _calculate_residuals(offset_model_sag_values, chart_sag_concat, weights_concat)
+        residuals_mer = _calculate_residuals(offset_model_mer_values, chart_mer_concat, weights_concat)
+        return np.concatenate((residuals_sag * residual_weights[0] ** 0.5,
+                               residuals_mer * residual_weights[1] ** 0.5)) * config.HIDDEN_COST_SCALE ** 0.5
+
+    def get_residuals_costs(residuals):
+        # The (hidden scaled) sagittal and meridional costs for residuals from get_residuals()
+        return np.array([(block ** 2).sum() for block in np.split(residuals, 2)]) / residual_weights
+
+    def get_residuals_cost(residuals):
+        # The (hidden scaled) cost prysmfit() returns for residuals from get_residuals()
+        return (get_residuals_costs(residuals) ** 2).sum() ** 0.5
+
+    def set_residual_weights(x):
+        """
+        Weight the residual blocks so that at x, half their sum of squares (which least_squares() minimises) and
+        its gradient equal prysmfit()'s sqrt(cost_sag ** 2 + cost_mer ** 2) and its gradient.
+
+        The weights are then fixed, so if the balance of sagittal and meridional costs shifts during the stage
+        least_squares() converges near, but not exactly to, the L-BFGS-B minimum.
+
+        :param x: Parameters at start of stage
+        """
+        nonlocal residual_weights
+        nonlocal last_residuals
+        residual_weights = np.ones(2)
+        costs = get_residuals_costs(prysmfit(x, return_residuals=True))
+        total = (costs ** 2).sum() ** 0.5
+        if total > 0:
+            # Keep both blocks, so costs can still be recovered from residuals
+            residual_weights = np.maximum(2 * costs / total, 1e-6)
+        last_residuals = None
+
+    def residuals_jacobian(x, indices=None):
+        """
+        Get forward difference Jacobian of the residual vector (see prysmfit()) for least_squares().
+
+        :param x: Parameters
+        :param indices: Indices of x to difference (defaults to all)
+        :return: Jacobian (residuals x parameters at indices)
+        """
+        nonlocal t_calc
+        if last_residuals is not None and np.array_equal(last_residuals[0], x):
+            residuals = last_residuals[1]
+        else:
+            residuals = prysmfit(x, return_residuals=True)
+        if indices is None:
+            indices = list(range(len(x)))
+        steps = run_finite_difference_steps(x, indices)
+        t = time.time()
+        jacobian = np.empty((len(residuals), len(indices)))
+        for column, (step, ps, batch_out) in enumerate(steps):
+            offset_model_values = get_model_cost(batch_out, ps[-1]['zero'])[5:]
+            jacobian[:, column] = (get_residuals(*offset_model_values) - residuals) / step
+        t_calc += time.time() - t
+        return jacobian
+
+    def prysmfit_and_gradient(x, indices=None):
+        """
+        Get cost and its gradient, back propagated where possible and by forward differences otherwise.
+
+        :param indices: Indices of x to get gradient for (defaults to all)
+        :return: (cost, gradient for indices)
+        """
+        if indices is None:
+            indices = list(range(len(x)))
+        if config.ADJOINT_GRADIENTS:
+            cost, grads, fd_indices = prysmfit(x, return_gradient=True)
+            fd_indices = [ix for ix in fd_indices if ix in indices]
+        else:
+            cost = prysmfit(x)
+            grads = np.zeros(len(x))
+            fd_indices = indices
+        if not fd_indices:
+            return cost, grads[indices]
+        if config.BATCHED_FD_GRADIENTS:
+            for ix, grad in finite_difference_gradient(x, cost, fd_indices).items():
+                grads[ix] = grad
+            return cost, grads[indices]
+        for ix in fd_indices:
+            step = config.GRADIENT_FD_STEP
+            if x[ix] + step > optimise_bounds[ix][1]:
+                step = -step
+            stepped = np.array(x, dtype="float64")
+            stepped[ix] += step
+            grads[ix] = (prysmfit(stepped) - cost) / step
+        return cost, grads[indices]
+
     initial_guess, optimise_bounds, passed_options_ordering = encode_parameter_tuple(dataset)
+    set_stage(0)
     if plot_gradients_initial is not None and plot_gradients_initial is not False:
         if plot_gradients_initial is True:
             plot_gradients_initial = initial_guess
@@ -967,23 +1399,63 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
         global keysignal
         nonlocal it_count
         ps, popt, pfix = decode_parameter_tuple(x, passed_options_ordering, dataset)
-        _save_data(ps, initial_ps,set, dataset, lastcost,iterations+1, count, False, starttime, True, True)
+        _save_data(ps, initial_ps,set, dataset, lastcost,iterations+1, count, False, starttime, True, True,
+                   schedule=stage_records)
         last_x = x
         total_iterations += 1
         it_count = 0
         iterations += 1
+        step_costs.append(lastcost)
         if lastcost < 0.02 or keysignal.lower() in ['s', 'a', 'x']:
             if keysignal.lower() == 'a':
                 keysignal = ""
             print(keysignal)
             raise TerminateOptException()
+        if is_step_plateaued():
+            print("Cost plateaued, handing off to next step")
+            raise TerminateOptException()
         return  # lastcost > 1.0
 
+    # Steps of (retrieval stage, number of parameter groups active), parameter groups are added at the fidelity of
+    # the first stage
+    activation = config.PARAMETER_ACTIVATION
+    steps = [(0, num_groups) for num_groups in range(1, len(activation) + 1)]
+    steps += [(stage, len(activation)) for stage in range(1, len(schedule))]
+    step_index = 0
+    last_step = None
+
     fun = np.inf
     bestfun = np.inf
     while fun > 0.02 and keysignal.lower() not in ['x', 's']:
 
+        stage, num_groups = steps[step_index]
+        active_indices = get_active_indices(passed_options_ordering, activation, num_groups)
+        if (not active_indices or (stage, active_indices) == last_step) and step_index < len(steps) - 1:
+            # Nothing new to fit
+            step_index += 1
+            continue
+        last_step = stage, active_indices
+        if stage != stage_index:
+            set_stage(stage)
+        record = get_stage_record(schedule[stage], stage_settings)
+        record['parameters'] = [passed_options_ordering[ix][0] for ix in active_indices]
+        stage_records.append(record)
+        if len(steps) > 1:
+            print("Fitting {} of {} parameters".format(len(active_indices), len(passed_options_ordering)))
+
+        frozen_guess = np.array(initial_guess, dtype="float64")
+
+        def expand(active_x):
+            return expand_parameter_tuple(active_x, frozen_guess, active_indices)
+
+        def active_callback(active_x, *args):
+            return callback(expand(active_x))
+
+        active_guess = frozen_guess[active_indices]
+        active_bounds = [optimise_bounds[ix] for ix in active_indices]
+        step_costs = []
         iterations = 0
+        options['maxiter'] = schedule[stage].get('max_iterations', config.MAXITER)
         try:
             # raise TerminateOptException()
             # opt = optimize.basinhopping(prysmfit,
@@ -1004,13 +1476,21 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
                     print(data.secret_ground_truth)
                     hidden = True
 
+            def export_profile(*args, **kwargs):
+                paths = profiler.export()
+                if paths is not None:
+                    profiler.print_summary()
+                    print("Profile written to {} and {}".format(*paths))
+
             def close_pools_and_exit(*args, **kwargs):
+                export_profile()
                 cudapool.close()
                 cpupool.close()
                 cudapool.terminate()
                 cpupool.terminate()
                 cudapool.join()
                 cpupool.join()
+                shared.release_published()
                 exit()
 
             def raise_exit_flag(*args, **kwargs):
@@ -1022,8 +1502,12 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
             signal.signal(signal.SIGTERM, raise_exit_flag)
             signal.signal(signal.SIGINT, raise_exit_flag)
             signal.signal(signal.SIGQUIT, raise_exit_flag)
+            if hasattr(signal, "SIGUSR1"):
+                # kill -USR1 <pid> to write the profile so far
+                signal.signal(signal.SIGUSR1, export_profile)
 
-            initial_ps, _, _ = decode_parameter_tuple(initial_guess, passed_options_ordering, dataset)
+            if step_index == 0:
+                initial_ps, _, _ = decode_parameter_tuple(initial_guess, passed_options_ordering, dataset)
 
             # opt = optimize.basinhopping(prysmfit, initial_guess,
             #                             minimizer_kwargs=dict(method='L-BFGS-b', options=options, bounds=optimise_bounds,callback=callback),
@@ -1034,12 +1518,32 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
             #                         options=dict(maxiter=5000, maxfev=15000), callback=callback)
             # opt = optimize.minimize(prysmfit, initial_guess, method="COBYLA", bounds=optimise_bounds,
             #                         options=dict(), callback=callback)
-            opt = optimize.minimize(prysmfit, initial_guess, method="L-BFGS-B", bounds=optimise_bounds,
-                                    options=options, callback=callback)
+            if solver == "least_squares":
+                lower, upper = np.array(active_bounds).T
+                set_residual_weights(expand(np.clip(active_guess, lower, upper)))
+                least_squares_options = dict(callback=active_callback) if LEAST_SQUARES_CALLBACK else {}
+                # max_nfev counts residual evaluations, one per iteration and one per rejected trust region step
+                # (Jacobians aren't counted), so this allows maxiter iterations only if no steps are rejected.
+                # L-BFGS-B's maxiter doesn't count its line search evaluations.
+                opt = optimize.least_squares(lambda x: prysmfit(expand(x), return_residuals=True),
+                                             np.clip(active_guess, lower, upper),
+                                             jac=lambda x: residuals_jacobian(expand(x), active_indices),
+                                             bounds=(lower, upper), method="trf", max_nfev=options['maxiter'],
+                                             **least_squares_options)
+                # Report cost and iterations as minimize() would (one Jacobian per accepted step)
+                opt.fun = get_residuals_cost(opt.fun)
+                opt.nit = iterations if LEAST_SQUARES_CALLBACK else opt.njev
+            elif config.ADJOINT_GRADIENTS or config.BATCHED_FD_GRADIENTS:
+                opt = optimize.minimize(lambda x: prysmfit_and_gradient(expand(x), active_indices), active_guess,
+                                        method="L-BFGS-B", jac=True, bounds=active_bounds, options=options,
+                                        callback=active_callback)
+            else:
+                opt = optimize.minimize(lambda x: prysmfit(expand(x)), active_guess, method="L-BFGS-B",
+                                        bounds=active_bounds, options=options, callback=active_callback)
             # opt = optimize.minimize(prysmfit, initial_guess, method="trust-constr", bounds=optimise_bounds,
             #                         options=dict(), callback=callback)
             fun = opt.fun / config.HIDDEN_COST_SCALE
-            x = opt.x
+            x = expand(opt.x)
             try:
                 nit = opt.nit
             except AttributeError:
@@ -1054,7 +1558,17 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
             x = last_x
             success = True
 
+        stage_records[-1].update([('num.iterations', nit), ('total.num.fevals', count), ('final.cost', fun)])
+        if step_index < len(steps) - 1 and keysignal.lower() not in ['x', 's']:
+            # Warm start next step
+            step_index += 1
+            initial_guess = x
+            fun = np.inf
+            continue
+
         print('==== FINISHED ====')
+        # Later fits publish their own
+        shared.release_published()
 
         ps, popt, pfix = decode_parameter_tuple(x, passed_options_ordering, dataset)
 
@@ -1062,7 +1576,7 @@ def estimate_wavefront_errors(set, fs_slices=16, skip=1, from_scratch=False, pro
 
         if (fun < bestfun or keysignal.lower() in ['s']) and keysignal.lower() not in ['a', 'x']:
             bestfun = fun
-            _save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime)
+            _save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime, schedule=stage_records)
 
         if hidden:
             compare_hidden(ps)
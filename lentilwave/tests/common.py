@@ -0,0 +1,42 @@
+import numpy as np
+
+from lentil import constants_utils as lentilconf
+
+from lentilwave import generate, TestSettings
+
+# Small pupils and FFTs keep the reference 2D FFT model quick
+PHASESAMPLES = 64
+FFTSIZE = 128
+
+CENTRE = dict(x_loc=lentilconf.IMAGE_WIDTH / 2, y_loc=lentilconf.IMAGE_HEIGHT / 2)
+OFF_AXIS = dict(x_loc=3500, y_loc=2500)
+
+# Rotationally symmetric aberrations only, then with astigmatism and coma
+SYMMETRIC_P = dict(fstop=2.0, base_fstop=2.0, df_offset=0.3, df_step=0.5, z9=0.05, loca=0.1, spca=0.05)
+ASYMMETRIC_P = dict(SYMMETRIC_P, z5=0.03, z7=0.02, z8=-0.02)
+
+
+def make_settings(p, defocus=0.0, loc=OFF_AXIS, **attributes):
+    """
+    Get CPU TestSettings at the test sizes, with pixel vignetting off so centre fields are symmetric.
+
+    :param attributes: Other TestSettings attributes to set
+    """
+    s = TestSettings(dict(p), defocus=defocus, **loc)
+    s.allow_cuda = False
+    s.pixel_vignetting = False
+    s.radial_fast_path = False
+    s.mirror_fast_path = False
+    s.phasesamples = PHASESAMPLES
+    s.fftsize = FFTSIZE
+    for name, value in attributes.items():
+        setattr(s, name, value)
+    return s
+
+
+def get_otfs(p, defocus=0.0, loc=OFF_AXIS, **attributes):
+    """
+    :return: (sagittal, tangential) OTFs from generate() as an array, and the engine used
+    """
+    tr = generate(make_settings(p, defocus, loc, **attributes))
+    return np.array(tr.otf), tr.timings['engine']
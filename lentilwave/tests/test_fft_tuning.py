@@ -0,0 +1,21 @@
+import pytest
+
+from lentilwave import config
+from lentilwave.generation import fft_tuning
+
+
+def test_autotune_needs_tuning_dir(monkeypatch):
+    monkeypatch.setattr(config, "FFT_TUNING_DIR", None)
+    with pytest.raises(ValueError):
+        fft_tuning.get_timings(config.FFT_BACKEND, config.FFT_WORKERS, config.PRECISION, tune_missing=True)
+
+
+def test_tuned_table_saved(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "FFT_TUNING_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "FFT_TUNING_MIN_TIME", 0.0)
+    monkeypatch.setattr(fft_tuning.lentilconf, "CPU_GOOD_FFT_SIZES", (32, 48, 64))
+    timings = fft_tuning.get_timings(config.FFT_BACKEND, 1, 64, tune_missing=True)
+    assert sorted(timings) == [32, 48, 64]
+    fft_tuning._tables.clear()
+    assert fft_tuning.get_timings(config.FFT_BACKEND, 1, 64) == timings
+    assert fft_tuning.choose_fftsize(40, (32, 48, 64), timings) in (48, 64)
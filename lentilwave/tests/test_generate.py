@@ -0,0 +1,32 @@
+import numpy as np
+
+from lentilwave import generate, generate_series
+from lentilwave.tests.common import ASYMMETRIC_P, make_settings
+
+DEFOCUS_VALUES = (-1.0, 0.5)
+
+
+def test_series_matches_generate():
+    template = make_settings(ASYMMETRIC_P)
+    results = generate_series(template, DEFOCUS_VALUES)
+    for defocus, tr in zip(DEFOCUS_VALUES, results):
+        np.testing.assert_allclose(tr.otf, generate(make_settings(ASYMMETRIC_P, defocus)).otf, rtol=0, atol=1e-12)
+
+
+def test_series_leaves_settings_alone():
+    template = make_settings(ASYMMETRIC_P, defocus=0.2)
+    generate_series(template, DEFOCUS_VALUES)
+    assert template.defocus == 0.2
+
+    settings = [make_settings(ASYMMETRIC_P, defocus=0.2) for _ in DEFOCUS_VALUES]
+    generate_series(settings, DEFOCUS_VALUES)
+    assert [s.defocus for s in settings] == [0.2, 0.2]
+    assert all(s.p == ASYMMETRIC_P and s.p is not settings[0].p for s in settings[1:])
+
+
+def test_series_cache_counts_whole():
+    results = generate_series(make_settings(ASYMMETRIC_P), DEFOCUS_VALUES)
+    assert results[0].timings['c_hits'] + results[0].timings['c_misses'] > 0
+    for tr in results:
+        assert all(float(tr.timings[key]).is_integer() for key in ('c_hits', 'c_misses', 'c_evictions'))
+    assert all(tr.timings['c_hits'] == tr.timings['c_misses'] == 0 for tr in results[1:])
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from lentilwave import helpers
+from lentilwave.generation import gradients
+from lentilwave.tests.common import ASYMMETRIC_P, CENTRE, OFF_AXIS, SYMMETRIC_P, get_otfs, make_settings
+
+DEFOCUS_VALUES = (-1.0, 0.5)
+FD_STEP = 1e-6
+
+
+@pytest.fixture(autouse=True)
+def direct_otf_sampling(monkeypatch):
+    # Adjoint gradients follow the direct DFT sampling path
+    monkeypatch.setattr(gradients.config, "DIRECT_OTF_SAMPLING", True)
+
+
+def get_cost(p, targets, loc, **attributes):
+    return sum((np.abs(get_otfs(p, defocus, loc, **attributes)[0] - target) ** 2).sum()
+               for defocus, target in zip(DEFOCUS_VALUES, targets))
+
+
+@pytest.mark.parametrize("p, loc, attributes", [(SYMMETRIC_P, CENTRE, {}),
+                                                 (SYMMETRIC_P, CENTRE, dict(mirror_fast_path=True)),
+                                                 (ASYMMETRIC_P, CENTRE, {}),
+                                                 (ASYMMETRIC_P, OFF_AXIS, {})],
+                         ids=["symmetric-centre", "symmetric-centre-mirror", "asymmetric-centre",
+                              "asymmetric-off-axis"])
+@pytest.mark.parametrize("return_otf_mtf", [False, True], ids=["otf", "mtf"])
+def test_gradient_matches_finite_differences(p, loc, attributes, return_otf_mtf):
+    attributes = dict(attributes, return_otf_mtf=return_otf_mtf)
+    targets = [get_otfs(dict(p, z9=0.07, z6=0.01), defocus, loc, **attributes)[0] for defocus in DEFOCUS_VALUES]
+    grads = {}
+    for defocus, target in zip(DEFOCUS_VALUES, targets):
+        otf, engine = get_otfs(p, defocus, loc, **attributes)
+        assert gradients.is_supported(make_settings(p, defocus, loc, **attributes), engine)
+        slice_grads = gradients.generate_gradient(make_settings(p, defocus, loc, **attributes),
+                                                  *(2 * (otf - target)))
+        for name, grad in slice_grads.items():
+            grads[name] = grads.get(name, 0.0) + grad
+
+    for name in set(p) & set(gradients.GRADIENT_PARAMS):
+        fd = (get_cost(dict(p, **{name: p[name] + FD_STEP}), targets, loc, **attributes) -
+              get_cost(dict(p, **{name: p[name] - FD_STEP}), targets, loc, **attributes)) / (2 * FD_STEP)
+        assert grads[name] == pytest.approx(fd, rel=1e-5, abs=1e-8), name
+
+
+@pytest.mark.parametrize("order", [1, 3])
+@pytest.mark.parametrize("factor, offset", [(1.001, 0.0), (1.3, 0.4), (1.001, -5.2), (1.2, 30.0)])
+def test_zoom_vjp(monkeypatch, order, factor, offset):
+    # Samples run off each end for the larger offsets
+    monkeypatch.setattr(gradients.config, "PSF_SPLINE_ORDER", order)
+    length = 64
+    # Row n is the resampled unit impulse at n
+    matrix = helpers.zoom1d_stack(np.eye(length), np.full(length, factor), np.full(length, offset))
+    cotangent = np.random.default_rng(0).normal(size=length)
+    np.testing.assert_allclose(gradients.zoom_vjp(cotangent, factor, offset), matrix @ cotangent, rtol=0, atol=1e-12)
+
+
+def test_approximate_engines_unsupported():
+    # Symmetric pupils take the Hankel path, so its cost isn't the model generate_gradient() differentiates
+    s = make_settings(SYMMETRIC_P, loc=CENTRE, radial_fast_path=True)
+    assert not gradients.is_supported(s)
+    _, engine = get_otfs(SYMMETRIC_P, loc=CENTRE, radial_fast_path=True)
+    assert not gradients.is_supported(s, engine)
+    assert gradients.is_supported(make_settings(ASYMMETRIC_P, loc=OFF_AXIS, radial_fast_path=True))
+
+    for engine in ("mft", "auto"):
+        assert not gradients.is_supported(make_settings(ASYMMETRIC_P, engine=engine))
+    assert gradients.is_supported(make_settings(ASYMMETRIC_P), "mirror")
+    assert not gradients.is_supported(make_settings(ASYMMETRIC_P), "mft")
+
+
+def test_spline_otf_sampling_unsupported(monkeypatch):
+    monkeypatch.setattr(gradients.config, "DIRECT_OTF_SAMPLING", False)
+    assert not gradients.is_supported(make_settings(ASYMMETRIC_P), "fft2")
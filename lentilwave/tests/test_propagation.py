@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from lentilwave.generation import propagation
+from lentilwave.generation.generate import pad_and_distort
+from lentilwave.tests.common import ASYMMETRIC_P, CENTRE, OFF_AXIS, SYMMETRIC_P, get_otfs, make_settings
+
+FIELDS = [(SYMMETRIC_P, CENTRE), (ASYMMETRIC_P, OFF_AXIS)]
+FIELD_IDS = ["symmetric-centre", "asymmetric-off-axis"]
+
+# (phasesamples, fftsize), padded and over padded (cropped) pupils
+SIZES = [(64, 128), (64, 48)]
+
+
+def get_pupil(s, seed=0):
+    # Random phase in an off centre circle, so support isn't the whole pupil or symmetric
+    coords = np.linspace(-1, 1, s.phasesamples)
+    mask = (coords[None, :] - 0.2) ** 2 + (coords[:, None] + 0.1) ** 2 < 0.6 ** 2
+    phase = np.random.default_rng(seed).normal(size=s.phaseshape)
+    return np.exp(1j * phase) * mask, mask
+
+
+def get_fft2_lsfs(s, wavefunction):
+    psf = np.abs(np.fft.ifftshift(np.fft.fft2(np.fft.fftshift(pad_and_distort(s, wavefunction))))) ** 2
+    return psf.sum(axis=-1), psf.sum(axis=-2)
+
+
+@pytest.mark.parametrize("phasesamples, fftsize", SIZES)
+def test_lsfs_from_1d_ffts(phasesamples, fftsize):
+    s = make_settings(ASYMMETRIC_P, phasesamples=phasesamples, fftsize=fftsize)
+    wavefunction, mask = get_pupil(s)
+    support = propagation.get_support(s, mask)
+    reference = get_fft2_lsfs(s, wavefunction)
+    for lsfs in (propagation.lsfs_from_1d_ffts(s, wavefunction),
+                 propagation.lsfs_from_1d_ffts(s, wavefunction, support=support)):
+        for lsf, reference_lsf in zip(lsfs, reference):
+            np.testing.assert_allclose(lsf, reference_lsf, rtol=0, atol=1e-10 * reference_lsf.max())
+
+
+@pytest.mark.parametrize("p, loc", FIELDS, ids=FIELD_IDS)
+@pytest.mark.parametrize("return_otf_mtf", [False, True], ids=["otf", "mtf"])
+def test_lsf_engine(p, loc, return_otf_mtf):
+    reference, _ = get_otfs(p, 0.5, loc, return_otf_mtf=return_otf_mtf)
+    otfs, engine = get_otfs(p, 0.5, loc, return_otf_mtf=return_otf_mtf, engine=propagation.ENGINE_LSF)
+    assert engine == propagation.ENGINE_LSF
+    np.testing.assert_allclose(otfs, reference, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("p, loc", FIELDS, ids=FIELD_IDS)
+def test_mft_engine(p, loc):
+    # Cropped to the LSF window, so only close to the 2D FFT
+    reference, _ = get_otfs(p, 0.5, loc)
+    otfs, engine = get_otfs(p, 0.5, loc, engine=propagation.ENGINE_MFT)
+    assert engine == propagation.ENGINE_MFT
+    np.testing.assert_allclose(otfs, reference, rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize("mft_relative_speed, support_samples, expected", [(1.0, 48, propagation.ENGINE_FFT2),
+                                                                           (1.0, 16, propagation.ENGINE_LSF),
+                                                                           (1e6, 48, propagation.ENGINE_MFT)])
+def test_choose_engine(monkeypatch, mft_relative_speed, support_samples, expected):
+    monkeypatch.setattr(propagation.config, "MFT_RELATIVE_SPEED", mft_relative_speed)
+    s = make_settings(ASYMMETRIC_P, phasesamples=64, fftsize=48)
+    support = (slice(0, support_samples), slice(0, support_samples))
+    assert propagation.choose_engine(s, mft_halfwidth=32, support=support) == expected
+
+
+@pytest.mark.parametrize("p, loc", FIELDS, ids=FIELD_IDS)
+def test_auto_engine(p, loc):
+    reference, _ = get_otfs(p, 0.5, loc)
+    otfs, engine = get_otfs(p, 0.5, loc, engine=propagation.ENGINE_AUTO)
+    assert engine in (propagation.ENGINE_FFT2, propagation.ENGINE_LSF, propagation.ENGINE_MFT)
+    np.testing.assert_allclose(otfs, reference, rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize("return_otf_mtf", [False, True], ids=["otf", "mtf"])
+def test_hankel_engine(return_otf_mtf):
+    # Approximate, the error is largest at these small sizes
+    reference, _ = get_otfs(SYMMETRIC_P, 0.5, CENTRE, return_otf_mtf=return_otf_mtf)
+    otfs, engine = get_otfs(SYMMETRIC_P, 0.5, CENTRE, return_otf_mtf=return_otf_mtf, radial_fast_path=True)
+    assert engine == propagation.ENGINE_HANKEL
+    np.testing.assert_allclose(otfs, reference, rtol=0, atol=3e-3)
+
+
+@pytest.mark.parametrize("return_otf_mtf", [False, True], ids=["otf", "mtf"])
+def test_mirror_engine(return_otf_mtf):
+    reference, _ = get_otfs(SYMMETRIC_P, 0.5, CENTRE, return_otf_mtf=return_otf_mtf)
+    otfs, engine = get_otfs(SYMMETRIC_P, 0.5, CENTRE, return_otf_mtf=return_otf_mtf, mirror_fast_path=True)
+    assert engine == propagation.ENGINE_MIRROR
+    np.testing.assert_allclose(otfs, reference, rtol=0, atol=1e-12)
+
+    # Asymmetric fields aren't mirror images, so take the usual path
+    _, engine = get_otfs(ASYMMETRIC_P, 0.5, OFF_AXIS, return_otf_mtf=return_otf_mtf, mirror_fast_path=True)
+    assert engine == propagation.ENGINE_FFT2
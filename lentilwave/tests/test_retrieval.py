@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from lentil.constants_utils import EXIF, FocusSetData
+
+from lentilwave import config, generate, retrieval, TestSettings
+
+FOCUS_VALUES = np.arange(2.0, 7.0)
+TRUE_P = dict(df_offset=4.0, df_step=0.3, z5=0.06, z9=0.07, spca=0.08)
+LOC = dict(x_loc=3500, y_loc=2500)
+
+
+class Saved(Exception):
+    pass
+
+
+def make_focusset(fstop, p):
+    data = FocusSetData()
+    data.exif = EXIF()
+    data.exif.aperture = fstop
+    data.focus_values = FOCUS_VALUES
+    data.cauchy_peak_x = FOCUS_VALUES.mean()
+    otfs = []
+    for defocus in FOCUS_VALUES:
+        s = TestSettings(dict(p, fstop=fstop, base_fstop=fstop, zero=0.0), defocus=defocus, **LOC)
+        s.allow_cuda = False
+        s.return_otf_mtf = True
+        otfs.append(generate(s).otf)
+    data.sag_mtf_values, data.mer_mtf_values = (np.array(axis_otfs).T for axis_otfs in zip(*otfs))
+    data.merged_mtf_values = (data.sag_mtf_values + data.mer_mtf_values) / 2
+    data.strehl_ests = np.full(len(FOCUS_VALUES), 0.5)
+    data.weights = np.ones_like(data.sag_mtf_values)
+    return data
+
+
+@pytest.fixture
+def quiet_retrieval(monkeypatch):
+    monkeypatch.setattr(config, "DISABLE_MULTIPROCESSING", True)
+    monkeypatch.setattr(config, "LIVE_PLOTTING", False)
+    monkeypatch.setattr(config, "MAXITER", 2)
+    # No figures in tests
+    monkeypatch.setattr(retrieval, "plot_pause_replacement", lambda interval: None)
+
+    def save_data(ps, initial_ps, set, dataset, fun, nit, nfev, success, starttime, autosave=False, quiet=False,
+                  schedule=None):
+        # Stop at the first result rather than restarting with shuffled Zernikes
+        if not autosave:
+            raise Saved(fun, nit, nfev, schedule)
+
+    monkeypatch.setattr(retrieval, "_save_data", save_data)
+
+
+def test_least_squares_retrieval(quiet_retrieval, monkeypatch):
+    least_squares = retrieval.optimize.least_squares
+    costs = []
+
+    def recording_least_squares(fun, x0, **kwargs):
+        result = least_squares(fun, x0, **kwargs)
+        costs.append((0.5 * (fun(x0) ** 2).sum(), result.cost))
+        return result
+
+    monkeypatch.setattr(retrieval.optimize, "least_squares", recording_least_squares)
+    with pytest.raises(Saved) as saved:
+        retrieval.estimate_wavefront_errors([make_focusset(2.0, TRUE_P)], from_scratch=True, solver="least_squares",
+                                            **LOC)
+    fun, nit, nfev, schedule = saved.value.args
+    assert costs
+    assert all(final <= initial for initial, final in costs)
+    assert costs[-1][1] < costs[0][0]
+    assert np.isfinite(fun) and nfev > 0
+    assert fun == schedule[-1]['final.cost']
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from lentilwave.generation import shared
+from lentilwave.generation.generate import get_phase_cache_cube
+from lentilwave.tests.common import ASYMMETRIC_P, make_settings
+
+SAMPLES = (16, 24, 32)
+
+
+@pytest.fixture
+def small_budget(monkeypatch):
+    # Room for the two larger cubes only
+    monkeypatch.setattr(shared.config, "SHARED_CUBE_BYTE_BUDGET", get_nbytes(SAMPLES[1]) + get_nbytes(SAMPLES[2]))
+    yield
+    shared.release_published()
+    shared._attached.clear()
+    shared._close_detached()
+
+
+def get_settings(samples):
+    return make_settings(ASYMMETRIC_P, phasesamples=samples).get_used_zernikes()
+
+
+def get_nbytes(samples):
+    return samples ** 2 * len(get_settings(samples).used_zernikes) * 8
+
+
+def test_published_cubes_bounded(small_budget):
+    names = [shared.publish_cube(get_settings(samples), "float64") for samples in SAMPLES]
+    assert list(shared._published) == names[1:]
+    # Evicted blocks are unlinked, so workers build their own
+    s = get_settings(SAMPLES[0])
+    s.shared_cube_name = names[0]
+    assert shared.attach_cube(s, "float64") is None
+
+    s = get_settings(SAMPLES[2])
+    s.shared_cube_name = names[2]
+    np.testing.assert_array_equal(shared.attach_cube(s, "float64"), get_phase_cache_cube(s))
+
+    shared.release_published()
+    assert not shared._published
+    assert shared.get_nbytes()[0] == 0
+
+
+def test_attached_cubes_bounded(small_budget):
+    settings = [get_settings(samples) for samples in SAMPLES]
+    for s in settings:
+        shared.publish_cube(s, "float64")
+    # Then room for one attached cube, as in a worker
+    shared.config.SHARED_CUBE_BYTE_BUDGET = get_nbytes(SAMPLES[2])
+    cubes = [shared.attach_cube(s, "float64") for s in settings[1:]]
+    assert list(shared._attached) == [settings[2].shared_cube_name]
+    assert shared.get_nbytes()[1] == get_nbytes(SAMPLES[2])
+
+    # Closing waits until evicted cubes aren't referenced
+    assert len(shared._closing) == 1
+    del cubes
+    shared._close_detached()
+    assert not shared._closing
@@ -1,84 +1,35 @@
 import cProfile
-import lentil
-import prysm
-import prysm as prysmc
-import numpy as np
+import os
 import pstats
-from lentil.constants_utils import *
-from lentil.wavefront_test__old import try_wavefront
-from lentil.wavefront_config__old import SPACIAL_FREQS
-from lentil import wavefront_config__old
-
-BASE_PATH = "/home/sam/nashome/MTFMapper Stuff/"
-
-PATHS = [
-    "Bernard/",
-
-    "56mm/f1.2/",
-    "56mm/f2.8/",
-    "56mm/f5.6/",
-    "56mm/f8/",]
-
-# focusset = lentil.FocusSet(fallback_results_path(os.path.join(BASE_PATH, PATHS[2]), 3), include_all=1,
-#                            use_calibration=1)
-e = np
-import cupy as cp
-
-# phase = cp.array(pupil.change_phase_unit(to='waves', inplace=False))
-# prysmc.config.backend = 'cuda'
-
-
-def fcn():
-    """Complex wavefunction associated with the pupil."""
-
-    pupil = prysmc.NollZernike(z4=0.1, z5=0.1, z6=0.1, z7=0.1, mask_target='none', samples=256)
-    psf = prysmc.PSF.from_pupil(pupil, efl=28, Q=2)
-
-    # fcn = e.exp(1j * 2 * e.pi * phase)  # phase implicitly in units of waves, no 2pi/l
-    # guard against nans in phase
-    # fcn[e.isnan(phase)] = 0
-
-    # if pupil.mask_target in ('fcn', 'both'):
-    #     fcn *= pupil._mask
-
-    # return fcn
-
-# m= prysm.MTF.from_psf(psf)
-
-# sag_x, sag_mod = m.sag
-# zkwargs = {'z9': 0.057499999999999996, 'z10': 0.057499999999999996, 'z11': 0.057499999999999996, 'z12': 0.057499999999999996}
-
-# prysm.config.backend = "cuda"
-# prysm.config.precision = 32
-
-def runme():
-    for _ in range(50):
-        # fcn()
-        # prysm.config.backend = 'numpy'
-        # prysm.config.precision = wavefront_config.PRECISION
-        # pupil = prysm.NollZernike(z4=0.1, z5=0.1, z6=0.1, z7=0.1, mask_target='none', samples=256)
-        # for _ in range(7):
-        #     pupil = prysm.FringeZernike(Z4=0.1,
-        #                                 dia=10, norm=True,
-        #                                 wavelength=0.5,
-        #                                 opd_unit="um",
-        #                                 samples=256,
-        #                                 **{'z9': 0.057499999999999996, 'z10': 0.057499999999999996,
-        #                                    'z11': 0.057499999999999996,
-        #                                    'z12': 0.057499999999999996})
-        # print(pupil.phase)
-        try_wavefront(10, dict(df_offset=10, df_step=0.1, z9=0.1, z10=0.1, z11=0.1, z12=0.1, base_fstop=2.0, fstop=2.0), samples=256, mono=False)
-        # sag_x, sag_mod = m.sag
-        # sag_x = cp.asnumpy(sag_x)
-        # sag_mod = cp.asnumpy(sag_mod)
-        # interpfn = interpolate.InterpolatedUnivariateSpline(cp.asnumpy(sag_x), cp.asnumpy(sag_mod), k=1)
-        # interpfn = interpolate.InterpolatedUnivariateSpline(sag_x, sag_mod, k=1)
-        # a = interpfn(SPACIAL_FREQS / DEFAULT_PIXEL_SIZE * 1e-3)
-
-for _ in range(1):
-    runme()
-
-cProfile.run('runme()', 'profilestats')
-p = pstats.Stats('profilestats')
-p.strip_dirs().sort_stats('cumulative').print_stats()
-p.strip_dirs().sort_stats('time').print_stats()
\ No newline at end of file
+import sys
+
+from lentilwave import benchmark, config
+
+# Run the generate() benchmark sweep, comparing against this host's baseline if there is one
+# python profileme.py [save|profile]
+
+if len(sys.argv) > 1 and sys.argv[1] == "profile":
+    # Profile one representative case in detail
+    case = benchmark.get_cases(params=("offaxis",), sizes=((256, 512),), num_wavelengths=(9,), mono=(False,),
+                               return_psf=(False,), precisions=(64,))[0]
+    cProfile.run('benchmark.run_case(case, min_time=5.0)', 'profilestats')
+    p = pstats.Stats('profilestats')
+    p.strip_dirs().sort_stats('cumulative').print_stats(40)
+    p.strip_dirs().sort_stats('time').print_stats(40)
+    exit()
+
+if config.BENCHMARK_DIR is None:
+    # Keep this script's baselines next to it
+    config.BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+baseline_path = benchmark.get_baseline_path()
+if not (len(sys.argv) > 1 and sys.argv[1] == "save") and not os.path.exists(baseline_path):
+    print("No baseline for this host at {}, run 'python profileme.py save' to save one".format(baseline_path))
+
+cases = benchmark.get_cases() + benchmark.get_cases(modes=tuple(benchmark.ENGINE_MODES)[1:], sizes=((256, 512),),
+                                                     num_wavelengths=(9,))
+results = benchmark.run(cases)
+
+if len(sys.argv) > 1 and sys.argv[1] == "save":
+    print("Saved baseline to", benchmark.save_baseline(results, baseline_path))
+elif os.path.exists(baseline_path):
+    benchmark.compare(results, benchmark.load_baseline(baseline_path))